@@ -1,57 +1,617 @@
 """Functions for retrieving and analyzing Spotify user data"""
 
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-CLIENT_CREDENTIALS_MANAGER = SpotifyClientCredentials()
+import math
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from artist_graph import RebuildingArtistGraph
+from caching import PrefixCache, SingleFlight, TTLCache
+from timing import StageTimer
+from spotify_oauth_tools import get_spotify_client
+from songkick import normalize_artist_name
+
+# Number of Spotify artist search results
+ARTIST_SEARCH_LIMIT = 5
+
+# Artist search results by normalized search term
+ARTIST_SEARCH_CACHE = PrefixCache(ttl=int(os.getenv('ARTIST_SEARCH_CACHE_TTL', 24 * 60 * 60)),
+                                  max_entries=int(os.getenv('ARTIST_SEARCH_CACHE_MAX_ENTRIES', 10000)))
+
+# Max number of concurrent Spotify requests for a list of artists
+SPOTIFY_MAX_WORKERS = int(os.getenv('SPOTIFY_MAX_WORKERS', 10))
+
+# Timing of finding related artists for a list of artists
+RELATED_ARTISTS_TIMER = StageTimer('related_artists')
+
+# Coalesces identical related-artist requests in flight (can be shared between processes)
+RELATED_ARTISTS_FLIGHT = SingleFlight()
+
+# Seconds before related artists are refreshed, and before they can no longer be used
+RELATED_ARTISTS_REFRESH_AFTER = int(os.getenv('RELATED_ARTISTS_REFRESH_AFTER', 7 * 24 * 60 * 60))
+RELATED_ARTISTS_EXPIRE_AFTER = int(os.getenv('RELATED_ARTISTS_EXPIRE_AFTER', 30 * 24 * 60 * 60))
+
+# Related artists responses in this process, refreshed in the background once old
+RELATED_ARTISTS_CACHE = TTLCache(ttl=RELATED_ARTISTS_REFRESH_AFTER,
+                                 stale_ttl=RELATED_ARTISTS_EXPIRE_AFTER - RELATED_ARTISTS_REFRESH_AFTER,
+                                 max_entries=int(os.getenv('RELATED_ARTISTS_CACHE_MAX_ENTRIES', 20000)))
+
+# Related artists responses saved for all processes, set to an object with
+# get_many(spotify_ids), most_recent(limit) and set(spotify_id, response)
+RELATED_ARTISTS_STORE = None
+
+# Graph of the related artists cached in this process, rebuilt in the background every few minutes
+ARTIST_GRAPH = RebuildingArtistGraph(lambda: dict(RELATED_ARTISTS_CACHE.items()),
+                                     max_age=int(os.getenv('ARTIST_GRAPH_MAX_AGE', 10 * 60)))
+
+# Max hops from a user's top artists for recommendations, and max number of
+# recommendations more than one hop away
+ARTIST_GRAPH_DEPTH = int(os.getenv('ARTIST_GRAPH_DEPTH', 2))
+ARTIST_GRAPH_MAX_RECS = int(os.getenv('ARTIST_GRAPH_MAX_RECS', 20))
+
+# Spotify time ranges to read a user's top artists from, with each one's weight,
+# as "range:weight,range:weight" (medium_term only by default)
+TOP_ARTISTS_RANGES = [(time_range, float(weight)) for time_range, weight in
+                      (item.split(':') for item in os.getenv('TOP_ARTISTS_RANGES', 'medium_term:1').split(','))]
+
+# Number of top artists to read from each time range, and max number of merged top artists
+TOP_ARTISTS_LIMIT = int(os.getenv('TOP_ARTISTS_LIMIT', 10))
+TOP_ARTISTS_MAX_SEEDS = int(os.getenv('TOP_ARTISTS_MAX_SEEDS', 20))
+
+# Seconds to wait for all time ranges before going ahead with the ones that finished
+TOP_ARTISTS_TIMEOUT = float(os.getenv('TOP_ARTISTS_TIMEOUT', 5))
+
+# Max number of playlist tracks and followed artists to read when importing seeds
+SEED_IMPORT_MAX_TRACKS = int(os.getenv('SEED_IMPORT_MAX_TRACKS', 5000))
+SEED_IMPORT_MAX_FOLLOWED = int(os.getenv('SEED_IMPORT_MAX_FOLLOWED', 1000))
+
+# Max number of imported seed artists, and of recommendations made from them
+SEED_IMPORT_MAX_ARTISTS = int(os.getenv('SEED_IMPORT_MAX_ARTISTS', 200))
+SEED_IMPORT_TOP_K = int(os.getenv('SEED_IMPORT_TOP_K', 100))
+
+# Number of playlist tracks and followed artists in each page of Spotify results
+PLAYLIST_PAGE_SIZE = 100
+FOLLOWED_PAGE_SIZE = 50
+
+# Playlist id in a Spotify link, URI or on its own
+PLAYLIST_ID_RE = re.compile(r"(?:playlist[/:])?(?P<playlist_id>[0-9A-Za-z]{22})(?:\?.*)?$")
+
+# Max number of ranked recommendations from a user's top artists (all if not set)
+RECS_TOP_K = int(os.getenv('RECS_TOP_K', 0)) or None
 
 
 def find_spotify_artists(search_term):
-    """Returns list of results for artists matching the search term"""
+    """Returns list of results for artists matching the search term
+
+    Results are cached by normalized term. When every match for a shorter
+    term is cached, a longer term is answered from those without searching.
+    """
+
+    term = normalize_artist_name(search_term)
+
+    # Use cached results if available
+    artist_list = ARTIST_SEARCH_CACHE.get(term, artist_matches_term)
+    if artist_list is not None:
+        return [dict(artist_dict) for artist_dict in artist_list]
 
     # Search for artists using the term
-    sp = spotipy.Spotify(client_credentials_manager=CLIENT_CREDENTIALS_MANAGER)
-    artist_response = sp.search(search_term, type='artist', limit=5)
+    sp = get_spotify_client()
+    artist_response = sp.search(search_term, type='artist', limit=ARTIST_SEARCH_LIMIT)
 
     # Create a list of search results
     artist_list = parse_artist_response(artist_response['artists']['items'])
 
+    # Results are complete if there were no more to return
+    complete = artist_response['artists']['total'] <= ARTIST_SEARCH_LIMIT
+    ARTIST_SEARCH_CACHE.set(term, [dict(artist_dict) for artist_dict in artist_list], complete)
+
     return artist_list
 
 
-def get_top_artist_recs(spotify):
+def artist_matches_term(artist_dict, term):
+    """Return True if an artist's name contains the normalized search term"""
+
+    return term in normalize_artist_name(artist_dict['artist'])
+
+
+def parse_playlist_id(playlist):
+    """Returns Spotify playlist id from a playlist link, URI or id, or None if not found"""
+
+    match = PLAYLIST_ID_RE.search(playlist.strip())
+
+    return match.group('playlist_id') if match else None
+
+
+def import_playlist_seeds(spotify, playlist, max_tracks=None, max_artists=None):
+    """Returns list of artist dictionaries for the artists in a Spotify playlist
+
+    Reads up to max_tracks tracks, requesting their pages at once on a
+    bounded pool of workers. Artists with the most tracks come first, and at
+    most max_artists are returned. Raises ValueError if the playlist isn't a
+    playlist link, URI or id.
+    """
+
+    if max_tracks is None:
+        max_tracks = SEED_IMPORT_MAX_TRACKS
+    if max_artists is None:
+        max_artists = SEED_IMPORT_MAX_ARTISTS
+
+    playlist_id = parse_playlist_id(playlist)
+    if playlist_id is None:
+        raise ValueError("Not a Spotify playlist: {}".format(playlist))
+
+    artists = ArtistRecCollection()
+    track_counts = Counter()
+
+    def add_page(tracks_page):
+        for item in tracks_page['items']:
+            track = item.get('track')
+
+            # Skip removed tracks and local files
+            if not track:
+                continue
+
+            for artist in track['artists']:
+                if artist['id'] is None:
+                    continue
+
+                track_counts[artist['id']] += 1
+                if artist['id'] not in artists:
+                    artists.append(ArtistRec(artist['id'], artist['name']))
+
+    # Read the first page to find out how many tracks there are
+    first_page = get_playlist_tracks_page(spotify, playlist_id, 0)
+    add_page(first_page)
+
+    offsets = range(PLAYLIST_PAGE_SIZE, min(first_page['total'], max_tracks), PLAYLIST_PAGE_SIZE)
+
+    # Read the rest of the pages at once, adding them in order
+    if offsets:
+        workers = min(SPOTIFY_MAX_WORKERS, len(offsets))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for tracks_page in executor.map(lambda offset: get_playlist_tracks_page(spotify, playlist_id, offset),
+                                            offsets):
+                add_page(tracks_page)
+
+    ranked = sorted(artists, key=lambda rec: -track_counts[rec.spotify_id])
+
+    return [rec.to_dict() for rec in ranked[:max_artists]]
+
+
+def get_playlist_tracks_page(spotify, playlist_id, offset):
+    """Return page of a playlist's tracks with only the artists' ids and names"""
+
+    # This version of Spotipy only wraps the older endpoint that needs the owner's id
+    return spotify._get("playlists/{}/tracks".format(playlist_id),
+                        limit=PLAYLIST_PAGE_SIZE,
+                        offset=offset,
+                        fields='total,items(track(artists(id,name)))')
+
+
+def import_followed_seeds(spotify, max_artists=None):
+    """Returns list of artist dictionaries for the artists a user follows
+
+    Reads up to max_artists artists. Spotify pages followed artists with a
+    cursor, so the pages are read one after another.
+    """
+
+    if max_artists is None:
+        max_artists = SEED_IMPORT_MAX_FOLLOWED
+
+    artists = ArtistRecCollection()
+    after = None
+
+    while len(artists) < max_artists:
+        followed_response = spotify.current_user_followed_artists(limit=FOLLOWED_PAGE_SIZE,
+                                                                  after=after)['artists']
+        artists.add_response(followed_response['items'])
+
+        after = followed_response['cursors']['after']
+        if after is None:
+            break
+
+    return artists.to_dicts()[:max_artists]
+
+
+def get_recs_for_imported_seeds(seeds_list, top_k=None):
+    """Returns list of the best artist recommendations using a long list of seed artists"""
+
+    if top_k is None:
+        top_k = SEED_IMPORT_TOP_K
+
+    return get_recs_for_top_artists(seeds_list, top_k)
+
+
+def get_top_artist_recs(spotify, top_k=None):
     """Returns list of artist recommendations using Spotify API object"""
 
-    # Get user's top artists
-    top_artists_response = spotify.current_user_top_artists(limit=10,
-                                                            time_range='medium_term')
-    top_artists_list = parse_artist_response(top_artists_response['items'])
+    return get_recs_for_top_artists(get_top_artists(spotify), top_k)
+
+
+def get_top_artists(spotify, time_ranges=None, timeout=None, max_seeds=None):
+    """Returns list of artist dictionaries for a user's top artists using Spotify API object
+
+    Reads each of the (time range, weight) pairs in time_ranges (default
+    TOP_ARTISTS_RANGES) at once. Ranges that haven't finished within timeout
+    seconds are left out. Artists are ranked by their weighted ranks across
+    the ranges, and at most max_seeds are returned.
+    """
+
+    if time_ranges is None:
+        time_ranges = TOP_ARTISTS_RANGES
+    if timeout is None:
+        timeout = TOP_ARTISTS_TIMEOUT
+    if max_seeds is None:
+        max_seeds = TOP_ARTISTS_MAX_SEEDS
+
+    # Get user's top artists for one time range, as before
+    if len(time_ranges) == 1:
+        top_artists_response = spotify.current_user_top_artists(limit=TOP_ARTISTS_LIMIT,
+                                                                time_range=time_ranges[0][0])
+        return parse_artist_response(top_artists_response['items'])[:max_seeds]
+
+    # Get user's top artists for every time range at once
+    executor = ThreadPoolExecutor(max_workers=len(time_ranges))
+    futures = [executor.submit(spotify.current_user_top_artists,
+                               limit=TOP_ARTISTS_LIMIT, time_range=time_range)
+               for time_range, weight in time_ranges]
+    done, not_done = wait(futures, timeout=timeout)
+
+    # Don't wait for slow ranges to finish
+    executor.shutdown(wait=False)
+
+    ranked_lists = []
+
+    for (time_range, weight), future in zip(time_ranges, futures):
+        if future in not_done:
+            print("Top artists timed out: {}".format(time_range))
+        elif future.exception() is not None:
+            print("Top artists failed: {} ({})".format(time_range, future.exception()))
+        else:
+            ranked_lists.append((parse_artist_response(future.result()['items']), weight))
+
+    # Fail only if there's nothing to go ahead with
+    if not ranked_lists:
+        for future in futures:
+            if future in done:
+                raise future.exception()
+        raise TimeoutError("Top artists timed out")
+
+    return merge_ranked_artists(ranked_lists)[:max_seeds]
+
+
+def merge_ranked_artists(ranked_lists):
+    """Returns list of artist dictionaries merged from (ranked list, weight) pairs
 
-    # Get artists related to each of the user's top artists
-    related_artists_list = get_artist_recs(top_artists_list)
+    Each artist scores the list's weight, less for lower ranks, in every
+    list it's in. Artists are returned best first; ties keep the order they
+    were first seen in.
+    """
 
-    return related_artists_list
+    merged = ArtistRecCollection()
+    scores = {}
+
+    for artists_list, weight in ranked_lists:
+        for rank, artist_dict in enumerate(artists_list):
+            spotify_id = artist_dict['spotify_id']
+
+            if spotify_id not in merged:
+                merged.append(ArtistRec.from_dict(artist_dict))
+                scores[spotify_id] = 0
+
+            scores[spotify_id] += weight / math.log2(rank + 2)
+
+    recs = sorted(merged, key=lambda rec: -scores[rec.spotify_id])
+
+    return [rec.to_dict() for rec in recs]
+
+
+def get_recs_for_top_artists(top_artists_list, top_k=None, graph=None):
+    """Returns list of artist recommendations using list of a user's top artists
+
+    Recommendations (including artists further away, see add_graph_recs)
+    are ranked by how strongly they're related to the user's top artists,
+    and only the best top_k (default RECS_TOP_K) are kept
+    """
+
+    if top_k is None:
+        top_k = RECS_TOP_K
+
+    # Get artists related to the user's top artists, best first
+    related_artists_list = get_ranked_artist_recs(top_artists_list)
+
+    # Add artists further away from the top artists, then rank them all together
+    related_artists_list = add_graph_recs(top_artists_list, related_artists_list, graph)
+    related_artists_list.sort(key=lambda artist_dict: -artist_dict.get('score', 0))
+
+    return related_artists_list[:top_k]
 
 
 def get_artist_recs(artists_list):
     """Returns list of artist recommendations using list of artist dicitonaries"""
 
-    sp = spotipy.Spotify(client_credentials_manager=CLIENT_CREDENTIALS_MANAGER)
+    sp = get_spotify_client()
+
+    related_artists = ArtistRecCollection()
+
+    with RELATED_ARTISTS_TIMER.time():
+
+        # Get artists related to each of the artists in the list, all at once
+        spotify_ids = [artist_dict['spotify_id'] for artist_dict in artists_list]
+        rel_artists_resps = get_related_artists_batch(sp, spotify_ids)
+
+        # Add the related artists in the same order as the list
+        for artist_dict, rel_artists_resp in zip(artists_list, rel_artists_resps):
+            related_artists.append(ArtistRec.from_dict(artist_dict))
+            parse_artist_response(rel_artists_resp['artists'], related_artists, artist_dict['artist'])
+
+    return related_artists.to_dicts()
+
+
+def get_ranked_artist_recs(artists_list, top_k=None):
+    """Returns list of artist recommendations ranked by score, best first
+
+    The list of artist dictionaries should be in order of preference, like
+    a user's top artists. Keeps only the best top_k recommendations if set.
+    """
+
+    sp = get_spotify_client()
+
+    with RELATED_ARTISTS_TIMER.time():
+
+        # Get artists related to each of the artists in the list, all at once
+        spotify_ids = [artist_dict['spotify_id'] for artist_dict in artists_list]
+        rel_artists_resps = get_related_artists_batch(sp, spotify_ids)
+
+        return rank_artist_recs(artists_list, rel_artists_resps, top_k)
 
-    related_artists_list = []
 
-    # Get artists related to each of the artists in the list
-    for artist_dict in artists_list:
-        related_artists_list.append(artist_dict)
-        rel_artists_resp = sp.artist_related_artists(artist_dict['spotify_id'])
-        related_artists_list = parse_artist_response(rel_artists_resp['artists'], related_artists_list, artist_dict['artist'])
+def rank_artist_recs(seeds_list, rel_artists_resps, top_k=None):
+    """Returns list of artists from the seeds' related artists responses, ranked by score
 
-    return related_artists_list
+    Each artist's score adds up a weight for every seed it's related to,
+    higher for seeds earlier in the list and for artists earlier in the
+    seed's related artists. Seeds count as related to themselves, first.
+    Each dictionary has a 'score', a list of 'sources' (the seeds it's
+    related to, in seed order) and a 'source' (the first of them, or None for
+    seeds). Ties keep the order the artists were first seen in.
+    """
+
+    artists = []
+    index = {}
+
+    # Seed, artist and position of each relation
+    seed_numbers = []
+    artist_numbers = []
+    positions = []
+
+    def add_relation(seed_number, artist_dict, position):
+        i = index.get(artist_dict['spotify_id'])
+
+        if i is None:
+            i = index[artist_dict['spotify_id']] = len(artists)
+            artists.append(artist_dict)
+
+        seed_numbers.append(seed_number)
+        artist_numbers.append(i)
+        positions.append(position)
+
+    for seed_number, (seed_dict, rel_artists_resp) in enumerate(zip(seeds_list, rel_artists_resps)):
+        add_relation(seed_number, dict(seed_dict, source=None), 0)
+
+        related_list = parse_artist_response(rel_artists_resp['artists'], source=seed_dict['artist'])
+        for position, artist_dict in enumerate(related_list, 1):
+            add_relation(seed_number, artist_dict, position)
+
+    if not artists:
+        return []
+
+    # Matrix of artists by seeds, weighted by position in related artists
+    relations = np.zeros((len(artists), len(seeds_list)))
+    relations[artist_numbers, seed_numbers] = 1 / np.log2(np.array(positions) + 2)
+
+    # Weight seeds by rank, and add up each artist's relations
+    seed_weights = 1 / np.log2(np.arange(len(seeds_list)) + 2)
+    scores = relations.dot(seed_weights)
+
+    seed_ids = {seed_dict['spotify_id'] for seed_dict in seeds_list}
+    ranked_list = []
+
+    for i in np.argsort(-scores, kind='stable')[:top_k]:
+        artist_dict = artists[i]
+
+        # List every seed the artist is related to, except itself
+        sources = [seeds_list[j]['artist'] for j in np.flatnonzero(relations[i])
+                   if seeds_list[j]['spotify_id'] != artist_dict['spotify_id']]
+
+        artist_dict['sources'] = sources
+        artist_dict['source'] = None if artist_dict['spotify_id'] in seed_ids else sources[0]
+        artist_dict['score'] = float(scores[i])
+        ranked_list.append(artist_dict)
+
+    return ranked_list
+
+
+def add_graph_recs(artists_list, recs_list, graph=None, max_depth=None, limit=None):
+    """Add artists more than one hop from the artists to list of recommendations
+
+    Uses only related artists already cached, so makes no Spotify requests.
+    Artists up to max_depth hops away are ranked by personalized PageRank
+    from the artists, and the best limit of them are added with the related
+    artist they were reached from as their source. Each gets a 'score' like
+    rank_artist_recs gives: its source's score, weighted by its position in
+    the source's related artists.
+    """
+
+    if max_depth is None:
+        max_depth = ARTIST_GRAPH_DEPTH
+    if limit is None:
+        limit = ARTIST_GRAPH_MAX_RECS
+
+    if max_depth < 2 or limit < 1:
+        return recs_list
+
+    if graph is None:
+        graph = ARTIST_GRAPH.get()
+
+    # Graph is still being built
+    if graph is None:
+        return recs_list
+
+    seed_ids = [artist_dict['spotify_id'] for artist_dict in artists_list]
+    recs_ids_set = {artist['spotify_id'] for artist in recs_list}
+
+    # Find artists the recommendations don't already have
+    candidates = [(spotify_id, parent_id) for spotify_id, depth, parent_id in graph.bfs(seed_ids, max_depth)
+                  if depth >= 2 and spotify_id not in recs_ids_set]
+
+    if not candidates:
+        return recs_list
+
+    # Rank them by how closely connected they are to the artists
+    scores = graph.personalized_pagerank(seed_ids)
+    chosen = set(sorted(candidates, key=lambda candidate: -scores[graph.index[candidate[0]]])[:limit])
+
+    # Score artists after the artist they were reached from (in breadth-first order)
+    rec_scores = {artist['spotify_id']: artist.get('score', 0) for artist in recs_list}
+
+    for spotify_id, parent_id in candidates:
+        if (spotify_id, parent_id) not in chosen:
+            continue
+
+        i = graph.index[spotify_id]
+        position = graph.related(parent_id).index(spotify_id) + 1
+        rec_scores[spotify_id] = rec_scores.get(parent_id, 0) / math.log2(position + 2)
+
+        source = graph.names[graph.index[parent_id]]
+        recs_list.append({'spotify_id': spotify_id,
+                          'artist': graph.names[i],
+                          'source': source,
+                          'sources': [source],
+                          'image_url': graph.image_urls[i],
+                          'score': rec_scores[spotify_id]})
+
+    return recs_list
+
+
+def get_related_artists_batch(sp, spotify_ids):
+    """Return list of Spotify's related artists responses for a list of artist ids
+
+    Makes the requests concurrently on a bounded pool of workers. The
+    responses are in the same order as the ids.
+    """
+
+    # Nothing to request
+    if not spotify_ids:
+        return []
+
+    # Load any saved responses missing from this process in one query
+    if RELATED_ARTISTS_STORE is not None:
+        load_saved_related_artists([spotify_id for spotify_id in spotify_ids
+                                    if not RELATED_ARTISTS_CACHE.has(spotify_id)])
+
+    workers = min(SPOTIFY_MAX_WORKERS, len(spotify_ids))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda spotify_id: get_related_artists(sp, spotify_id, check_store=False),
+                                 spotify_ids))
+
+
+def get_related_artists(sp, spotify_id, check_store=True):
+    """Return Spotify's related artists response for an artist
+
+    Uses responses already fetched (in this process or in
+    RELATED_ARTISTS_STORE if set) before requesting them from Spotify.
+    Concurrent requests for the same artist share one request to Spotify.
+    """
+
+    if check_store and RELATED_ARTISTS_STORE is not None and not RELATED_ARTISTS_CACHE.has(spotify_id):
+        load_saved_related_artists([spotify_id])
+
+    flight_key = 'spotify:related-artists:{}'.format(spotify_id)
+
+    def fetch():
+        return RELATED_ARTISTS_FLIGHT.do(flight_key, lambda: fetch_related_artists(sp, spotify_id))
+
+    return RELATED_ARTISTS_CACHE.get_or_fetch(spotify_id, fetch)
+
+
+def fetch_related_artists(sp, spotify_id):
+    """Request related artists for an artist from Spotify and save the response"""
+
+    response = trim_related_artists_response(sp.artist_related_artists(spotify_id))
+
+    if RELATED_ARTISTS_STORE is not None:
+        RELATED_ARTISTS_STORE.set(spotify_id, response)
+
+    return response
+
+
+def trim_related_artists_response(response):
+    """Return related artists response with only the data used for recommendations"""
+
+    return {'artists': [{'id': artist['id'],
+                         'name': artist['name'],
+                         'images': artist['images'][:1]}
+                        for artist in response['artists']]}
+
+
+def load_saved_related_artists(spotify_ids):
+    """Add related artists responses saved in RELATED_ARTISTS_STORE to this process's cache
+
+    Returns number of responses loaded
+    """
+
+    if not spotify_ids:
+        return 0
+
+    return cache_saved_related_artists(RELATED_ARTISTS_STORE.get_many(spotify_ids))
+
+
+def warm_related_artists_cache(limit=None):
+    """Load the most recently fetched related artists into this process's cache
+
+    Returns number of responses loaded
+    """
+
+    if RELATED_ARTISTS_STORE is None:
+        return 0
+
+    if limit is None:
+        limit = RELATED_ARTISTS_CACHE.max_entries
+
+    return cache_saved_related_artists(RELATED_ARTISTS_STORE.most_recent(limit))
+
+
+def cache_saved_related_artists(saved):
+    """Add dictionary of spotify id to (response, fetched_at) to this process's cache
+
+    Returns number of responses added
+    """
+
+    # Keep the time saved, so old responses are still refreshed on time
+    for spotify_id, (response, fetched_at) in saved.items():
+        RELATED_ARTISTS_CACHE.set(spotify_id, response, stored_at=time.mktime(fetched_at.timetuple()))
+
+    return len(saved)
 
 
 def parse_artist_response(artists_response, results_list=None, source=None):
     """Takes results of API call and returns a list of dictionaries for each artist
 
-    Each dictionary in the returned list has a spotify ID, artist name, source, and image url"""
+    Each dictionary in the returned list has a spotify ID, artist name, source, and image url.
+    If results_list is an ArtistRecCollection, new artists are added to it
+    as records instead, and the collection is returned."""
+
+    # Add to collection, which already knows which artists it has
+    if isinstance(results_list, ArtistRecCollection):
+        results_list.add_response(artists_response, source)
+        return results_list
 
     if results_list is None:
         results_list = []
@@ -66,19 +626,92 @@ def parse_artist_response(artists_response, results_list=None, source=None):
         if artist['id'] in results_ids_set:
             continue
 
-        # Create dictionary for the artist
-        artist_dict = {}
-        artist_dict['spotify_id'] = artist['id']
-        artist_dict['artist'] = artist['name']
-        artist_dict['source'] = source
+        # Add dictionary for the artist to the list
+        results_list.append(ArtistRec.from_response(artist, source).to_dict())
+
+    return results_list
+
+
+class ArtistRec(object):
+    """Compact record of a recommended artist"""
+
+    __slots__ = ('spotify_id', 'artist', 'source', 'image_url')
+
+    def __init__(self, spotify_id, artist, source=None, image_url=None):
+
+        self.spotify_id = spotify_id
+        self.artist = artist
+        self.source = source
+        self.image_url = image_url
+
+    @classmethod
+    def from_response(cls, artist, source=None):
+        """Create record from an artist in a Spotify API response"""
 
         # Add a url for the artist's image if available
         try:
-            artist_dict['image_url'] = artist['images'][0]['url']
+            image_url = artist['images'][0]['url']
         except IndexError:
-            artist_dict['image_url'] = None
+            image_url = None
 
-        # Add dictionary to the list
-        results_list.append(artist_dict)
+        return cls(artist['id'], artist['name'], source, image_url)
 
-    return results_list
+    @classmethod
+    def from_dict(cls, artist_dict):
+        """Create record from an artist dictionary"""
+
+        return cls(artist_dict['spotify_id'],
+                   artist_dict['artist'],
+                   artist_dict.get('source'),
+                   artist_dict.get('image_url'))
+
+    def to_dict(self):
+        """Return artist dictionary, as used in JSON for the frontend"""
+
+        return {'spotify_id': self.spotify_id,
+                'artist': self.artist,
+                'source': self.source,
+                'image_url': self.image_url}
+
+    def __repr__(self):     # pragma: no cover
+        return "<ArtistRec spotify_id={} artist={}>".format(self.spotify_id, self.artist)
+
+
+class ArtistRecCollection(object):
+    """Ordered list of artist records with an index of their spotify ids
+
+    Checking whether an artist is already in the collection takes constant
+    time, however many artists it has.
+    """
+
+    def __init__(self):
+
+        self._recs = []
+        self._ids = set()
+
+    def __len__(self):
+        return len(self._recs)
+
+    def __iter__(self):
+        return iter(self._recs)
+
+    def __contains__(self, spotify_id):
+        return spotify_id in self._ids
+
+    def append(self, rec):
+        """Add record to the end of the collection, even if the artist is already in it"""
+
+        self._recs.append(rec)
+        self._ids.add(rec.spotify_id)
+
+    def add_response(self, artists_response, source=None):
+        """Add the artists from a Spotify API response that aren't already in the collection"""
+
+        for artist in artists_response:
+            if artist['id'] not in self._ids:
+                self.append(ArtistRec.from_response(artist, source))
+
+    def to_dicts(self):
+        """Return list of artist dictionaries, as used in JSON for the frontend"""
+
+        return [rec.to_dict() for rec in self._recs]
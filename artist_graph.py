@@ -0,0 +1,268 @@
+"""Graph of related artists built from Spotify related artists responses"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class ArtistGraph(object):
+    """Compact directed graph of artists and the artists related to them
+
+    Artists are numbered 0..n-1. The related artists of artist i are
+    targets[offsets[i]:offsets[i + 1]], in the order Spotify lists them
+    (compressed sparse row form), so each edge takes one 32-bit integer.
+    """
+
+    def __init__(self, spotify_ids, names, image_urls, offsets, targets):
+
+        self.spotify_ids = spotify_ids
+        self.names = names
+        self.image_urls = image_urls
+        self.offsets = offsets
+        self.targets = targets
+
+        # Map of spotify id to artist number
+        self.index = {spotify_id: i for i, spotify_id in enumerate(spotify_ids)}
+
+        # Artist each edge starts from, made when first needed
+        self._sources = None
+
+        self.built_at = time.time()
+
+    @classmethod
+    def from_responses(cls, responses):
+        """Return graph built from dictionary of spotify id to related artists response
+
+        Edges are written straight into preallocated arrays, so building
+        needs about 4 bytes per edge and 16 per artist on top of the Python
+        lists of artist ids, names and image urls. Each process builds its
+        own graph, so that is the bound per process.
+        """
+
+        spotify_ids = []
+        names = []
+        image_urls = []
+        index = {}
+
+        def artist_number(spotify_id, name=None, images=None):
+            i = index.get(spotify_id)
+
+            if i is None:
+                i = index[spotify_id] = len(spotify_ids)
+                spotify_ids.append(spotify_id)
+                names.append(name)
+                image_urls.append(None)
+
+            # Fill in artist details from the first response that has them
+            if names[i] is None:
+                names[i] = name
+            if image_urls[i] is None and images:
+                image_urls[i] = images[0]['url']
+
+            return i
+
+        # Number the artists with responses first, so their edges are in artist order
+        for spotify_id in responses:
+            artist_number(spotify_id)
+
+        n_sources = len(spotify_ids)
+        n_edges = sum(len(response['artists']) for response in responses.values())
+
+        offsets = np.zeros(n_sources + 1, dtype=np.int64)
+        targets = np.empty(n_edges, dtype=np.int32)
+        end = 0
+
+        for source, response in enumerate(responses.values()):
+            start = end
+            end = start + len(response['artists'])
+
+            targets[start:end] = np.fromiter((artist_number(artist['id'], artist['name'], artist['images'])
+                                              for artist in response['artists']),
+                                             dtype=np.int32, count=end - start)
+            offsets[source + 1] = end
+
+        # Artists only found as related artists have no edges of their own
+        n_artists = len(spotify_ids)
+        offsets = np.concatenate([offsets, np.full(n_artists - n_sources, end, dtype=np.int64)])
+
+        return cls(spotify_ids, names, image_urls, offsets, targets)
+
+    @property
+    def sources(self):
+        """Array of the artist each edge starts from"""
+
+        if self._sources is None:
+            out_degrees = np.diff(self.offsets)
+            self._sources = np.repeat(np.arange(len(self.spotify_ids), dtype=np.int32), out_degrees)
+
+        return self._sources
+
+    def related(self, spotify_id):
+        """Return list of spotify ids of the artists related to an artist"""
+
+        i = self.index.get(spotify_id)
+
+        if i is None:
+            return []
+
+        return [self.spotify_ids[j] for j in self.targets[self.offsets[i]:self.offsets[i + 1]]]
+
+    def seed_numbers(self, seed_ids):
+        """Return array of the artist numbers of the seeds in the graph"""
+
+        return np.array([self.index[spotify_id] for spotify_id in seed_ids if spotify_id in self.index],
+                        dtype=np.int32)
+
+    def bfs(self, seed_ids, max_depth=2):
+        """Return artists within max_depth hops of the seed artists
+
+        Returns list of (spotify id, depth, spotify id of artist it was
+        reached from) in breadth-first order. Seeds have depth 0 and come
+        from None.
+        """
+
+        n_artists = len(self.spotify_ids)
+        frontier = np.unique(self.seed_numbers(seed_ids))
+
+        depths = np.full(n_artists, -1, dtype=np.int32)
+        parents = np.full(n_artists, -1, dtype=np.int32)
+        depths[frontier] = 0
+        reached = [frontier]
+
+        for depth in range(1, max_depth + 1):
+            if not len(frontier):
+                break
+
+            # Gather every edge leaving the frontier, in frontier order
+            starts = self.offsets[frontier]
+            counts = self.offsets[frontier + 1] - starts
+            edge_numbers = (np.repeat(starts - np.cumsum(counts) + counts, counts) +
+                            np.arange(counts.sum()))
+            neighbors = self.targets[edge_numbers]
+            from_artists = np.repeat(frontier, counts)
+
+            # Keep the first edge reaching each artist not seen yet
+            unseen = depths[neighbors] < 0
+            neighbors, first = np.unique(neighbors[unseen], return_index=True)
+            first_order = np.argsort(first, kind='stable')
+            frontier = neighbors[first_order]
+
+            depths[frontier] = depth
+            parents[frontier] = from_artists[unseen][first[first_order]]
+            reached.append(frontier)
+
+        return [(self.spotify_ids[i], int(depths[i]),
+                 self.spotify_ids[parents[i]] if parents[i] >= 0 else None)
+                for i in np.concatenate(reached)]
+
+    def personalized_pagerank(self, seed_ids, damping=0.85, iterations=30, tolerance=1e-6):
+        """Return array of each artist's PageRank score, personalized to the seeds
+
+        Walks restart at the seed artists, so artists related to many seeds
+        (directly or through other artists) score highest. Scores sum to 1.
+        """
+
+        n_artists = len(self.spotify_ids)
+        seeds = self.seed_numbers(seed_ids)
+
+        if not len(seeds):
+            return np.zeros(n_artists)
+
+        restart = np.bincount(seeds, minlength=n_artists).astype(np.float64)
+        restart /= restart.sum()
+
+        out_degrees = np.diff(self.offsets).astype(np.float64)
+        dangling = out_degrees == 0
+        edge_weights = 1 / np.maximum(out_degrees, 1)
+
+        scores = restart.copy()
+
+        for _ in range(iterations):
+            # Spread each artist's score evenly over its related artists
+            spread = np.bincount(self.targets,
+                                 weights=(scores * edge_weights)[self.sources],
+                                 minlength=n_artists)
+
+            # Artists without related artists send their score back to the seeds
+            new_scores = damping * (spread + scores[dangling].sum() * restart) + (1 - damping) * restart
+
+            change = np.abs(new_scores - scores).sum()
+            scores = new_scores
+
+            if change < tolerance:
+                break
+
+        return scores
+
+    def stats(self):
+        """Return dictionary of graph size"""
+
+        return {'artists': len(self.spotify_ids),
+                'edges': len(self.targets),
+                'array_bytes': self.offsets.nbytes + self.targets.nbytes,
+                'age_seconds': time.time() - self.built_at}
+
+
+class RebuildingArtistGraph(object):
+    """Keeps an artist graph built from changing responses up to date
+
+    get() returns the current graph. Graphs are built in the background, so
+    get() returns None until the first one is ready, and the old graph is
+    still used while one older than max_age seconds is rebuilt.
+    """
+
+    def __init__(self, load_responses, max_age=10 * 60):
+
+        # Function returning dictionary of spotify id to related artists response
+        self.load_responses = load_responses
+        self.max_age = max_age
+
+        self._graph = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return current artist graph, or None if it isn't built yet"""
+
+        with self._lock:
+            graph = self._graph
+            stale = graph is None or time.time() - graph.built_at > self.max_age
+            rebuild = stale and not self._building
+
+            if rebuild:
+                self._building = True
+
+        if rebuild:
+            thread = threading.Thread(target=self.rebuild, name='artist-graph-builder')
+            thread.daemon = True
+            thread.start()
+
+        return graph
+
+    def rebuild(self):
+        """Build and return a new artist graph"""
+
+        try:
+            graph = ArtistGraph.from_responses(self.load_responses())
+
+            with self._lock:
+                self._graph = graph
+
+            return graph
+
+        except Exception as msg:      # pragma: no cover
+            print("Failed to build artist graph: {}".format(msg))
+            return None
+
+        finally:
+            with self._lock:
+                self._building = False
+
+    def stats(self):
+        """Return dictionary of current graph size, or None if not built"""
+
+        with self._lock:
+            graph = self._graph
+
+        return graph.stats() if graph is not None else None
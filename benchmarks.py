@@ -0,0 +1,325 @@
+"""Micro-benchmarks for performance-sensitive code
+
+Run all benchmarks with `python benchmarks.py`, or one with
+`python benchmarks.py <name>`.
+"""
+
+import copy
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import date, timedelta
+
+import arrow
+from flask import Flask
+
+import analyzation
+import migrations
+import sample_apis
+import songkick
+from model import db, connect_to_db, User, REMOVE_CONCERT_SQL
+
+
+def scale_events(n_events):
+    """Return list of n_events Songkick events copied from the sample API data
+
+    Each copy gets its own id and dates, so the list looks like a large
+    festival calendar with many concerts on each day
+    """
+
+    templates = (sample_apis.vw_concerts['resultsPage']['results']['event'] +
+                 sample_apis.outside_lands['resultsPage']['results']['event'])
+
+    first_day = date(2017, 1, 1)
+    events = []
+
+    for i in range(n_events):
+        event = copy.deepcopy(templates[i % len(templates)])
+        event['id'] = i
+        day = (first_day + timedelta(days=i % 365)).isoformat()
+
+        # Alternate between events with times and date-only events
+        if i % 2:
+            event['start'] = {'date': day, 'datetime': day + 'T19:30:00-0700'}
+        else:
+            event['start'] = {'date': day, 'datetime': None}
+            event['end'] = {'date': day, 'datetime': None}
+
+        events.append(event)
+
+    return events
+
+
+def create_concerts_with_arrow(events, search_dict):
+    """Return list of concert dictionaries, parsing every date with arrow
+
+    The previous implementation of songkick.create_concerts, for comparison
+    """
+
+    event_list = []
+
+    for event in events:
+        concert = {
+            'display_name': event['displayName'],
+            'songkick_id': event['id'],
+            'songkick_url': event['uri'],
+            'artist': search_dict['artist'],
+            'spotify_id': search_dict['spotify_id'],
+            'image_url': search_dict['image_url'],
+            'venue_name': event['venue']['displayName'],
+            'venue_lat': event['venue']['lat'],
+            'venue_lng': event['venue']['lng'],
+            'city': event['location']['city'],
+            'source': search_dict['source'],
+        }
+
+        if event.get('start'):
+            if event['start']['datetime']:
+                concert['start_datetime'] = arrow.get(event['start']['datetime']).isoformat()
+            else:
+                concert['start_datetime'] = arrow.get(event['start']['date']).isoformat()
+                concert['start_date'] = arrow.get(event['start']['date']).isoformat()
+
+        if event.get('end'):
+            if event['end']['datetime']:
+                concert['end_datetime'] = arrow.get(event['end']['datetime']).isoformat()
+            else:
+                concert['end_datetime'] = arrow.get(event['end']['date']).isoformat()
+                concert['end_date'] = arrow.get(event['end']['date']).isoformat()
+
+        event_list.append(concert)
+
+    return event_list
+
+
+def bench_create_concerts(n_events=5000, repeat=3):
+    """Compare create_concerts with the arrow-based version on n_events events"""
+
+    events = scale_events(n_events)
+    search_dict = {'spotify_id': '9999',
+                   'artist': 'Vampire Weekend',
+                   'image_url': None,
+                   'source': 'Phoenix'}
+
+    # Make sure the output hasn't changed
+    expected = create_concerts_with_arrow(events, search_dict)
+    assert songkick.create_concerts(events, search_dict) == expected
+
+    old = min(timeit.repeat(lambda: create_concerts_with_arrow(events, search_dict),
+                            number=1, repeat=repeat))
+    new = min(timeit.repeat(lambda: songkick.create_concerts(events, search_dict),
+                            number=1, repeat=repeat))
+
+    print("create_concerts ({} events)".format(n_events))
+    print("  arrow:      {:8.1f} ms".format(old * 1000))
+    print("  normalized: {:8.1f} ms  ({:.1f}x faster)".format(new * 1000, old / new))
+
+
+def scale_related_artists(n_seeds, n_related=20):
+    """Return list of seed artists and list of related artists responses for them
+
+    Related artists are shared between nearby seeds, so there are repeats
+    to skip like in real recommendations
+    """
+
+    seeds = [{'spotify_id': 'seed{}'.format(i),
+              'artist': 'Seed {}'.format(i),
+              'source': None,
+              'image_url': None} for i in range(n_seeds)]
+
+    responses = [{'artists': [{'id': 'artist{}'.format(i * n_related // 2 + j),
+                               'name': 'Artist {}'.format(i * n_related // 2 + j),
+                               'images': [{'url': 'https://i.scdn.co/image/{}'.format(j)}]}
+                              for j in range(n_related)]}
+                 for i in range(n_seeds)]
+
+    return seeds, responses
+
+
+def merge_related_artists_with_lists(seeds, responses):
+    """Return list of artist dictionaries, merging responses into a plain list
+
+    The previous implementation of analyzation.get_artist_recs, for comparison
+    """
+
+    related_artists_list = []
+
+    for artist_dict, rel_artists_resp in zip(seeds, responses):
+        related_artists_list.append(artist_dict)
+        related_artists_list = analyzation.parse_artist_response(rel_artists_resp['artists'],
+                                                                 related_artists_list,
+                                                                 artist_dict['artist'])
+
+    return related_artists_list
+
+
+def merge_related_artists_with_collection(seeds, responses):
+    """Return list of artist dictionaries, merging responses into an ArtistRecCollection"""
+
+    related_artists = analyzation.ArtistRecCollection()
+
+    for artist_dict, rel_artists_resp in zip(seeds, responses):
+        related_artists.append(analyzation.ArtistRec.from_dict(artist_dict))
+        analyzation.parse_artist_response(rel_artists_resp['artists'], related_artists, artist_dict['artist'])
+
+    return related_artists.to_dicts()
+
+
+def bench_merge_related_artists(n_seeds=2000, repeat=3):
+    """Compare merging related artists into a collection with merging into a list"""
+
+    seeds, responses = scale_related_artists(n_seeds)
+
+    # Make sure the output hasn't changed
+    expected = merge_related_artists_with_lists(seeds, responses)
+    assert merge_related_artists_with_collection(seeds, responses) == expected
+
+    old = min(timeit.repeat(lambda: merge_related_artists_with_lists(seeds, responses),
+                            number=1, repeat=repeat))
+    new = min(timeit.repeat(lambda: merge_related_artists_with_collection(seeds, responses),
+                            number=1, repeat=repeat))
+
+    print("merge related artists ({} seeds, {} artists)".format(n_seeds, len(expected)))
+    print("  list:       {:8.1f} ms".format(old * 1000))
+    print("  collection: {:8.1f} ms  ({:.1f}x faster)".format(new * 1000, old / new))
+
+
+# Concerts loaded for each profile page, like the server's PROFILE_PAGE_SIZE + 1
+PROFILE_LIMIT = int(os.getenv('PROFILE_PAGE_SIZE', 20)) + 1
+
+
+def compile_statement(statement):
+    """Return SQL and parameters of a SQLAlchemy statement, as the app would send them"""
+
+    compiled = statement.compile(dialect=db.engine.dialect)
+
+    return str(compiled), compiled.params
+
+
+def profile_statement(sample, past):
+    """Return SQL and parameters of the first profile page of a sampled user"""
+
+    user = User(user_id=sample['user_id'])
+
+    return compile_statement(user.profile_concerts_query(past, PROFILE_LIMIT).statement)
+
+
+# Statements behind the profile page, past concerts and removing a saved concert,
+# built from the model so they match the app's queries. Each takes a sampled
+# saved concert and returns (SQL, parameters).
+CONCERT_QUERIES = {
+    'profile': lambda sample: profile_statement(sample, past=False),
+    'past': lambda sample: profile_statement(sample, past=True),
+    'remove': lambda sample: compile_statement(db.text(REMOVE_CONCERT_SQL).bindparams(**sample)),
+}
+
+
+def seed_concerts(n_users, n_concerts, n_saves):
+    """Fill an empty DB with users, concerts spread over ten years and saved concerts"""
+
+    db.drop_all()
+    db.create_all()
+    migrations.drop_indexes()
+
+    with db.engine.begin() as conn:
+        conn.execute(db.text("""
+            INSERT INTO users (user_id, email, pw_hash)
+            SELECT i, 'user' || i || '@example.com', 'x' FROM generate_series(1, :n) AS i
+        """), n=n_users)
+
+        conn.execute(db.text("""
+            INSERT INTO concerts (songkick_id, artist, display_name, start_datetime)
+            SELECT i, 'Artist ' || i, 'Concert ' || i,
+                   now() - interval '5 years' + random() * interval '10 years'
+            FROM generate_series(1, :n) AS i
+        """), n=n_concerts)
+
+        conn.execute(db.text("""
+            INSERT INTO users_concerts (user_id, songkick_id)
+            SELECT 1 + (random() * (:n_users - 1))::int, 1 + (random() * (:n_concerts - 1))::int
+            FROM generate_series(1, :n) AS i
+        """), n=n_saves, n_users=n_users, n_concerts=n_concerts)
+
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(db.text('VACUUM ANALYZE'))
+
+
+def time_concert_queries(samples, n_runs):
+    """Print query plans and median latencies of the concert queries
+
+    Every query runs in a transaction that's rolled back, so removes don't
+    change the data
+    """
+
+    for name, make_statement in CONCERT_QUERIES.items():
+        with db.engine.connect() as conn:
+            trans = conn.begin()
+            query, params = make_statement(samples[0])
+            plan = conn.execute('EXPLAIN (ANALYZE, COSTS OFF) ' + query, params).fetchall()
+            trans.rollback()
+
+            timings = []
+
+            for sample in samples[:n_runs]:
+                query, params = make_statement(sample)
+                trans = conn.begin()
+                started = time.time()
+                conn.execute(query, params)
+                timings.append(time.time() - started)
+                trans.rollback()
+
+        timings.sort()
+        print("  {}: {:8.2f} ms median".format(name, timings[len(timings) // 2] * 1000))
+
+        for row in plan:
+            print("      " + row[0])
+
+
+def bench_concert_indexes(n_users=50000, n_concerts=1000000, n_saves=2000000, n_runs=50):
+    """Compare the concert queries before and after the migration's indexes
+
+    Drops and reseeds every table in the BENCH_DATABASE_URL database
+    """
+
+    app = Flask(__name__)
+    connect_to_db(app, os.getenv('BENCH_DATABASE_URL', 'postgresql:///consa_bench'))
+
+    with app.app_context():
+        print("concert indexes ({} users, {} concerts, {} saves)".format(n_users, n_concerts, n_saves))
+        seed_concerts(n_users, n_concerts, n_saves)
+
+        # Sample saved concerts to look up and remove
+        samples = [{'user_id': user_id, 'songkick_id': songkick_id}
+                   for user_id, songkick_id in db.engine.execute(db.text("""
+                       SELECT user_id, songkick_id FROM users_concerts
+                       ORDER BY random() LIMIT :n
+                   """), n=n_runs)]
+        random.shuffle(samples)
+
+        print(" without indexes")
+        time_concert_queries(samples, n_runs)
+
+        started = time.time()
+        migrations.add_indexes(concurrently=False)
+        db.engine.execute(db.text('ANALYZE'))
+        print(" migration: {:.1f} s".format(time.time() - started))
+
+        print(" with indexes")
+        time_concert_queries(samples, n_runs)
+
+
+BENCHMARKS = {
+    'create_concerts': bench_create_concerts,
+    'merge_related_artists': bench_merge_related_artists,
+    'concert_indexes': bench_concert_indexes,
+}
+
+
+if __name__ == "__main__":      # pragma: no cover
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,392 @@
+"""In-process caching and request coalescing for upstream API calls"""
+
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def estimate_size(value):
+    """Return approximate size in bytes of a cached value"""
+
+    # Use length of JSON for API data, else Python's own estimate
+    try:
+        return len(json.dumps(value))
+    except (TypeError, ValueError):
+        return sys.getsizeof(value)
+
+
+class TTLCache(object):
+    """Thread-safe cache with expiring entries and least-recently-used eviction
+
+    Entries are fresh for ttl seconds. For stale_ttl seconds after that they
+    are still returned, but refreshed in the background. The least recently
+    used entries are evicted once the cache holds more than max_entries
+    entries or (approximately) more than max_bytes bytes.
+    """
+
+    def __init__(self, ttl, stale_ttl=0, max_entries=1000, max_bytes=None,
+                 refresh_workers=2):
+
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Map of key to (value, time stored, size), in least recently used order
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        # Keys being refreshed in the background
+        self._refreshing = set()
+        self._refresh_workers = refresh_workers
+        self._executor = None
+
+        self._counts = {'hits': 0,
+                        'stale_hits': 0,
+                        'misses': 0,
+                        'evictions': 0,
+                        'refreshes': 0,
+                        'refresh_errors': 0}
+
+    def get(self, key):
+        """Return cached value for key if it's fresh, otherwise None"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry and time.time() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self._counts['hits'] += 1
+                return entry[0]
+
+            self._counts['misses'] += 1
+            return None
+
+    def has(self, key):
+        """Return True if the cache holds a usable (fresh or stale) value for key
+
+        Doesn't count as a lookup or change the entry's recent use
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return bool(entry) and time.time() - entry[1] < self.ttl + self.stale_ttl
+
+    def get_or_fetch(self, key, fetch):
+        """Return cached value for key, calling fetch() to get it if needed
+
+        Stale values are returned immediately and refreshed in the background.
+        If fetch() returns None, nothing is cached.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry:
+                value, stored_at, size = entry
+                age = time.time() - stored_at
+
+                # Return fresh value
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._counts['hits'] += 1
+                    return value
+
+                # Return stale value and refresh it in the background
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._counts['stale_hits'] += 1
+                    self._schedule_refresh(key, fetch)
+                    return value
+
+                # Drop value that's too old to use
+                self._remove(key)
+
+            self._counts['misses'] += 1
+
+        value = fetch()
+        self.set(key, value)
+
+        return value
+
+    def set(self, key, value, stored_at=None):
+        """Store value for key, evicting least recently used entries if needed
+
+        Does nothing if value is None or too large for the cache
+        """
+
+        if value is None:
+            return
+
+        if stored_at is None:
+            stored_at = time.time()
+
+        size = estimate_size(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            # Skip values that would evict everything else
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, stored_at, size)
+            self._size += size
+
+            # Evict least recently used entries until within limits
+            while (len(self._entries) > self.max_entries or
+                   (self.max_bytes is not None and self._size > self.max_bytes)):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._counts['evictions'] += 1
+
+    def items(self):
+        """Return list of (key, value) for every usable (fresh or stale) entry
+
+        Doesn't count as lookups or change the entries' recent use
+        """
+
+        now = time.time()
+
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()
+                    if now - entry[1] < self.ttl + self.stale_ttl]
+
+    def clear(self):
+        """Remove all entries from the cache"""
+
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return dictionary of cache counters and current size"""
+
+        with self._lock:
+            stats = dict(self._counts)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._size
+
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['stale_hits']) / lookups if lookups else None
+
+        return stats
+
+    def _remove(self, key):
+        """Remove entry for key (lock must be held)"""
+
+        value, stored_at, size = self._entries.pop(key)
+        self._size -= size
+
+    def _schedule_refresh(self, key, fetch):
+        """Refresh key in the background unless already refreshing (lock must be held)"""
+
+        if key in self._refreshing:
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._refresh_workers)
+
+        self._refreshing.add(key)
+        self._executor.submit(self._refresh, key, fetch)
+
+    def _refresh(self, key, fetch):
+        """Fetch and store a new value for key"""
+
+        try:
+            self.set(key, fetch())
+            with self._lock:
+                self._counts['refreshes'] += 1
+
+        except Exception as msg:
+            print("Cache refresh failed: {} ({})".format(key, msg))
+            with self._lock:
+                self._counts['refresh_errors'] += 1
+
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class PrefixCache(object):
+    """Thread-safe cache of search results that can answer longer terms from shorter ones
+
+    Results are stored by search term with whether they're complete (every
+    match, not just the first page). A term that isn't cached is answered
+    by filtering the complete results of its longest cached prefix. Entries
+    expire after ttl seconds, and the least recently used entries are
+    evicted once there are more than max_entries.
+    """
+
+    def __init__(self, ttl, max_entries=5000, min_prefix=1):
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_prefix = min_prefix
+
+        # Map of term to (results, complete, time stored), in least recently used order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._counts = {'hits': 0,
+                        'prefix_hits': 0,
+                        'misses': 0,
+                        'evictions': 0}
+
+    def get(self, term, match):
+        """Return cached results for term, or None if they aren't cached
+
+        match(result, term) should return True if a result for a prefix of
+        term is also a result for term.
+        """
+
+        now = time.time()
+
+        with self._lock:
+
+            # Use results for the term itself
+            entry = self._fresh_entry(term, now)
+            if entry:
+                self._counts['hits'] += 1
+                return entry[0]
+
+            # Otherwise filter complete results for the longest prefix
+            for length in range(len(term) - 1, self.min_prefix - 1, -1):
+                entry = self._fresh_entry(term[:length], now)
+
+                if entry and entry[1]:
+                    self._counts['prefix_hits'] += 1
+                    return [result for result in entry[0] if match(result, term)]
+
+            self._counts['misses'] += 1
+            return None
+
+    def set(self, term, results, complete):
+        """Store results for term, evicting least recently used entries if needed"""
+
+        with self._lock:
+            self._entries.pop(term, None)
+            self._entries[term] = (results, complete, time.time())
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts['evictions'] += 1
+
+    def clear(self):
+        """Remove all entries from the cache"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return dictionary of cache counters and current size"""
+
+        with self._lock:
+            stats = dict(self._counts, entries=len(self._entries))
+
+        lookups = stats['hits'] + stats['prefix_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['prefix_hits']) / lookups if lookups else None
+
+        return stats
+
+    def _fresh_entry(self, term, now):
+        """Return unexpired entry for term and mark it recently used (lock must be held)"""
+
+        entry = self._entries.get(term)
+
+        if entry is None:
+            return None
+
+        if now - entry[2] >= self.ttl:
+            del self._entries[term]
+            return None
+
+        self._entries.move_to_end(term)
+        return entry
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into one call
+
+    While a call for a key is in flight, other callers with the same key wait
+    for it and share its result (or exception). If a shared backend with the
+    same do() method is set, the one call is also coalesced through it, for
+    example with other processes.
+    """
+
+    def __init__(self, shared=None):
+
+        self.shared = shared
+
+        # Map of key to call in flight
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        self._counts = {'calls': 0,
+                        'shared': 0}
+
+    def do(self, key, fn):
+        """Return result of fn(), sharing it with concurrent callers for key"""
+
+        with self._lock:
+            call = self._calls.get(key)
+
+            # Wait for the call already in flight
+            if call is not None:
+                self._counts['shared'] += 1
+                leader = False
+
+            # Otherwise make the call
+            else:
+                call = _FlightCall()
+                self._calls[key] = call
+                self._counts['calls'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            if self.shared is not None:
+                call.result = self.shared.do(key, fn)
+            else:
+                call.result = fn()
+
+            return call.result
+
+        except Exception as error:
+            call.error = error
+            raise
+
+        # Let waiting callers have the result
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Return dictionary of counts of calls made and calls shared"""
+
+        with self._lock:
+            return dict(self._counts, in_flight=len(self._calls))
+
+
+class _FlightCall(object):
+    """A call in flight for SingleFlight"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -1,10 +1,11 @@
 from server import app as application
-from server import print_referrer
+from server import print_referrer, configure_shared_state
 from model import connect_to_db
 
 application.before_request(print_referrer)
 
 connect_to_db(application)
+configure_shared_state()
 
 if __name__ == "__main__":
 
@@ -0,0 +1,63 @@
+"""Thread-safe requests sessions sharing one pool of keep-alive connections"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Response statuses retried with backoff, since APIs send them for passing problems
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTP adapter whose connections stay open when a response closes it
+
+    Spotipy closes the response's connection (the adapter) after every call,
+    which would empty the shared pool. Call close_pool() to really close it.
+    """
+
+    def close(self):
+        """Keep the connection pool open"""
+
+    def close_pool(self):
+        """Close every connection in the pool"""
+
+        super(KeepAliveAdapter, self).close()
+
+
+class ThreadSessions(object):
+    """Gives each thread its own requests session, all sharing one connection pool
+
+    Requests are retried with exponential backoff on connection errors and
+    retry_statuses responses. Once retries run out the last response is
+    returned instead of raising.
+    """
+
+    def __init__(self, pool_size, retries, backoff_factor, retry_statuses=RETRY_STATUSES):
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=retry_statuses,
+                      raise_on_status=False)
+
+        # Adapter holding the connection pool shared by every thread
+        self.adapter = KeepAliveAdapter(pool_connections=2,
+                                        pool_maxsize=pool_size,
+                                        max_retries=retry)
+
+        # Sessions aren't thread-safe, so each thread gets its own
+        self._local = threading.local()
+
+    def get(self):
+        """Return this thread's session, using the shared connection pool"""
+
+        session = getattr(self._local, 'session', None)
+
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+
+        return session
@@ -0,0 +1,94 @@
+"""Schema changes for databases created before the models changed
+
+Run with `python migrations.py`, or from the Flask CLI with
+`flask migrate-db`. Every migration can be run again safely.
+"""
+
+from model import db, connect_to_db
+
+# Indexes added to existing tables, as (name, CREATE INDEX statement)
+INDEXES = [
+    ('ux_users_concerts_user_id_songkick_id',
+     'CREATE UNIQUE INDEX {concurrently} IF NOT EXISTS ux_users_concerts_user_id_songkick_id '
+     'ON users_concerts (user_id, songkick_id)'),
+    ('ix_users_concerts_songkick_id',
+     'CREATE INDEX {concurrently} IF NOT EXISTS ix_users_concerts_songkick_id '
+     'ON users_concerts (songkick_id)'),
+    ('ix_concerts_start_datetime_songkick_id',
+     'CREATE INDEX {concurrently} IF NOT EXISTS ix_concerts_start_datetime_songkick_id '
+     'ON concerts (start_datetime, songkick_id)'),
+]
+
+
+def remove_duplicate_saves(conn):
+    """Delete all but the first save of each concert by each user
+
+    Returns number of rows deleted
+    """
+
+    return conn.execute(db.text("""
+        DELETE FROM users_concerts AS later
+        USING users_concerts AS earlier
+        WHERE later.user_id = earlier.user_id
+          AND later.songkick_id = earlier.songkick_id
+          AND later.user_concert_id > earlier.user_concert_id
+    """)).rowcount
+
+
+def add_indexes(concurrently=True):
+    """Remove duplicate saves, then add the indexes missing from the tables
+
+    With concurrently, indexes are built without blocking writes to the
+    tables, which is slower. Returns list of the index names.
+    """
+
+    # Duplicates would stop the unique index being built
+    with db.engine.begin() as conn:
+        removed = remove_duplicate_saves(conn)
+
+    if removed:
+        print("Removed {} duplicate saved concerts".format(removed))
+
+    # Concurrent index builds can't run inside a transaction
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        for name, statement in INDEXES:
+
+            # Drop index left invalid by an interrupted concurrent build
+            invalid = conn.execute(db.text("""
+                SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                WHERE pg_class.relname = :name AND NOT pg_index.indisvalid
+            """), name=name).first()
+
+            if invalid:      # pragma: no cover
+                conn.execute(db.text('DROP INDEX {}'.format(name)))
+
+            conn.execute(db.text(statement.format(concurrently='CONCURRENTLY' if concurrently else '')))
+
+    return [name for name, statement in INDEXES]
+
+
+def drop_indexes():
+    """Drop the indexes added by add_indexes, for comparing query plans"""
+
+    with db.engine.begin() as conn:
+        for name, statement in INDEXES:
+            conn.execute(db.text('DROP INDEX IF EXISTS {}'.format(name)))
+
+
+def migrate(concurrently=True):
+    """Create new tables and bring existing ones up to date"""
+
+    db.create_all()
+    add_indexes(concurrently)
+
+
+if __name__ == "__main__":      # pragma: no cover
+
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        migrate()
+        print("Migrated DB.")
@@ -1,9 +1,31 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timedelta
 
+import hashlib
+import json
 import os
+import threading
+import time
+
+from songkick import normalize_artist_name
+
 db = SQLAlchemy()
 
+# Delete a user's saved concert, then the concert if no other user saved it
+REMOVE_CONCERT_SQL = """
+    WITH removed AS (
+        DELETE FROM users_concerts
+        WHERE user_id = :user_id AND songkick_id = :songkick_id
+        RETURNING songkick_id
+    )
+    DELETE FROM concerts
+    WHERE songkick_id IN (SELECT songkick_id FROM removed)
+      AND NOT EXISTS (SELECT 1 FROM users_concerts
+                      WHERE users_concerts.songkick_id = concerts.songkick_id
+                        AND users_concerts.user_id != :user_id)
+"""
+
 
 class User(db.Model):
     """App users"""
@@ -47,21 +69,52 @@ class User(db.Model):
             print(msg)
             return False
 
+    @classmethod
+    def save_concerts(cls, user_id, concert_rows):
+        """Save concerts to a user's list of saved concerts in one transaction
+
+        Takes list of dictionaries of concert columns. Concerts already in the
+        database and concerts the user already saved are left as they are, so
+        users saving the same new concert at once don't conflict.
+        Return True if successful, False if unsuccessful
+        """
+
+        if not concert_rows:
+            return True
+
+        concert_upsert = insert(Concert.__table__).values(concert_rows)
+        concert_upsert = concert_upsert.on_conflict_do_nothing(index_elements=['songkick_id'])
+
+        # The unique index on user and concert decides which saves are repeats
+        assoc_upsert = insert(UserConcert.__table__).values([{'user_id': user_id,
+                                                              'songkick_id': row['songkick_id']}
+                                                             for row in concert_rows])
+        assoc_upsert = assoc_upsert.on_conflict_do_nothing(index_elements=['user_id', 'songkick_id'])
+
+        try:
+            db.session.execute(concert_upsert)
+            db.session.execute(assoc_upsert)
+            db.session.commit()
+            return True
+
+        # Rollback transaction and return False if not successful
+        except Exception as msg:
+            db.session.rollback()
+            print(msg)
+            return False
+
     def remove_concert(self, songkick_id):
         """Removes concert from user's list of saved concerts
 
-        Removes association betwen user and the concert from the UserConcert table
+        Removes association betwen user and the concert from the UserConcert
+        table, and the concert if no other users saved it, in one statement
         Return True if successful, False if unsuccessful
         """
 
-        # Delete all associations in users_concerts table between this user and concert
+        # Delete association, then concert if no other user's association uses it
         try:
-            UserConcert.query.filter(UserConcert.songkick_id == songkick_id,
-                                     UserConcert.user_id == self.user_id).delete()
-
-            # Delete concert from database if no users associated
-            if not Concert.query.get(songkick_id).users:
-                Concert.query.filter(Concert.songkick_id == songkick_id).delete()
+            db.session.execute(db.text(REMOVE_CONCERT_SQL),
+                               {'user_id': self.user_id, 'songkick_id': songkick_id})
 
             # Return True if successful
             db.session.commit()
@@ -73,11 +126,127 @@ class User(db.Model):
             print(msg)
             return False
 
+    def saved_concerts_query(self):
+        """Return query of the concerts the user has saved"""
+
+        return Concert.query.join(UserConcert,
+                                  UserConcert.songkick_id == Concert.songkick_id).filter(
+                                      UserConcert.user_id == self.user_id)
+
+    @classmethod
+    def saved_concert_ids(cls, user_id):
+        """Return list of the songkick ids of a user's saved concerts
+
+        Reads only the association table, without loading the user or concerts
+        """
+
+        return [songkick_id for songkick_id, in
+                db.session.query(UserConcert.songkick_id).filter(UserConcert.user_id == user_id)]
+
+    def concerts_page_query(self, past, limit=None, cursor=None, now=None):
+        """Return query of a page of the user's future or past saved concerts
+
+        Future concerts are soonest first and past concerts latest first.
+        For keyset pagination, cursor is the (start_datetime, songkick_id) of
+        the last concert on the previous page.
+        """
+
+        # Compare with the time now, not when the app started
+        if now is None:
+            now = datetime.now()
+
+        key = db.tuple_(Concert.start_datetime, Concert.songkick_id)
+
+        if past:
+            query = self.saved_concerts_query().filter(Concert.start_datetime < now)
+            query = query.filter(key < cursor) if cursor else query
+            order_by = (Concert.start_datetime.desc(), Concert.songkick_id.desc())
+
+        else:
+            query = self.saved_concerts_query().filter(Concert.start_datetime > now)
+            query = query.filter(key > cursor) if cursor else query
+            order_by = (Concert.start_datetime, Concert.songkick_id)
+
+        return query.order_by(*order_by).limit(limit)
+
+    def future_concerts(self, limit=None, after=None):
+        """Return list of the user's saved concerts that haven't started, soonest first
+
+        For keyset pagination, after is the (start_datetime, songkick_id)
+        of the last concert on the previous page
+        """
+
+        return self.concerts_page_query(False, limit, after).all()
+
+    def past_concerts(self, limit=None, before=None):
+        """Return list of the user's saved concerts that have started, latest first
+
+        For keyset pagination, before is the (start_datetime, songkick_id)
+        of the last concert on the previous page
+        """
+
+        return self.concerts_page_query(True, limit, before).all()
+
+    def profile_concerts_query(self, past, limit, cursor=None, now=None):
+        """Return query of a page of saved concerts and one concert from the other side
+
+        See concerts_page_query for past, limit and cursor
+        """
+
+        if now is None:
+            now = datetime.now()
+
+        page = self.concerts_page_query(past, limit, cursor, now)
+        other = self.concerts_page_query(not past, 1, None, now)
+
+        return page.union_all(other)
+
+    def load_profile_concerts(self, past, limit, cursor=None):
+        """Return a page of future or past saved concerts and whether there are any of the other
+
+        Loads the page and one concert from the other side in a single query,
+        then splits them by the time now. Returns (list of concerts, boolean).
+        """
+
+        now = datetime.now()
+
+        concerts = []
+        has_other = False
+
+        # Split by the same time the query used
+        for concert in self.profile_concerts_query(past, limit, cursor, now):
+            if (concert.start_datetime < now) == past:
+                concerts.append(concert)
+            else:
+                has_other = True
+
+        # Union doesn't keep the page's order
+        concerts.sort(key=lambda concert: (concert.start_datetime, concert.songkick_id), reverse=past)
+
+        return concerts, has_other
+
     def __repr__(self):     # pragma: no cover
         return ("<User user_id={} email={}>"
                 .format(self.user_id, self.email))
 
 
+# Concert form fields, as (form field name, Concert column name)
+CONCERT_FORM_FIELDS = [('songkick-id', 'songkick_id'),
+                       ('songkick-url', 'songkick_url'),
+                       ('artist', 'artist'),
+                       ('spotify-id', 'spotify_id'),
+                       ('image-url', 'image_url'),
+                       ('venue-name', 'venue_name'),
+                       ('venue-lat', 'venue_lat'),
+                       ('venue-lng', 'venue_lng'),
+                       ('city', 'city'),
+                       ('start-date', 'start_date'),
+                       ('start-datetime', 'start_datetime'),
+                       ('end-date', 'end_date'),
+                       ('end-datetime', 'end_datetime'),
+                       ('display-name', 'display_name')]
+
+
 class Concert(db.Model):
     """Concerts"""
 
@@ -100,42 +269,24 @@ class Concert(db.Model):
     end_datetime = db.Column(db.DateTime)
     display_name = db.Column(db.String(128))
 
+    # Profile pages filter and order saved concerts by start time
+    __table_args__ = (db.Index('ix_concerts_start_datetime_songkick_id', 'start_datetime', 'songkick_id'),)
+
+    @classmethod
+    def row_from_form(cls, form):
+        """Return dictionary of concert columns from a form's concert information
+
+        Empty fields are None, so they're stored as NULL
+        """
+
+        return {column: form.get(field) or None for field, column in CONCERT_FORM_FIELDS}
+
     @classmethod
     def create_from_form(cls, form):
         """Instantiate a new Concert using concert information from a form"""
 
-        # Get concert data from form
-        songkick_id = form.get('songkick-id')
-        songkick_url = form.get('songkick-url')
-        artist = form.get('artist')
-        spotify_id = form.get('spotify-id')
-        image_url = form.get('image-url')
-        venue_name = form.get('venue-name')
-        venue_lat = form.get('venue-lat')
-        venue_lng = form.get('venue-lng')
-        city = form.get('city')
-        start_date = form.get('start-date') or None
-        start_datetime = form.get('start-datetime') or None
-        end_date = form.get('end-date') or None
-        end_datetime = form.get('end-datetime') or None
-        display_name = form.get('display-name')
-
-        # Create new concert object from data
-        new_concert = cls(songkick_id=songkick_id,
-                          songkick_url=songkick_url,
-                          artist=artist,
-                          spotify_id=spotify_id,
-                          image_url=image_url,
-                          venue_name=venue_name,
-                          venue_lat=venue_lat,
-                          venue_lng=venue_lng,
-                          city=city,
-                          start_date=start_date,
-                          start_datetime=start_datetime,
-                          end_date=end_date,
-                          end_datetime=end_datetime,
-                          display_name=display_name,
-                          )
+        # Create new concert object from form data
+        new_concert = cls(**cls.row_from_form(form))
 
         # Add and commit new concert and return True if successful
         try:
@@ -150,6 +301,63 @@ class Concert(db.Model):
             print(msg)
             return False
 
+    @classmethod
+    def collect_orphans(cls, now, batch_size=1000):
+        """Remove a batch of concerts no user has saved, in one short transaction
+
+        Concerts that haven't started are deleted, and ones that have are
+        moved to the concerts archive. Concerts locked by other
+        transactions, like a user saving one, are skipped.
+        Returns (number deleted, number archived)
+        """
+
+        # Pick orphans without waiting on locked rows
+        orphans = """
+            SELECT songkick_id FROM concerts
+            WHERE NOT EXISTS (SELECT 1 FROM users_concerts
+                              WHERE users_concerts.songkick_id = concerts.songkick_id)
+              AND {}
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        """
+        columns = ', '.join(column.name for column in cls.__table__.columns)
+
+        with db.engine.begin() as conn:
+            deleted = conn.execute(db.text("""
+                DELETE FROM concerts WHERE songkick_id IN ({})
+            """.format(orphans.format('(start_datetime >= :now OR start_datetime IS NULL)'))),
+                now=now, batch_size=batch_size).rowcount
+
+            archived = conn.execute(db.text("""
+                WITH moved AS (
+                    DELETE FROM concerts WHERE songkick_id IN ({orphans})
+                    RETURNING {columns}
+                )
+                INSERT INTO concerts_archive ({columns}, archived_at)
+                SELECT {columns}, :now FROM moved
+                ON CONFLICT (songkick_id) DO NOTHING
+            """.format(orphans=orphans.format('start_datetime < :now'), columns=columns)),
+                now=now, batch_size=batch_size).rowcount
+
+        return deleted, archived
+
+    @property
+    def page_cursor(self):
+        """Cursor for the page of saved concerts after this one"""
+
+        return '{}_{}'.format(self.start_datetime.isoformat(), self.songkick_id)
+
+    @staticmethod
+    def parse_page_cursor(cursor):
+        """Return (start_datetime, songkick_id) from a page cursor, or None if it's invalid"""
+
+        try:
+            start_datetime, songkick_id = cursor.rsplit('_', 1)
+            return datetime.fromisoformat(start_datetime), int(songkick_id)
+
+        except (AttributeError, ValueError):
+            return None
+
     def __repr__(self):     # pragma: no cover
         return ("<Concert songkick_id={} display_name={}>"
                 .format(self.songkick_id, self.display_name))
@@ -170,23 +378,648 @@ class UserConcert(db.Model):
                             db.ForeignKey('concerts.songkick_id'),
                             nullable=False)
 
+    # Each concert is saved once per user, and found by user or by concert
+    __table_args__ = (db.Index('ux_users_concerts_user_id_songkick_id', 'user_id', 'songkick_id', unique=True),
+                      db.Index('ix_users_concerts_songkick_id', 'songkick_id'))
+
     def __repr__(self):     # pragma: no cover
         return ("<UserConcert user_id={} songkick_id={}>"
                 .format(self.user_id, self.songkick_id))
 
 
-# Create relationships between users and concerts for past and future concerts
-User.future_concerts = db.relationship("Concert",
-                                       order_by="Concert.start_datetime",
-                                       secondary="users_concerts",
-                                       secondaryjoin=db.and_(UserConcert.songkick_id == Concert.songkick_id,
-                                                             Concert.start_datetime > datetime.now()))
+class ConcertArchive(db.Model):
+    """Past concerts no user has saved any more, moved out of the concerts table"""
+
+    __tablename__ = "concerts_archive"
+
+    songkick_id = db.Column(db.Integer,
+                            primary_key=True)
+    songkick_url = db.Column(db.String(256))
+    artist = db.Column(db.String(64),
+                       nullable=False)
+    spotify_id = db.Column(db.String(64))
+    image_url = db.Column(db.String(256))
+    venue_name = db.Column(db.String(64))
+    venue_lat = db.Column(db.Float)
+    venue_lng = db.Column(db.Float)
+    city = db.Column(db.String(64))
+    start_date = db.Column(db.Date)
+    start_datetime = db.Column(db.DateTime)
+    end_date = db.Column(db.Date)
+    end_datetime = db.Column(db.DateTime)
+    display_name = db.Column(db.String(128))
+    archived_at = db.Column(db.DateTime,
+                            nullable=False)
+
+    def __repr__(self):     # pragma: no cover
+        return ("<ConcertArchive songkick_id={} display_name={}>"
+                .format(self.songkick_id, self.display_name))
+
+
+class SpotifyUser(db.Model):
+    """Spotify users who have authorized the app, with their tokens and top artists"""
+
+    __tablename__ = "spotify_users"
+
+    spotify_user_id = db.Column(db.String(64),
+                                primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.user_id'),
+                        index=True)
+    access_token = db.Column(db.Text)
+    refresh_token = db.Column(db.Text)
+    token_expires_at = db.Column(db.DateTime)
+    top_artists_json = db.Column(db.Text)
+    top_artists_fetched_at = db.Column(db.DateTime)
+
+    @classmethod
+    def save_authorization(cls, spotify_user_id, token_info, user_id=None):
+        """Save Spotify user's tokens, adding the user if they're new
+
+        Links the Spotify user to the app user if user_id is given
+        Return the SpotifyUser if successful, None if unsuccessful
+        """
+
+        spotify_user = cls.query.get(spotify_user_id)
+
+        if spotify_user is None:
+            spotify_user = cls(spotify_user_id=spotify_user_id)
+            db.session.add(spotify_user)
+
+        if user_id is not None:
+            spotify_user.user_id = user_id
+
+        if spotify_user.save_token(token_info):
+            return spotify_user
+
+        return None
+
+    def save_token(self, token_info):
+        """Save Spotify token info, keeping the old refresh token if there's no new one
+
+        Return True if successful, False if unsuccessful
+        """
+
+        self.access_token = token_info['access_token']
+        self.refresh_token = token_info.get('refresh_token') or self.refresh_token
+        self.token_expires_at = datetime.fromtimestamp(token_info['expires_at'])
+
+        try:
+            db.session.commit()
+            return True
+
+        # Rollback transaction and return False if not successful
+        except Exception as msg:      # pragma: no cover
+            db.session.rollback()
+            print(msg)
+            return False
+
+    def token_is_valid(self):
+        """Return True if the access token won't expire in the next minute"""
+
+        return (self.access_token is not None and
+                self.token_expires_at - datetime.now() > timedelta(minutes=1))
+
+    def get_top_artists(self, max_age):
+        """Return saved list of top artist dictionaries if fetched within max_age, else None"""
+
+        if (self.top_artists_json is None or
+                datetime.now() - self.top_artists_fetched_at >= max_age):
+            return None
+
+        return json.loads(self.top_artists_json)
+
+    def save_top_artists(self, top_artists_list):
+        """Save list of top artist dictionaries
+
+        Return True if successful, False if unsuccessful
+        """
+
+        self.top_artists_json = json.dumps(top_artists_list)
+        self.top_artists_fetched_at = datetime.now()
+
+        try:
+            db.session.commit()
+            return True
+
+        # Rollback transaction and return False if not successful
+        except Exception as msg:      # pragma: no cover
+            db.session.rollback()
+            print(msg)
+            return False
+
+    def __repr__(self):     # pragma: no cover
+        return ("<SpotifyUser spotify_user_id={} user_id={}>"
+                .format(self.spotify_user_id, self.user_id))
+
+
+class Location(db.Model):
+    """Songkick locations users have searched in"""
+
+    __tablename__ = "locations"
+
+    location_id = db.Column(db.String(32),
+                            primary_key=True)
+    name = db.Column(db.String(128))
+    search_count = db.Column(db.Integer,
+                             nullable=False,
+                             default=0)
+    last_searched = db.Column(db.DateTime)
+    refreshed_at = db.Column(db.DateTime)
+
+    @classmethod
+    def record_search(cls, location_id, name=None):
+        """Count a search in a location, adding the location if it's new
+
+        Return True if successful, False if unsuccessful
+        """
+
+        table = cls.__table__
+
+        # Add location if it hasn't been searched before, else increment its
+        # search count in the database (so concurrent searches are all counted)
+        upsert = insert(table).values(location_id=location_id,
+                                      name=name,
+                                      search_count=1,
+                                      last_searched=datetime.now())
+        upsert = upsert.on_conflict_do_update(index_elements=[table.c.location_id],
+                                              set_={'search_count': table.c.search_count + 1,
+                                                    'last_searched': upsert.excluded.last_searched})
+
+        try:
+            db.session.execute(upsert)
+            db.session.commit()
+            return True
+
+        # Rollback transaction and return False if not successful
+        except Exception as msg:      # pragma: no cover
+            db.session.rollback()
+            print(msg)
+            return False
+
+    @classmethod
+    def most_searched(cls, limit=10):
+        """Return list of the most searched locations"""
+
+        return (cls.query.order_by(cls.search_count.desc(), cls.last_searched.desc())
+                         .limit(limit)
+                         .all())
+
+    def is_warm(self, max_age):
+        """Return True if location's events were refreshed within max_age"""
+
+        return (self.refreshed_at is not None and
+                datetime.now() - self.refreshed_at < max_age)
+
+    def __repr__(self):     # pragma: no cover
+        return ("<Location location_id={} search_count={}>"
+                .format(self.location_id, self.search_count))
+
+
+class Event(db.Model):
+    """Upcoming Songkick events in searched locations
+
+    Stores the event JSON from Songkick so concerts can be found without
+    making requests to Songkick
+    """
+
+    __tablename__ = "events"
+
+    songkick_id = db.Column(db.Integer,
+                            primary_key=True)
+    location_id = db.Column(db.String(32),
+                            db.ForeignKey('locations.location_id'),
+                            nullable=False,
+                            index=True)
+    start_date = db.Column(db.Date)
+    event_json = db.Column(db.Text,
+                           nullable=False)
+
+    @classmethod
+    def replace_for_location(cls, location_id, events):
+        """Replace a location's stored events in one transaction
+
+        Takes list of Songkick event JSON for all of the location's events,
+        which marks the location warm, so never pass a partial calendar
+        Return True if successful, False if unsuccessful
+        """
+
+        event_rows = []
+        artist_rows = []
+        seen_ids = set()
+
+        for event in events:
+
+            # Skip events repeated between calendar pages
+            if event['id'] in seen_ids:
+                continue
+            seen_ids.add(event['id'])
+
+            event_rows.append({'songkick_id': event['id'],
+                               'location_id': location_id,
+                               'start_date': (event.get('start') or {}).get('date'),
+                               'event_json': json.dumps(event)})
+
+            # Add a row for each artist performing (once per artist)
+            artist_keys = {normalize_artist_name(performance['artist']['displayName'])
+                           for performance in event.get('performance', [])}
+            artist_rows.extend({'songkick_id': event['id'], 'artist_key': artist_key}
+                               for artist_key in artist_keys)
+
+        # Ids of old events for location and of events being moved here
+        old_ids = db.select([cls.songkick_id]).where(cls.location_id == location_id)
+        event_ids = [row['songkick_id'] for row in event_rows]
+
+        try:
+            # Add location if needed and mark it as refreshed
+            location = Location.query.get(location_id)
+            if location is None:
+                location = Location(location_id=location_id, search_count=0)
+                db.session.add(location)
+            location.refreshed_at = datetime.now()
+            db.session.flush()
+
+            # Remove old events
+            EventArtist.query.filter(EventArtist.songkick_id.in_(old_ids)
+                                     ).delete(synchronize_session=False)
+            cls.query.filter(cls.location_id == location_id
+                             ).delete(synchronize_session=False)
+
+            if event_ids:
+                EventArtist.query.filter(EventArtist.songkick_id.in_(event_ids)
+                                         ).delete(synchronize_session=False)
+                cls.query.filter(cls.songkick_id.in_(event_ids)
+                                 ).delete(synchronize_session=False)
+
+            # Insert new events
+            if event_rows:
+                db.session.execute(cls.__table__.insert(), event_rows)
+            if artist_rows:
+                db.session.execute(EventArtist.__table__.insert(), artist_rows)
+
+            db.session.commit()
+            return True
+
+        # Rollback transaction and return False if not successful
+        except Exception as msg:      # pragma: no cover
+            db.session.rollback()
+            print(msg)
+            return False
+
+    @classmethod
+    def find_for_artists(cls, location_id, artist_keys, max_age):
+        """Return dictionary of normalized artist name to list of event JSON
+
+        Only includes the given artists. Returns None if the location's events
+        haven't been refreshed within max_age.
+        """
+
+        location = Location.query.get(location_id)
+
+        if location is None or not location.is_warm(max_age):
+            return None
+
+        artist_index = {}
+
+        if not artist_keys:
+            return artist_index
+
+        rows = (db.session.query(EventArtist.artist_key, cls.event_json)
+                          .join(cls, EventArtist.songkick_id == cls.songkick_id)
+                          .filter(cls.location_id == location_id,
+                                  EventArtist.artist_key.in_(set(artist_keys)))
+                          .order_by(cls.start_date, cls.songkick_id)
+                          .all())
+
+        for artist_key, event_json in rows:
+            artist_index.setdefault(artist_key, []).append(json.loads(event_json))
+
+        return artist_index
+
+    def __repr__(self):     # pragma: no cover
+        return ("<Event songkick_id={} location_id={}>"
+                .format(self.songkick_id, self.location_id))
+
+
+class EventArtist(db.Model):
+    """Association table between stored events and their artists' normalized names"""
+
+    __tablename__ = "events_artists"
+
+    # Text, since one artist name too long for the column would fail the whole replace
+    artist_key = db.Column(db.Text,
+                           primary_key=True)
+    songkick_id = db.Column(db.Integer,
+                            db.ForeignKey('events.songkick_id'),
+                            primary_key=True)
+
+    def __repr__(self):     # pragma: no cover
+        return ("<EventArtist artist_key={} songkick_id={}>"
+                .format(self.artist_key, self.songkick_id))
+
+
+class ArtistMapping(db.Model):
+    """Songkick artist ids resolved for Spotify artists
+
+    Artists not found on Songkick are saved with no Songkick id
+    """
+
+    __tablename__ = "artist_mappings"
+
+    spotify_id = db.Column(db.String(64),
+                           primary_key=True)
+    songkick_artist_id = db.Column(db.Integer)
+    resolved_at = db.Column(db.DateTime,
+                            nullable=False)
+
+    def __repr__(self):     # pragma: no cover
+        return ("<ArtistMapping spotify_id={} songkick_artist_id={}>"
+                .format(self.spotify_id, self.songkick_artist_id))
+
+
+class DatabaseArtistIdStore(object):
+    """Saves Songkick artist ids for Spotify artists using ArtistMapping
+
+    Used as songkick.ARTIST_ID_STORE. Uses its own database connections, so
+    it's safe to use from any thread.
+    """
+
+    def __init__(self, retry_not_found_after=timedelta(hours=6)):
+
+        # Time before searching again for artists that weren't on Songkick
+        self.retry_not_found_after = retry_not_found_after
+
+    def get(self, spotify_id):
+        """Return (found, songkick_artist_id) for a Spotify artist id"""
+
+        table = ArtistMapping.__table__
+        query = (db.select([table.c.songkick_artist_id, table.c.resolved_at])
+                   .where(table.c.spotify_id == spotify_id))
+
+        with db.engine.connect() as conn:
+            row = conn.execute(query).first()
+
+        if row is None:
+            return False, None
+
+        # Search again for artists that might have been added to Songkick
+        if (row.songkick_artist_id is None and
+                datetime.now() - row.resolved_at > self.retry_not_found_after):
+            return False, None
+
+        return True, row.songkick_artist_id
+
+    def set(self, spotify_id, songkick_artist_id):
+        """Save Songkick artist id (or None if not found) for a Spotify artist id"""
+
+        table = ArtistMapping.__table__
+        values = {'spotify_id': spotify_id,
+                  'songkick_artist_id': songkick_artist_id,
+                  'resolved_at': datetime.now()}
+
+        upsert = insert(table).values(values)
+        upsert = upsert.on_conflict_do_update(index_elements=[table.c.spotify_id],
+                                              set_={'songkick_artist_id': upsert.excluded.songkick_artist_id,
+                                                    'resolved_at': upsert.excluded.resolved_at})
+
+        with db.engine.begin() as conn:
+            conn.execute(upsert)
+
+
+class RelatedArtistsResponse(db.Model):
+    """Spotify related artists responses, shared between users and processes"""
+
+    __tablename__ = "related_artists"
+
+    spotify_id = db.Column(db.String(64),
+                           primary_key=True)
+    response_json = db.Column(db.Text,
+                              nullable=False)
+    fetched_at = db.Column(db.DateTime,
+                           nullable=False,
+                           index=True)
+
+    def __repr__(self):     # pragma: no cover
+        return ("<RelatedArtistsResponse spotify_id={} fetched_at={}>"
+                .format(self.spotify_id, self.fetched_at))
+
+
+class DatabaseRelatedArtistsStore(object):
+    """Saves Spotify related artists responses using RelatedArtistsResponse
+
+    Used as analyzation.RELATED_ARTISTS_STORE. Responses older than
+    expire_after are never returned. Uses its own database connections, so
+    it's safe to use from any thread.
+    """
+
+    def __init__(self, expire_after=timedelta(days=30)):
+
+        self.expire_after = expire_after
+
+    def get_many(self, spotify_ids):
+        """Return dictionary of spotify id to (response, fetched_at) for saved responses"""
+
+        if not spotify_ids:
+            return {}
+
+        table = RelatedArtistsResponse.__table__
+        query = (db.select([table.c.spotify_id, table.c.response_json, table.c.fetched_at])
+                   .where(db.and_(table.c.spotify_id.in_(list(spotify_ids)),
+                                  table.c.fetched_at > datetime.now() - self.expire_after)))
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+
+        return {row.spotify_id: (json.loads(row.response_json), row.fetched_at) for row in rows}
+
+    def most_recent(self, limit):
+        """Return dictionary of spotify id to (response, fetched_at) for the newest responses"""
+
+        table = RelatedArtistsResponse.__table__
+        query = (db.select([table.c.spotify_id, table.c.response_json, table.c.fetched_at])
+                   .where(table.c.fetched_at > datetime.now() - self.expire_after)
+                   .order_by(table.c.fetched_at.desc())
+                   .limit(limit))
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+
+        return {row.spotify_id: (json.loads(row.response_json), row.fetched_at) for row in rows}
+
+    def set(self, spotify_id, response):
+        """Save related artists response for a Spotify artist id"""
+
+        table = RelatedArtistsResponse.__table__
+        values = {'spotify_id': spotify_id,
+                  'response_json': json.dumps(response),
+                  'fetched_at': datetime.now()}
+
+        upsert = insert(table).values(values)
+        upsert = upsert.on_conflict_do_update(index_elements=[table.c.spotify_id],
+                                              set_={'response_json': upsert.excluded.response_json,
+                                                    'fetched_at': upsert.excluded.fetched_at})
+
+        with db.engine.begin() as conn:
+            conn.execute(upsert)
+
+
+class UpstreamCall(db.Model):
+    """Lock table for upstream API calls in flight, shared between processes
+
+    A row is added by the process making the call, and the JSON result is
+    stored in it for other processes waiting on the same call. Calls are
+    stored by a hash of their key, since keys can include long artist names.
+    """
+
+    __tablename__ = "upstream_calls"
+
+    call_key = db.Column(db.String(64),
+                         primary_key=True)
+    started_at = db.Column(db.DateTime,
+                           nullable=False)
+    finished_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)
+
+    def __repr__(self):     # pragma: no cover
+        return ("<UpstreamCall call_key={} finished_at={}>"
+                .format(self.call_key, self.finished_at))
+
+    @staticmethod
+    def hash_key(key):
+        """Return fixed-length call_key for a call key of any length"""
+
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class DatabaseSingleFlight(object):
+    """Coalesces identical upstream calls between processes using UpstreamCall
+
+    Has the same do() method as caching.SingleFlight. Uses its own database
+    connections, so it's safe to use from any thread. Results must be JSON
+    serializable.
+    """
+
+    def __init__(self, result_ttl=30, lock_timeout=30, poll_interval=0.05, purge_interval=60):
+
+        # Seconds to keep results for callers that arrive just after the call
+        self.result_ttl = result_ttl
+
+        # Seconds before an unfinished call is assumed to be abandoned
+        self.lock_timeout = lock_timeout
+
+        self.poll_interval = poll_interval
+
+        # Seconds between removals of every key's expired calls
+        self.purge_interval = purge_interval
+        self._purged_at = 0
+        self._purge_lock = threading.Lock()
+
+    def expired_calls(self, now):
+        """Return condition for finished calls past result_ttl and abandoned calls"""
+
+        table = UpstreamCall.__table__
+
+        return db.or_(table.c.finished_at < now - timedelta(seconds=self.result_ttl),
+                      db.and_(table.c.finished_at.is_(None),
+                              table.c.started_at < now - timedelta(seconds=self.lock_timeout)))
+
+    def purge_expired(self):
+        """Remove expired calls for every key, so the table doesn't keep growing
+
+        Returns number of calls removed
+        """
+
+        table = UpstreamCall.__table__
+
+        with db.engine.begin() as conn:
+            return conn.execute(table.delete().where(self.expired_calls(datetime.now()))).rowcount
+
+    def do(self, key, fn):
+        """Return result of fn(), sharing it with other processes calling for key"""
+
+        table = UpstreamCall.__table__
+        deadline = time.time() + self.lock_timeout
+        call_key = UpstreamCall.hash_key(key)
+
+        # Now and then remove other keys' expired calls too
+        with self._purge_lock:
+            purge = time.time() - self._purged_at >= self.purge_interval
+            if purge:
+                self._purged_at = time.time()
+
+        if purge:
+            self.purge_expired()
+
+        while time.time() < deadline:
+            now = datetime.now()
+
+            with db.engine.begin() as conn:
+
+                # Remove expired results and abandoned calls for key
+                conn.execute(table.delete().where(db.and_(table.c.call_key == call_key,
+                                                          self.expired_calls(now))))
+
+                # Claim the call unless another process already has
+                claimed = conn.execute(insert(table)
+                                       .values(call_key=call_key, started_at=now)
+                                       .on_conflict_do_nothing()).rowcount
+
+            if claimed:
+                return self._call(call_key, fn)
+
+            # Wait for the other process's result
+            result = self._wait_for_result(call_key, deadline)
+            if result is not None:
+                return json.loads(result)
+
+        # Make the call without coalescing if waiting takes too long
+        return fn()
+
+    def _call(self, call_key, fn):
+        """Make the call for a hashed call key and store its result"""
+
+        table = UpstreamCall.__table__
+
+        try:
+            result = fn()
+
+        # Release the claim so waiting processes can retry
+        except Exception:
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.call_key == call_key))
+            raise
+
+        with db.engine.begin() as conn:
+            conn.execute(table.update()
+                              .where(table.c.call_key == call_key)
+                              .values(finished_at=datetime.now(),
+                                      result=json.dumps(result)))
+
+        return result
+
+    def _wait_for_result(self, call_key, deadline):
+        """Return JSON result of another process's call for a hashed call key
+
+        Returns None if the call is released or the deadline passes first
+        """
+
+        table = UpstreamCall.__table__
+        query = db.select([table.c.finished_at, table.c.result]).where(table.c.call_key == call_key)
+
+        while time.time() < deadline:
+            with db.engine.connect() as conn:
+                row = conn.execute(query).first()
+
+            # Call was released without a result
+            if row is None:
+                return None
+
+            if row.finished_at is not None:
+                return row.result
+
+            time.sleep(self.poll_interval)
 
-User.past_concerts = db.relationship("Concert",
-                                     order_by="Concert.start_datetime.desc()",
-                                     secondary="users_concerts",
-                                     secondaryjoin=db.and_(UserConcert.songkick_id == Concert.songkick_id,
-                                                           Concert.start_datetime < datetime.now()))
+        return None
 
 
 ##############################################################################
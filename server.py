@@ -1,17 +1,27 @@
-from flask import Flask, render_template, flash, redirect, request, session, jsonify
+from flask import (Flask, render_template, flash, redirect, request, session, jsonify,
+                   Response, stream_with_context)
 
 from passlib.hash import pbkdf2_sha256 as sha
+from datetime import timedelta
+import click
 import json
 import os
 
-import spotipy
 from spotipy.oauth2 import SpotifyOauthError
 
-from model import User, Concert, db, connect_to_db
-from spotify_oauth_tools import get_spotify_oauth
+from model import (User, Concert, Location, Event, SpotifyUser, DatabaseSingleFlight,
+                   DatabaseArtistIdStore, DatabaseRelatedArtistsStore, db, connect_to_db)
+from spotify_oauth_tools import get_spotify_oauth, get_spotify_client, get_user_spotify_client
 
-from analyzation import get_top_artist_recs, get_artist_recs, find_spotify_artists
-from songkick import find_songkick_locations, find_songkick_concerts
+import analyzation
+import songkick
+from analyzation import (get_top_artists, get_recs_for_top_artists, get_artist_recs, find_spotify_artists,
+                         import_playlist_seeds, import_followed_seeds, get_recs_for_imported_seeds)
+from songkick import (find_songkick_locations, find_songkick_concerts, find_songkick_concerts_batch,
+                      iter_songkick_concerts_batch, normalize_artist_name, SongkickError,
+                      SONGKICK_EVENT_CACHE, SONGKICK_CALENDAR_CACHE)
+from workers import warm_popular_locations, run_warmer, collect_orphaned_concerts, run_collector
+from migrations import migrate
 
 
 app = Flask(__name__)
@@ -21,6 +31,39 @@ app.secret_key = os.getenv('FLASK_KEY')
 # Create Spotify OAuth object for use with spotipy
 SPOTIFY_OAUTH = get_spotify_oauth()
 
+# Max age of a location's stored events for them to be used instead of Songkick
+WARM_LOCATION_MAX_AGE = timedelta(seconds=int(os.getenv('WARM_LOCATION_MAX_AGE', 3 * 60 * 60)))
+
+# Max age of a Spotify user's saved top artists for them to be reused
+TOP_ARTISTS_MAX_AGE = timedelta(seconds=int(os.getenv('TOP_ARTISTS_MAX_AGE', 24 * 60 * 60)))
+
+# Number of saved concerts on each page of a profile
+PROFILE_PAGE_SIZE = int(os.getenv('PROFILE_PAGE_SIZE', 20))
+
+
+def configure_shared_state():
+    """Share upstream API data between processes through the database
+
+    Saves resolved Songkick artist ids and Spotify related artists, and loads
+    recently saved related artists into this process. Also starts this
+    process's Spotify token refresher. Set SINGLE_FLIGHT_BACKEND=database to
+    also share calls in flight between workers. The database must be
+    connected first.
+    """
+
+    songkick.ARTIST_ID_STORE = DatabaseArtistIdStore()
+
+    # Start refreshing the app's Spotify token before the first request needs it
+    get_spotify_client()
+
+    expire_after = timedelta(seconds=analyzation.RELATED_ARTISTS_EXPIRE_AFTER)
+    analyzation.RELATED_ARTISTS_STORE = DatabaseRelatedArtistsStore(expire_after)
+    print("Loaded {} related artists".format(analyzation.warm_related_artists_cache()))
+
+    if os.getenv('SINGLE_FLIGHT_BACKEND') == 'database':
+        songkick.SONGKICK_FLIGHT.shared = DatabaseSingleFlight()
+        analyzation.RELATED_ARTISTS_FLIGHT.shared = DatabaseSingleFlight()
+
 
 def save_location(form):
     """Save selected location data to session from form"""
@@ -34,6 +77,159 @@ def save_location(form):
         session['locID'] = locID
         session['locName'] = locName
 
+        # Count search so popular locations are kept warm
+        Location.record_search(locID, locName)
+
+
+def get_auth_artist_recs(auth_code=None):
+    """Return list of artist recommendations for a Spotify user
+
+    Uses the authorization code if given, otherwise the Spotify user saved in
+    the session. Raises SpotifyOauthError if the user can't be authorized
+    """
+
+    return get_spotify_user_recs(get_spotify_user(auth_code))
+
+
+def get_request_auth_code():
+    """Return Spotify authorization code sent with the request, or None
+
+    Pages shown without a new authorization send an empty code
+    (or 'None' from pages rendered by older versions)
+    """
+
+    auth_code = request.args.get('auth-code')
+
+    if auth_code in ('', 'None'):
+        return None
+
+    return auth_code
+
+
+def get_spotify_user(auth_code=None):
+    """Return SpotifyUser authorized by the code, or saved in the session if no code
+
+    Raises SpotifyOauthError if the user can't be authorized
+    """
+
+    if auth_code:
+        return authorize_spotify_user(auth_code)
+
+    spotify_user = get_session_spotify_user()
+
+    if spotify_user is None:
+        raise SpotifyOauthError('No Spotify authorization')
+
+    return spotify_user
+
+
+def authorize_spotify_user(auth_code):
+    """Save Spotify user's tokens using an authorization code and add them to the session
+
+    Raises SpotifyOauthError if the code cannot be exchanged for a token
+    """
+
+    # Exchange authorization code for access token
+    token_info = SPOTIFY_OAUTH.get_access_token(auth_code)
+
+    # Find out which Spotify user authorized the app
+    spotify = get_user_spotify_client(token_info['access_token'])
+    spotify_user_id = spotify.current_user()['id']
+
+    spotify_user = SpotifyUser.save_authorization(spotify_user_id, token_info, session.get('user_id'))
+    if spotify_user is None:      # pragma: no cover
+        raise SpotifyOauthError('Unable to save Spotify authorization')
+
+    session['spotify_user_id'] = spotify_user_id
+
+    return spotify_user
+
+
+def get_session_spotify_user():
+    """Return SpotifyUser saved in the session, or None"""
+
+    spotify_user_id = session.get('spotify_user_id')
+
+    if spotify_user_id is None:
+        return None
+
+    return SpotifyUser.query.get(spotify_user_id)
+
+
+def get_spotify_user_recs(spotify_user):
+    """Return list of artist recommendations for a SpotifyUser
+
+    Reuses the user's saved top artists until they're TOP_ARTISTS_MAX_AGE old
+    Raises SpotifyOauthError if the user's token can't be refreshed
+    """
+
+    top_artists_list = spotify_user.get_top_artists(TOP_ARTISTS_MAX_AGE)
+
+    # Get user's top artists from Spotify if needed
+    if top_artists_list is None:
+        top_artists_list = get_top_artists(get_spotify_user_client(spotify_user))
+        spotify_user.save_top_artists(top_artists_list)
+
+    # Get dictionary of concert recommendations
+    return get_recs_for_top_artists(top_artists_list)
+
+
+def get_spotify_user_client(spotify_user):
+    """Return Spotify API object authorized by a SpotifyUser, refreshing their token if needed
+
+    Raises SpotifyOauthError if the user's token can't be refreshed
+    """
+
+    if not spotify_user.token_is_valid():
+        token_info = None
+
+        if spotify_user.refresh_token:
+            token_info = SPOTIFY_OAUTH.refresh_access_token(spotify_user.refresh_token)
+
+        if token_info is None:
+            raise SpotifyOauthError('Unable to refresh Spotify authorization')
+
+        spotify_user.save_token(token_info)
+
+    return get_user_spotify_client(spotify_user.access_token)
+
+
+def get_playlist_seeds(playlist):
+    """Return list of seed artist dictionaries from a Spotify playlist
+
+    Uses the session's Spotify user's authorization if available, so their
+    private playlists can be read. Raises ValueError if the playlist isn't
+    a playlist link, URI or id.
+    """
+
+    spotify = get_spotify_client()
+    spotify_user = get_session_spotify_user()
+
+    if spotify_user is not None:
+        try:
+            spotify = get_spotify_user_client(spotify_user)
+        except SpotifyOauthError:      # pragma: no cover
+            pass
+
+    return import_playlist_seeds(spotify, playlist)
+
+
+def format_sse(event, data):
+    """Return a server-sent event message with JSON data"""
+
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+def get_warm_artist_index(locID, artist_recs):
+    """Return index of artist name to stored events if location is warm
+
+    Returns None if the location's events aren't stored or are out of date
+    """
+
+    artist_keys = [normalize_artist_name(artist_dict['artist']) for artist_dict in artist_recs]
+
+    return Event.find_for_artists(locID, artist_keys, WARM_LOCATION_MAX_AGE)
+
 
 def get_user_saved_concerts():
     """Return list of current user's saved concerts"""
@@ -43,8 +239,7 @@ def get_user_saved_concerts():
 
     # Create list of user's saved concert's songkick ids if logged in
     if current_user_id:
-        current_user = User.query.get(current_user_id)
-        user_saved_concerts = [concert.songkick_id for concert in current_user.concerts]
+        user_saved_concerts = User.saved_concert_ids(current_user_id)
 
     # Set to empty list if not logged in
     else:
@@ -114,8 +309,9 @@ def log_out():
         session.clear()
         flash('Logged out')
 
-    # Display message if no user logged in
+    # Display message if no user logged in, forgetting any Spotify user
     else:
+        session.pop('spotify_user_id', None)
         flash('No user currently logged in.')
 
     return redirect('/')
@@ -163,13 +359,21 @@ def register():
 
 @app.route('/my-profile')
 def return_user_profile():
-    """Displays the profile page for the logged in user"""
+    """Displays a page of the logged in user's upcoming concerts"""
 
     # Display user's profile page if logged in
     if session.get('user_id'):
         current_user = User.query.get(session['user_id'])
+
+        # Get one more concert than fits to know if there's another page
+        after = Concert.parse_page_cursor(request.args.get('after'))
+        concerts, has_past_concerts = current_user.load_profile_concerts(False, PROFILE_PAGE_SIZE + 1, after)
+
         return render_template('profile.html',
-                               current_user=current_user)
+                               current_user=current_user,
+                               concerts=concerts[:PROFILE_PAGE_SIZE],
+                               next_cursor=get_next_cursor(concerts),
+                               has_past_concerts=has_past_concerts)
 
     # Return redirect to login page if not logged in
     else:
@@ -179,13 +383,20 @@ def return_user_profile():
 
 @app.route('/my-profile/past')
 def return_user_past_concerts():
-    """Displays the logged in user's past concerts"""
+    """Displays a page of the logged in user's past concerts"""
 
     # Display user's profile page if logged in
     if session.get('user_id'):
         current_user = User.query.get(session['user_id'])
+
+        before = Concert.parse_page_cursor(request.args.get('before'))
+        concerts, has_future_concerts = current_user.load_profile_concerts(True, PROFILE_PAGE_SIZE + 1, before)
+
         return render_template('past.html',
-                               current_user=current_user)
+                               current_user=current_user,
+                               concerts=concerts[:PROFILE_PAGE_SIZE],
+                               next_cursor=get_next_cursor(concerts),
+                               has_future_concerts=has_future_concerts)
 
     # Return redirect to login page if not logged in
     else:
@@ -193,28 +404,53 @@ def return_user_past_concerts():
         return redirect('/login')
 
 
+def get_next_cursor(concerts):
+    """Return cursor for the next page of a profile, or None if it's the last page
+
+    concerts is the page with one extra concert, if there are more
+    """
+
+    if len(concerts) > PROFILE_PAGE_SIZE:
+        return concerts[PROFILE_PAGE_SIZE - 1].page_cursor
+
+    return None
+
+
 @app.route('/add-concert.json', methods=["POST"])
 def add_saved_concert():
     """Adds concert to user's saved list"""
 
-    # Get concert data
-    songkick_id = request.form.get('songkick-id')
+    # Get current user's id
+    user_id = session.get('user_id')
 
-    # If songkick id not already in database, insert information from post request form
-    if not Concert.query.get(songkick_id):
-        create_success = Concert.create_from_form(request.form)
-    else:
-        create_success = True
+    if not user_id:
+        return jsonify(False)
+
+    # Add concert if it's new and association between concert and current user
+    success = User.save_concerts(user_id, [Concert.row_from_form(request.form)])
+
+    # Return T/F if successful or unsuccessful
+    return jsonify(success)
+
+
+@app.route('/add-concerts.json', methods=["POST"])
+def add_saved_concerts():
+    """Adds list of concerts to user's saved list in one transaction
 
-    # Get current user data
+    Takes a JSON list of concert forms, each like the /add-concert.json form
+    """
+
+    # Get current user's id
     user_id = session.get('user_id')
-    current_user = User.query.get(user_id)
 
-    # Add association between concert and current user
-    add_success = current_user.add_concert(songkick_id)
+    if not user_id:
+        return jsonify(False)
+
+    concert_forms = json.loads(request.form.get('concerts', '[]'))
+    success = User.save_concerts(user_id, [Concert.row_from_form(form) for form in concert_forms])
 
     # Return T/F if successful or unsuccessful
-    return jsonify(add_success and create_success)
+    return jsonify(success)
 
 
 @app.route('/remove-concert.json', methods=["POST"])
@@ -281,6 +517,11 @@ def request_authorization():
     # Save selected location data
     save_location(request.args)
 
+    # Skip authorization if the user's top artists or tokens are saved
+    spotify_user = get_session_spotify_user()
+    if spotify_user and (spotify_user.refresh_token or spotify_user.get_top_artists(TOP_ARTISTS_MAX_AGE)):
+        return jsonify('/callback')
+
     # Get url for Spotify authorization
     auth_url = SPOTIFY_OAUTH.get_authorize_url()
 
@@ -294,11 +535,15 @@ def return_results_page():
     # Get authorization code from Spotify
     auth_code = request.args.get('code')
 
+    # Use Spotify user saved in session if there's no new authorization
+    spotify_session = not auth_code and 'spotify_user_id' in session
+
     # Get list of user's saved concerts
     user_saved_concerts = get_user_saved_concerts()
 
     return render_template('results.html',
                            auth_code=auth_code,
+                           spotify_session=spotify_session,
                            user_saved_concerts=user_saved_concerts)
 
 
@@ -311,24 +556,17 @@ def return_recommendations():
     Otherwise, returns (JSONified) dictionary of artist recommendations
     """
 
-    # Get auth code from callback
-    auth_code = request.args.get('auth-code')
+    # Get auth code from callback (or use Spotify user saved in session)
+    auth_code = get_request_auth_code()
 
-    # Exchange authorization code for access token
+    # Get dictionary of concert recommendations
     try:
-        token_info = SPOTIFY_OAUTH.get_access_token(auth_code)
-        access_token = token_info.get('access_token')
+        artist_recs = get_auth_artist_recs(auth_code)
 
     # Return error message if getting access token fails
     except SpotifyOauthError as error:
         return jsonify('Unable to authorize: ' + str(error))
 
-    # Create Spotify API object using access_token
-    spotify = spotipy.Spotify(auth=access_token)
-
-    # Get dictionary of concert recommendations
-    artist_recs = get_top_artist_recs(spotify)
-
     return jsonify(artist_recs)
 
 
@@ -339,20 +577,33 @@ def return_no_auth_results():
     # Save selected location data
     save_location(request.form)
 
-    # Get list of artist data objects from form data
+    # Get list of artist data objects (or a playlist to import them from) from form data
     selected_artists = request.form.get('artists')
+    playlist = request.form.get('playlist')
 
     # Get list of user's saved concerts
     user_saved_concerts = get_user_saved_concerts()
 
     return render_template('results.html',
                            user_saved_concerts=user_saved_concerts,
-                           selected_artists=selected_artists)
+                           selected_artists=selected_artists,
+                           playlist=playlist)
 
 
 @app.route('/recs-from-search.json')
 def return_recs_from_search():
-    """Returns JSON dictionary of recommended artists using chosen artists"""
+    """Returns JSON dictionary of recommended artists using chosen artists or a playlist"""
+
+    playlist = request.args.get('playlist')
+
+    # Get recommendations using artists in playlist
+    if playlist:
+        try:
+            artist_recs = get_recs_for_imported_seeds(get_playlist_seeds(playlist))
+        except ValueError as error:
+            return jsonify('Unable to import: ' + str(error))
+
+        return jsonify(artist_recs)
 
     # Get selected artists from form data
     selected_artists = json.loads(request.args.get('artists'))
@@ -362,6 +613,31 @@ def return_recs_from_search():
     return jsonify(artist_recs)
 
 
+@app.route('/import-seeds.json')
+def return_imported_seeds():
+    """Returns JSON list of artists from a Spotify playlist or the Spotify user's followed artists
+
+    Followed artists need a Spotify user saved in the session
+    Returns error message if unsuccessful
+    """
+
+    playlist = request.args.get('playlist')
+
+    try:
+        if playlist:
+            seeds = get_playlist_seeds(playlist)
+        else:
+            seeds = import_followed_seeds(get_spotify_user_client(get_spotify_user()))
+
+    # Return error message if seeds can't be imported
+    except SpotifyOauthError as error:
+        return jsonify('Unable to authorize: ' + str(error))
+    except ValueError as error:
+        return jsonify('Unable to import: ' + str(error))
+
+    return jsonify(seeds)
+
+
 @app.route('/concerts.json')
 def return_concerts():
     """Returns JSON list of concerts for an artist and location"""
@@ -380,11 +656,144 @@ def return_concerts():
     # Get concert recommendations using saved location (SF Bay as default)
     locID = session.get('locID', 'sk:26330')
 
-    concert_recs = find_songkick_concerts(search_dict, locID)
+    # Use stored events if location is warm, otherwise search Songkick
+    artist_index = get_warm_artist_index(locID, [search_dict])
+
+    # Show no concerts for the artist if Songkick can't be searched
+    try:
+        concert_recs = find_songkick_concerts(search_dict, locID, artist_index=artist_index)
+    except SongkickError as msg:
+        print(msg)
+        concert_recs = []
+
+    return jsonify(concert_recs)
+
+
+@app.route('/concerts-batch.json', methods=["POST"])
+def return_concerts_batch():
+    """Returns JSON dictionary of concerts for a list of artists and location
+
+    The dictionary has the merged list of concerts and a list of the artists
+    whose Songkick search failed
+    """
+
+    # Get list of recommended artists from request
+    artist_recs = json.loads(request.form.get('artists', '[]'))
+
+    # Use location from request, else saved location (SF Bay as default)
+    locID = request.form.get('locID') or session.get('locID', 'sk:26330')
+
+    # Use stored events if location is warm, otherwise search Songkick
+    artist_index = get_warm_artist_index(locID, artist_recs)
+
+    concert_recs = find_songkick_concerts_batch(artist_recs, locID, artist_index)
 
     return jsonify(concert_recs)
 
 
+@app.route('/search-stream')
+def stream_search_results():
+    """Streams artist recommendations and their concerts as server-sent events
+
+    Sends an 'artists' event with the recommended artists, a 'concerts' event
+    for each artist as their Songkick search finishes (or 'artist-failed'),
+    and a final 'done' event with counts. Sends a 'search-error' event instead
+    if the recommendations can't be found.
+    """
+
+    # Get auth code, selected artists or playlist from request
+    auth_code = get_request_auth_code()
+    selected_artists = request.args.get('artists')
+    playlist = request.args.get('playlist')
+
+    # Get concert recommendations using saved location (SF Bay as default)
+    locID = session.get('locID', 'sk:26330')
+
+    # Authorize Spotify user before streaming, so the session can be updated
+    spotify_user = None
+    auth_error = None
+
+    if auth_code or (selected_artists is None and playlist is None):
+        try:
+            spotify_user = get_spotify_user(auth_code)
+        except SpotifyOauthError as error:
+            auth_error = 'Unable to authorize: ' + str(error)
+        except Exception as error:
+            auth_error = 'Artist search failed: ' + str(error)
+
+    def generate_events():
+
+        # Send error message and stop if Spotify user can't be authorized
+        if auth_error is not None:
+            yield format_sse('search-error', auth_error)
+            return
+
+        # Get artist recommendations from Spotify
+        try:
+            if spotify_user is not None:
+                artist_recs = get_spotify_user_recs(spotify_user)
+            elif playlist:
+                artist_recs = get_recs_for_imported_seeds(get_playlist_seeds(playlist))
+            else:
+                artist_recs = get_artist_recs(json.loads(selected_artists))
+
+        # Send error message and stop if recommendations can't be found
+        except SpotifyOauthError as error:
+            yield format_sse('search-error', 'Unable to authorize: ' + str(error))
+            return
+        except Exception as error:
+            yield format_sse('search-error', 'Artist search failed: ' + str(error))
+            return
+
+        yield format_sse('artists', artist_recs)
+
+        # Use stored events if location is warm, otherwise search Songkick
+        artist_index = get_warm_artist_index(locID, artist_recs)
+
+        concert_count = 0
+        failed_count = 0
+
+        # Send each artist's concerts as soon as they are found
+        for search_dict, concerts, error in iter_songkick_concerts_batch(artist_recs, locID,
+                                                                         artist_index):
+            if error is None:
+                concert_count += len(concerts)
+                yield format_sse('concerts', {'artist': search_dict.get('artist'),
+                                              'concerts': concerts})
+            else:
+                failed_count += 1
+                yield format_sse('artist-failed', {'artist': search_dict.get('artist'),
+                                                   'error': error})
+
+        yield format_sse('done', {'artists': len(artist_recs),
+                                  'concerts': concert_count,
+                                  'failed': failed_count})
+
+    # Disable caching and proxy buffering so events arrive as they're sent
+    headers = {'Cache-Control': 'no-cache',
+               'X-Accel-Buffering': 'no'}
+
+    return Response(stream_with_context(generate_events()),
+                    mimetype='text/event-stream',
+                    headers=headers)
+
+
+@app.route('/stats.json')
+def return_stats():
+    """Returns JSON dictionary of cache and timing statistics for tuning"""
+
+    stats = {'artist_search': analyzation.ARTIST_SEARCH_CACHE.stats(),
+             'songkick_events': SONGKICK_EVENT_CACHE.stats(),
+             'songkick_calendars': SONGKICK_CALENDAR_CACHE.stats(),
+             'songkick_flights': songkick.SONGKICK_FLIGHT.stats(),
+             'related_artists': analyzation.RELATED_ARTISTS_CACHE.stats(),
+             'related_artists_flights': analyzation.RELATED_ARTISTS_FLIGHT.stats(),
+             'related_artists_timing': analyzation.RELATED_ARTISTS_TIMER.stats(),
+             'artist_graph': analyzation.ARTIST_GRAPH.stats()}
+
+    return jsonify(stats)
+
+
 @app.route('/errrr')
 def return_error():
     """Raise an error
@@ -395,6 +804,39 @@ def return_error():
     raise Exception("Oh no! A mysterious error!")
 
 
+@app.cli.command('warm-locations')
+@click.option('--forever', is_flag=True, help='Keep refreshing every WARMER_INTERVAL seconds.')
+def warm_locations_command(forever):
+    """Refresh stored events for the most searched locations"""
+
+    if forever:      # pragma: no cover
+        run_warmer()
+
+    refreshed = warm_popular_locations()
+    print("Warmed {} locations: {}".format(len(refreshed), ', '.join(refreshed)))
+
+
+@app.cli.command('collect-concerts')
+@click.option('--forever', is_flag=True, help='Keep collecting every COLLECTOR_INTERVAL seconds.')
+def collect_concerts_command(forever):
+    """Delete future and archive past concerts that no user has saved"""
+
+    if forever:      # pragma: no cover
+        run_collector()
+
+    deleted, archived = collect_orphaned_concerts()
+    print("Deleted {} and archived {} concerts".format(deleted, archived))
+
+
+@app.cli.command('migrate-db')
+@click.option('--blocking', is_flag=True, help='Build indexes faster, blocking writes meanwhile.')
+def migrate_db_command(blocking):
+    """Create new tables and add missing indexes to existing ones"""
+
+    migrate(concurrently=not blocking)
+    print("Migrated DB.")
+
+
 def print_referrer():
     """Print/log info about how each route is accessed"""
 
@@ -410,5 +852,6 @@ if __name__ == '__main__':  # pragma: no cover
     app.before_request(print_referrer)
 
     connect_to_db(app)
+    configure_shared_state()
 
     app.run(threaded=True)
@@ -1,11 +1,117 @@
 """Functions for interacting with the Songkick API"""
 
 import os
+import re
 import requests
 import arrow
+from datetime import datetime
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from caching import TTLCache, SingleFlight
+from http_sessions import ThreadSessions
 
 SONGKICK_API_URL = "http://api.songkick.com/api/3.0"
 
+# Max number of concurrent Songkick requests for a batch of artists
+SONGKICK_MAX_WORKERS = int(os.getenv('SONGKICK_MAX_WORKERS', 8))
+
+# Find concerts using each metro area's whole calendar instead of per-artist searches
+SONGKICK_CALENDAR_MODE = os.getenv('SONGKICK_CALENDAR_MODE', '').lower() in ('1', 'true', 'on')
+
+# Songkick's date (2017-08-11) and datetime (2010-02-16T19:30:00+0000) formats
+SONGKICK_DATE_RE = re.compile(r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})"
+                              r"(?P<time>T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})"
+                              r"(?:(?P<offset_hours>[+-]\d{2}):?(?P<offset_minutes>\d{2}))?)?$")
+
+# Find concerts using artists' calendars by Songkick artist id instead of name searches
+SONGKICK_ARTIST_ID_LOOKUP = os.getenv('SONGKICK_ARTIST_ID_LOOKUP', 'on').lower() in ('1', 'true', 'on')
+
+# Number of events to request in each page of Songkick results
+SONGKICK_PAGE_SIZE = 50
+
+# Max number of events to read for an artist in a location
+SONGKICK_MAX_EVENTS = int(os.getenv('SONGKICK_MAX_EVENTS', 500))
+
+# Max number of calendar pages (of 50 events) to read for a metro area. Metro
+# areas with more events than this aren't indexed, and use per-artist searches.
+SONGKICK_CALENDAR_MAX_PAGES = int(os.getenv('SONGKICK_CALENDAR_MAX_PAGES', 200))
+
+
+class SongkickError(Exception):
+    """Raised when Songkick can't be searched, as opposed to finding no concerts"""
+
+
+class SongkickClient(object):
+    """Thread-safe client for the Songkick API
+
+    Requests share one pool of keep-alive connections, are retried with
+    exponential backoff on connection errors, 429 and 5xx responses, and time
+    out instead of blocking forever on a slow response.
+    """
+
+    def __init__(self, api_url=SONGKICK_API_URL, pool_size=None, retries=None,
+                 backoff_factor=None, connect_timeout=None, read_timeout=None):
+
+        # Use settings from environment unless provided
+        if pool_size is None:
+            pool_size = int(os.getenv('SONGKICK_POOL_SIZE', SONGKICK_MAX_WORKERS * 2))
+        if retries is None:
+            retries = int(os.getenv('SONGKICK_RETRIES', 3))
+        if backoff_factor is None:
+            backoff_factor = float(os.getenv('SONGKICK_BACKOFF', 0.3))
+        if connect_timeout is None:
+            connect_timeout = float(os.getenv('SONGKICK_CONNECT_TIMEOUT', 3.05))
+        if read_timeout is None:
+            read_timeout = float(os.getenv('SONGKICK_READ_TIMEOUT', 10))
+
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Each thread's session uses the connection pool shared by every thread
+        self.sessions = ThreadSessions(pool_size, retries, backoff_factor)
+
+    def get(self, path, payload=None):
+        """Make GET request to a Songkick API path and return the response"""
+
+        # Add API key to request parameters
+        params = dict(payload or {})
+        params['apikey'] = os.getenv('SONGKICK_KEY')
+
+        return self.sessions.get().get(self.api_url + path,
+                                       params=params,
+                                       timeout=self.timeout)
+
+
+# Shared Songkick client for all requests in this process
+SONGKICK_CLIENT = SongkickClient()
+
+# Cache of event lists by (normalized artist name, Songkick location id)
+SONGKICK_EVENT_CACHE = TTLCache(ttl=int(os.getenv('SONGKICK_CACHE_TTL', 60 * 60)),
+                                stale_ttl=int(os.getenv('SONGKICK_CACHE_STALE_TTL', 6 * 60 * 60)),
+                                max_entries=int(os.getenv('SONGKICK_CACHE_MAX_ENTRIES', 5000)),
+                                max_bytes=int(os.getenv('SONGKICK_CACHE_MAX_BYTES', 50 * 1024 * 1024)))
+
+# Cache of metro area calendar indexes by Songkick location id
+SONGKICK_CALENDAR_CACHE = TTLCache(ttl=int(os.getenv('SONGKICK_CALENDAR_TTL', 60 * 60)),
+                                   stale_ttl=int(os.getenv('SONGKICK_CALENDAR_STALE_TTL', 6 * 60 * 60)),
+                                   max_entries=int(os.getenv('SONGKICK_CALENDAR_MAX_ENTRIES', 20)),
+                                   max_bytes=int(os.getenv('SONGKICK_CALENDAR_MAX_BYTES', 200 * 1024 * 1024)))
+
+# Cache of Songkick artist ids by Spotify artist id
+SONGKICK_ARTIST_ID_CACHE = TTLCache(ttl=int(os.getenv('SONGKICK_ARTIST_ID_TTL', 24 * 60 * 60)),
+                                    max_entries=int(os.getenv('SONGKICK_ARTIST_ID_MAX_ENTRIES', 50000)))
+
+# Persistent store of Songkick artist ids by Spotify artist id, with methods
+# get(spotify_id) -> (found, songkick_artist_id) and set(spotify_id, songkick_artist_id)
+ARTIST_ID_STORE = None
+
+# Coalesces identical event searches in flight (can be shared between processes)
+SONGKICK_FLIGHT = SingleFlight()
+
+# Coalesces reads of the same metro area calendar in this process
+SONGKICK_CALENDAR_FLIGHT = SingleFlight()
+
 
 def find_songkick_locations(search_term):
     """Return list of Songkick metro areas matching search term
@@ -16,10 +122,8 @@ def find_songkick_locations(search_term):
     # Make GET request to Songkick API for location
     payload = {
         'query': search_term,
-        'apikey': os.getenv('SONGKICK_KEY'),
     }
-    loc_response = requests.get(SONGKICK_API_URL + "/search/locations.json",
-                                payload)
+    loc_response = SONGKICK_CLIENT.get("/search/locations.json", payload)
 
     # Create empty list of metro areas
     metros = []
@@ -66,38 +170,487 @@ def create_location_list(location_json):
     return metro_list
 
 
-def find_songkick_concerts(search_dict, location="sk:26330"):
-    """Takes Spotify artist info and returns a list of concert dictionaries
+def normalize_artist_name(artist_name):
+    """Return artist name in a standard form for use as a lookup key"""
 
-    Makes requests to the Songkick API for upcoming events in Songkick location
-    for the provided artist name
+    return ' '.join(artist_name.casefold().split())
+
+
+def iter_songkick_results(path, payload, max_date=None, max_pages=None):
+    """Yields Songkick event JSON from every page of results for an API path
+
+    Reads pages of results from Songkick only as the events are used, so
+    callers can stop early. If max_date (a date or YYYY-MM-DD string) is
+    given, stops after the last event on or before that date. Raises
+    requests.HTTPError if a request is unsuccessful, and SongkickError if
+    there are more than max_pages pages of results.
     """
 
-    songkick_key = os.getenv('SONGKICK_KEY')
+    payload = dict(payload, per_page=SONGKICK_PAGE_SIZE)
 
-    # Create empty recommendation list
-    concert_recs_list = []
+    if max_date is not None:
+        max_date = str(max_date)
+        payload['max_date'] = max_date
+
+    page = 1
+    events_read = 0
+
+    while True:
+
+        # Make GET request to songkick API for this page of results
+        payload['page'] = page
+        event_response = SONGKICK_CLIENT.get(path, payload)
+        event_response.raise_for_status()
+
+        results_page = event_response.json()['resultsPage']
+        page_events = results_page['results'].get('event') or []
+
+        for event in page_events:
+
+            # Stop once events are past the last date wanted (events are in date order)
+            event_date = (event.get('start') or {}).get('date')
+            if max_date is not None and event_date and event_date > max_date:
+                return
+
+            yield event
+
+        # Stop once the last page has been read
+        events_read += len(page_events)
+        if not page_events or events_read >= results_page.get('totalEntries', 0):
+            return
+
+        if max_pages is not None and page >= max_pages:
+            raise SongkickError("More than {} pages of results for {}".format(max_pages, path))
+
+        page += 1
+
+
+def iter_songkick_events(artist_name, location="sk:26330", max_date=None):
+    """Yields Songkick event JSON for an artist's upcoming events in a location
+
+    Searches for events by artist name, reading pages of results only as
+    needed (see iter_songkick_results)
+    """
 
-    # Make GET request to songkick API for this location & artist
     payload = {
-        'apikey': songkick_key,
-        'artist_name': search_dict['artist'],
+        'artist_name': artist_name,
         'location': location,
     }
-    event_response = requests.get(SONGKICK_API_URL + "/events.json", payload)
 
-    # If request is successful
-    if event_response.ok:
+    return iter_songkick_results("/events.json", payload, max_date)
+
+
+def iter_artist_calendar(songkick_artist_id, max_date=None):
+    """Yields Songkick event JSON for all of a Songkick artist's upcoming events
+
+    Reads pages of the artist's calendar only as needed (see
+    iter_songkick_results)
+    """
+
+    path = "/artists/{}/calendar.json".format(songkick_artist_id)
+
+    return iter_songkick_results(path, {}, max_date)
+
+
+def iter_songkick_concerts(search_dict, location="sk:26330", limit=None, max_date=None):
+    """Takes Spotify artist info and yields concert dictionaries one at a time
+
+    Reads pages of events from Songkick only as needed, stopping after limit
+    concerts or the last concert on or before max_date
+    """
+
+    date_memo = {}
+
+    events = iter_songkick_events(search_dict['artist'], location, max_date)
+
+    for event in islice(events, limit):
+        yield create_concert(event, search_dict, date_memo)
+
+
+def fetch_songkick_events(artist_name, location="sk:26330"):
+    """Return list of Songkick event JSON for an artist in a Songkick location
+
+    Reads up to SONGKICK_MAX_EVENTS events. Returns None if a request is
+    unsuccessful.
+    """
+
+    try:
+        return list(islice(iter_songkick_events(artist_name, location), SONGKICK_MAX_EVENTS))
+
+    # If request unsuccessful (including timeouts), print(error)
+    except requests.RequestException as msg:
+        print("Failed: {} ({})".format(artist_name, msg))
+        return None
+
+
+def get_metro_area_id(location):
+    """Return Songkick metro area id from a Songkick location id like 'sk:26330'"""
+
+    return location.split(':')[-1]
+
+
+def find_songkick_artist_id(artist_name):
+    """Return Songkick artist id for an artist name, or None if not found
+
+    Only returns an artist whose name matches (after normalizing). Raises
+    requests.HTTPError if the request is unsuccessful.
+    """
+
+    artist_response = SONGKICK_CLIENT.get("/search/artists.json", {'query': artist_name})
+    artist_response.raise_for_status()
+
+    artists = artist_response.json()['resultsPage']['results'].get('artist') or []
+    artist_key = normalize_artist_name(artist_name)
+
+    for artist in artists:
+        if normalize_artist_name(artist['displayName']) == artist_key:
+            return artist['id']
+
+    return None
+
+
+def resolve_songkick_artist_id(spotify_id, artist_name):
+    """Return Songkick artist id for a Spotify artist, or None if not found
+
+    Uses ids already resolved (in this process or in ARTIST_ID_STORE if set)
+    before searching Songkick by name. Ids that aren't found are only
+    remembered by ARTIST_ID_STORE, which searches again sooner. Raises
+    requests.HTTPError if the search is unsuccessful.
+    """
+
+    def resolve():
+        # Use mapping saved by any process if available
+        if ARTIST_ID_STORE is not None:
+            found, songkick_artist_id = ARTIST_ID_STORE.get(spotify_id)
+            if found:
+                return {'songkick_artist_id': songkick_artist_id} if songkick_artist_id else None
+
+        songkick_artist_id = find_songkick_artist_id(artist_name)
+
+        if ARTIST_ID_STORE is not None:
+            ARTIST_ID_STORE.set(spotify_id, songkick_artist_id)
+
+        # Don't cache artists that weren't found in this process
+        return {'songkick_artist_id': songkick_artist_id} if songkick_artist_id else None
+
+    def fetch():
+        return SONGKICK_FLIGHT.do('songkick:artist-id:{}'.format(spotify_id), resolve)
+
+    resolved = SONGKICK_ARTIST_ID_CACHE.get_or_fetch(spotify_id, fetch)
+
+    return resolved['songkick_artist_id'] if resolved else None
+
+
+def fetch_artist_calendar(songkick_artist_id):
+    """Return list of Songkick event JSON for a Songkick artist's upcoming events
+
+    Reads up to SONGKICK_MAX_EVENTS events. Returns None if a request is
+    unsuccessful.
+    """
+
+    try:
+        return list(islice(iter_artist_calendar(songkick_artist_id), SONGKICK_MAX_EVENTS))
+
+    # If request unsuccessful (including timeouts), print(error)
+    except requests.RequestException as msg:      # pragma: no cover
+        print("Failed: calendar for artist {} ({})".format(songkick_artist_id, msg))
+        return None
+
+
+def filter_events_by_metro_area(events, location="sk:26330"):
+    """Return list of the events in a Songkick location's metro area"""
+
+    metro_area_id = get_metro_area_id(location)
+
+    return [event for event in events
+            if str((event['venue'].get('metroArea') or {}).get('id')) == metro_area_id]
+
+
+def find_artist_events_by_id(spotify_id, artist_name, location="sk:26330"):
+    """Return list of Songkick event JSON for an artist in a Songkick location
+
+    Looks up the artist's calendar by Songkick artist id and filters it to the
+    location. Returns None if the artist id or calendar can't be found, so
+    the artist can be searched for by name instead.
+    """
+
+    try:
+        songkick_artist_id = resolve_songkick_artist_id(spotify_id, artist_name)
+
+    # If request unsuccessful (including timeouts), print(error), and search by name instead
+    except requests.RequestException as msg:
+        print("Failed: artist id for {} ({})".format(artist_name, msg))
+        return None
+
+    # Artist's name doesn't match a Songkick artist exactly
+    if songkick_artist_id is None:
+        return None
 
-        # Add the concerts to our list
-        concert_recs_list = create_concert_list(event_response.json(), search_dict)
+    # Get artist's calendar from cache, or from Songkick if not cached
+    cache_key = ('songkick-artist', songkick_artist_id)
 
-    # If request unsuccessful, print(error)
-    else:      # pragma: no cover
-        artist = search_dict['artist']
-        print("Failed: {}".format(artist))
+    def fetch():
+        flight_key = 'songkick:artist-calendar:{}'.format(songkick_artist_id)
+        return SONGKICK_FLIGHT.do(flight_key, lambda: fetch_artist_calendar(songkick_artist_id))
 
-    return concert_recs_list
+    events = SONGKICK_EVENT_CACHE.get_or_fetch(cache_key, fetch)
+
+    if events is None:      # pragma: no cover
+        return None
+
+    return filter_events_by_metro_area(events, location)
+
+
+def fetch_metro_calendar(location="sk:26330", max_pages=None):
+    """Return list of Songkick event JSON for all upcoming events in a metro area
+
+    Reads pages of the metro area's calendar (see iter_songkick_results)
+    until all events are read. Returns None if a request is unsuccessful, or
+    if the calendar has more than max_pages pages, since a partial calendar
+    would hide later concerts.
+    """
+
+    if max_pages is None:
+        max_pages = SONGKICK_CALENDAR_MAX_PAGES
+
+    path = "/metro_areas/{}/calendar.json".format(get_metro_area_id(location))
+
+    try:
+        return list(iter_songkick_results(path, {}, max_pages=max_pages))
+
+    # If request unsuccessful (including timeouts) or calendar too large, print(error)
+    except (requests.RequestException, SongkickError) as msg:
+        print("Failed: calendar for {} ({})".format(location, msg))
+        return None
+
+
+def index_events_by_artist(events):
+    """Return dictionary of normalized artist name to list of their events"""
+
+    artist_index = {}
+
+    for event in events:
+
+        # Add event to the list for each artist performing (once per artist)
+        artist_keys = {normalize_artist_name(performance['artist']['displayName'])
+                       for performance in event.get('performance', [])}
+
+        for artist_key in artist_keys:
+            artist_index.setdefault(artist_key, []).append(event)
+
+    return artist_index
+
+
+def build_metro_calendar_index(location="sk:26330"):
+    """Return index of artist name to events from a metro area's calendar
+
+    Returns None if the calendar can't be read
+    """
+
+    events = fetch_metro_calendar(location)
+
+    if events is None:      # pragma: no cover
+        return None
+
+    return index_events_by_artist(events)
+
+
+def get_metro_calendar_index(location="sk:26330"):
+    """Return cached artist index for a metro area's calendar
+
+    Only one thread reads a missing calendar from Songkick; others wait for it
+    """
+
+    def fetch():
+        return SONGKICK_CALENDAR_FLIGHT.do(location, lambda: build_metro_calendar_index(location))
+
+    return SONGKICK_CALENDAR_CACHE.get_or_fetch(location, fetch)
+
+
+def find_songkick_concerts(search_dict, location="sk:26330", use_calendar=None, artist_index=None):
+    """Takes Spotify artist info and returns a list of concert dictionaries
+
+    Makes requests to the Songkick API for upcoming events in Songkick location
+    for the provided artist, unless the events are already cached. Raises
+    SongkickError if Songkick can't be searched. Uses the
+    artist's calendar by Songkick artist id if it can be resolved, otherwise
+    searches by artist name. In calendar mode, looks up the artist in the
+    metro area's calendar instead.
+    If an index of artist name to all their events in the location is given,
+    looks up the artist there without making any requests.
+    """
+
+    artist = search_dict['artist']
+
+    # Look up artist in provided index of the location's events
+    if artist_index is not None:
+        events = artist_index.get(normalize_artist_name(artist), [])
+        return create_concerts(events, search_dict)
+
+    if use_calendar is None:
+        use_calendar = SONGKICK_CALENDAR_MODE
+
+    # Look up artist in the metro area's calendar if available
+    if use_calendar:
+        calendar_index = get_metro_calendar_index(location)
+
+        if calendar_index is not None:
+            events = calendar_index.get(normalize_artist_name(artist), [])
+            return create_concerts(events, search_dict)
+
+    # Look up artist's calendar by Songkick artist id if possible, else search by name
+    if SONGKICK_ARTIST_ID_LOOKUP and search_dict.get('spotify_id'):
+        events = find_artist_events_by_id(search_dict['spotify_id'], artist, location)
+
+        if events is not None:
+            return create_concerts(events, search_dict)
+
+    # Get events from cache, or from Songkick if not cached (sharing identical searches in flight)
+    cache_key = (normalize_artist_name(artist), location)
+
+    def fetch():
+        flight_key = 'songkick:events:{}:{}'.format(*cache_key)
+        return SONGKICK_FLIGHT.do(flight_key, lambda: fetch_songkick_events(artist, location))
+
+    events = SONGKICK_EVENT_CACHE.get_or_fetch(cache_key, fetch)
+
+    # Report failed search, rather than the artist having no concerts
+    if events is None:
+        raise SongkickError("Songkick search failed for {}".format(artist))
+
+    return create_concerts(events, search_dict)
+
+
+def find_songkick_concerts_batch(artist_recs, location="sk:26330", artist_index=None):
+    """Takes a list of Spotify artist info and returns merged concert results
+
+    Searches Songkick for each artist concurrently on a bounded pool of
+    workers (or in artist_index, see find_songkick_concerts). Returns a
+    dictionary with the merged list of concert dictionaries and a list of the
+    artists whose search failed.
+    """
+
+    concert_recs_list = []
+    failed_artists = []
+
+    # Nothing to search for
+    if not artist_recs:
+        return {'concerts': concert_recs_list, 'failed': failed_artists}
+
+    workers = min(SONGKICK_MAX_WORKERS, len(artist_recs))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        # Start a Songkick search for each artist
+        futures = [executor.submit(find_songkick_concerts, search_dict, location,
+                                   artist_index=artist_index)
+                   for search_dict in artist_recs]
+
+        # Merge results in the same order as the list of artists
+        for search_dict, future in zip(artist_recs, futures):
+            try:
+                concert_recs_list.extend(future.result())
+
+            # Report the failed artist without failing the whole batch
+            except Exception as msg:
+                print("Failed: {} ({})".format(search_dict.get('artist'), msg))
+                failed_artists.append(search_dict.get('artist'))
+
+    return {'concerts': concert_recs_list, 'failed': failed_artists}
+
+
+def iter_songkick_concerts_batch(artist_recs, location="sk:26330", artist_index=None):
+    """Yields concert search results for a list of artists as they complete
+
+    Searches Songkick for each artist concurrently on a bounded pool of
+    workers (or in artist_index, see find_songkick_concerts). Yields a
+    (search_dict, concert list, error) tuple for each artist, in the order
+    the searches finish. The error is None if the search succeeded,
+    otherwise the concert list is None. Searches not yet started are
+    cancelled if the caller stops reading early.
+    """
+
+    # Nothing to search for
+    if not artist_recs:
+        return
+
+    workers = min(SONGKICK_MAX_WORKERS, len(artist_recs))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+
+    try:
+        # Start a Songkick search for each artist
+        for search_dict in artist_recs:
+            future = executor.submit(find_songkick_concerts, search_dict, location, artist_index=artist_index)
+            futures[future] = search_dict
+
+        # Yield each artist's results as soon as they are ready
+        for future in as_completed(futures):
+            search_dict = futures[future]
+            try:
+                yield search_dict, future.result(), None
+
+            # Report the failed artist without stopping the other searches
+            except Exception as msg:
+                print("Failed: {} ({})".format(search_dict.get('artist'), msg))
+                yield search_dict, None, str(msg)
+
+    finally:
+        # Don't wait for searches nobody will read, like when a stream is closed
+        for future in futures:
+            future.cancel()
+
+        executor.shutdown(wait=False)
+
+
+def normalize_date(date_string, memo=None):
+    """Return Songkick date or datetime string as an ISO 8601 datetime string
+
+    Gives the same result as arrow.get(date_string).isoformat(), but handles
+    Songkick's usual formats without arrow's parser. Also takes an optional
+    dictionary of results for strings already normalized.
+    """
+
+    if memo is not None and date_string in memo:
+        return memo[date_string]
+
+    date_match = SONGKICK_DATE_RE.match(date_string)
+
+    try:
+        # Date only, at midnight UTC, like 2017-08-11
+        if date_match and date_match.group('time') is None:
+            year, month, day = date_match.group('year', 'month', 'day')
+            datetime(int(year), int(month), int(day))
+            normalized = date_string + 'T00:00:00+00:00'
+
+        # Date and time with UTC offset, like 2010-02-16T19:30:00+0000
+        elif date_match and date_match.group('offset_minutes') is not None:
+            year, month, day, hour, minute, second = date_match.group('year', 'month', 'day',
+                                                                      'hour', 'minute', 'second')
+            datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+
+            offset_hours, offset_minutes = date_match.group('offset_hours', 'offset_minutes')
+            if int(offset_hours[1:]) > 23 or int(offset_minutes) > 59:
+                raise ValueError("UTC offset out of range")
+
+            # Zero offsets are always written as +00:00
+            if offset_hours[1:] == '00' and offset_minutes == '00':
+                offset_hours = '+00'
+
+            normalized = date_string[:19] + offset_hours + ':' + offset_minutes
+
+        # Let arrow parse anything else
+        else:
+            normalized = arrow.get(date_string).isoformat()
+
+    # Let arrow handle (or reject) strings that aren't real dates
+    except ValueError:
+        normalized = arrow.get(date_string).isoformat()
+
+    if memo is not None:
+        memo[date_string] = normalized
+
+    return normalized
 
 
 def create_concert_list(event_json, search_dict):
@@ -106,50 +659,72 @@ def create_concert_list(event_json, search_dict):
     Also takes a dictionary of the searched artist's information
     """
 
-    event_list = []
-
     # Get list of events from response
     events = event_json['resultsPage']['results'].get('event')
 
+    return create_concerts(events, search_dict)
+
+
+def create_concerts(events, search_dict):
+    """Takes list of Songkick event JSON and returns list of concert dictionaries
+
+    Also takes a dictionary of the searched artist's information
+    """
+
+    event_list = []
+
+    # Dates already normalized for these events
+    date_memo = {}
+
     # If event list not empty
     if events:
 
-        # Iterate over event list
+        # Iterate over event list and add each concert to recommendation list
         for event in events:
-
-            # Create dictionary of concert's information
-            concert = {
-                'display_name': event['displayName'],
-                'songkick_id': event['id'],
-                'songkick_url': event['uri'],
-                'artist': search_dict['artist'],
-                'spotify_id': search_dict['spotify_id'],
-                'image_url': search_dict['image_url'],
-                'venue_name': event['venue']['displayName'],
-                'venue_lat': event['venue']['lat'],
-                'venue_lng': event['venue']['lng'],
-                'city': event['location']['city'],
-                'source': search_dict['source'],
-            }
-
-            # Set concert dict's start & end date & time
-            if event.get('start'):
-                if event['start']['datetime']:
-                    concert['start_datetime'] = arrow.get(event['start']['datetime']).isoformat()
-                # Only use date if there's no time
-                else:
-                    concert['start_datetime'] = arrow.get(event['start']['date']).isoformat()
-                    concert['start_date'] = arrow.get(event['start']['date']).isoformat()
-
-            if event.get('end'):
-                if event['end']['datetime']:
-                    concert['end_datetime'] = arrow.get(event['end']['datetime']).isoformat()
-                # Only use date if there's no time
-                else:
-                    concert['end_datetime'] = arrow.get(event['end']['date']).isoformat()
-                    concert['end_date'] = arrow.get(event['end']['date']).isoformat()
-
-            # Add concert to recommendation list
-            event_list.append(concert)
+            event_list.append(create_concert(event, search_dict, date_memo))
 
     return event_list
+
+
+def create_concert(event, search_dict, date_memo=None):
+    """Takes Songkick event JSON and returns a concert dictionary
+
+    Also takes a dictionary of the searched artist's information, and an
+    optional dictionary of dates already normalized
+    """
+
+    # Create dictionary of concert's information
+    concert = {
+        'display_name': event['displayName'],
+        'songkick_id': event['id'],
+        'songkick_url': event['uri'],
+        'artist': search_dict['artist'],
+        'spotify_id': search_dict['spotify_id'],
+        'image_url': search_dict['image_url'],
+        'venue_name': event['venue']['displayName'],
+        'venue_lat': event['venue']['lat'],
+        'venue_lng': event['venue']['lng'],
+        'city': event['location']['city'],
+        'source': search_dict['source'],
+    }
+
+    # Set concert dict's start & end date & time
+    if event.get('start'):
+        if event['start']['datetime']:
+            concert['start_datetime'] = normalize_date(event['start']['datetime'], date_memo)
+        # Only use date if there's no time
+        else:
+            start_date = normalize_date(event['start']['date'], date_memo)
+            concert['start_datetime'] = start_date
+            concert['start_date'] = start_date
+
+    if event.get('end'):
+        if event['end']['datetime']:
+            concert['end_datetime'] = normalize_date(event['end']['datetime'], date_memo)
+        # Only use date if there's no time
+        else:
+            end_date = normalize_date(event['end']['date'], date_memo)
+            concert['end_datetime'] = end_date
+            concert['end_date'] = end_date
+
+    return concert
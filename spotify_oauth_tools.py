@@ -1,6 +1,19 @@
 import os
+import threading
+import time
+
+import requests
+import spotipy
 from spotipy import oauth2
 
+from http_sessions import ThreadSessions
+
+# Seconds before the client credentials token expires to refresh it
+SPOTIFY_TOKEN_REFRESH_MARGIN = int(os.getenv('SPOTIFY_TOKEN_REFRESH_MARGIN', 5 * 60))
+
+# Seconds to wait for a response from Spotify
+SPOTIFY_REQUESTS_TIMEOUT = float(os.getenv('SPOTIFY_REQUESTS_TIMEOUT', 10))
+
 
 def get_spotify_oauth():
     """Returns SpotifyOAuth object
@@ -12,7 +25,7 @@ def get_spotify_oauth():
     client_id = os.getenv('SPOTIPY_CLIENT_ID')
     client_secret = os.getenv('SPOTIPY_CLIENT_SECRET')
     redirect_uri = os.getenv('SPOTIPY_REDIRECT_URI')
-    scope = 'user-top-read'
+    scope = 'user-top-read user-follow-read playlist-read-private'
 
     # Create Spotipy SpotifyOauth object
     sp_oauth = oauth2.SpotifyOAuth(client_id,
@@ -20,3 +33,142 @@ def get_spotify_oauth():
                                    redirect_uri,
                                    scope=scope)
     return sp_oauth
+
+
+class PooledSession(requests.Session):
+    """Thread-safe stand-in for a requests session, for Spotipy clients
+
+    Each thread gets its own session, but they all share one pool of
+    keep-alive connections (see http_sessions). Spotipy retries rate limited
+    and failed responses itself, so only connection errors are retried here.
+    (Spotipy only uses a session it's given if it's a requests.Session.)
+    """
+
+    def __init__(self, pool_size=None, retries=None):
+
+        super(PooledSession, self).__init__()
+
+        if pool_size is None:
+            pool_size = int(os.getenv('SPOTIFY_POOL_SIZE', 20))
+        if retries is None:
+            retries = int(os.getenv('SPOTIFY_RETRIES', 2))
+
+        self.sessions = ThreadSessions(pool_size, retries, backoff_factor=0, retry_statuses=())
+
+    def request(self, method, url, **kwargs):
+        """Make request using this thread's session"""
+
+        return self.sessions.get().request(method, url, **kwargs)
+
+
+class RefreshingClientCredentials(oauth2.SpotifyClientCredentials):
+    """Thread-safe client credentials that are refreshed before they expire
+
+    Once start() is called, a background thread gets a new token
+    refresh_margin seconds before the current one expires, so requests
+    don't have to wait for one.
+    """
+
+    def __init__(self, client_id=None, client_secret=None, refresh_margin=None):
+
+        super(RefreshingClientCredentials, self).__init__(client_id, client_secret)
+
+        if refresh_margin is None:
+            refresh_margin = SPOTIFY_TOKEN_REFRESH_MARGIN
+
+        self.refresh_margin = refresh_margin
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get_access_token(self):
+        """Return current access token, only requesting one if it has expired"""
+
+        token_info = self.token_info
+
+        if token_info and not self._is_token_expired(token_info):
+            return token_info['access_token']
+
+        # Only one thread requests a token if the refresher fell behind
+        with self._lock:
+            if self.token_info and not self._is_token_expired(self.token_info):
+                return self.token_info['access_token']
+
+            return self.refresh()['access_token']
+
+    def refresh(self):
+        """Request a new token and return its token info"""
+
+        token_info = self._add_custom_values_to_token_info(self._request_access_token())
+        self.token_info = token_info
+
+        return token_info
+
+    def seconds_until_refresh(self):
+        """Return seconds until the current token should be refreshed"""
+
+        if not self.token_info:
+            return 0
+
+        return max(self.token_info['expires_at'] - self.refresh_margin - time.time(), 0)
+
+    def start(self):
+        """Start refreshing the token in the background, if not already"""
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh_forever,
+                                                name='spotify-token-refresher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _refresh_forever(self):      # pragma: no cover
+        """Refresh the token shortly before it expires, forever"""
+
+        while True:
+            time.sleep(self.seconds_until_refresh())
+
+            try:
+                with self._lock:
+                    if self.seconds_until_refresh() == 0:
+                        self.refresh()
+
+            # Try again soon, while the old token is still usable
+            except Exception as msg:
+                print("Spotify token refresh failed: {}".format(msg))
+                time.sleep(10)
+
+
+# Shared connection pool for all Spotify requests in this process
+SPOTIFY_SESSION = PooledSession()
+
+_spotify_client = None
+_spotify_client_lock = threading.Lock()
+
+
+def get_spotify_client():
+    """Returns this process's Spotify API object for app-authorized requests
+
+    Created on first use, which starts its token refresher
+    """
+
+    global _spotify_client
+
+    with _spotify_client_lock:
+        if _spotify_client is None:
+            credentials = RefreshingClientCredentials()
+            credentials.start()
+
+            _spotify_client = spotipy.Spotify(client_credentials_manager=credentials,
+                                              requests_session=SPOTIFY_SESSION,
+                                              requests_timeout=SPOTIFY_REQUESTS_TIMEOUT)
+
+    return _spotify_client
+
+
+def get_user_spotify_client(access_token):
+    """Returns Spotify API object for requests authorized by a user's access token"""
+
+    return spotipy.Spotify(auth=access_token,
+                           requests_session=SPOTIFY_SESSION,
+                           requests_timeout=SPOTIFY_REQUESTS_TIMEOUT)
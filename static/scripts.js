@@ -280,11 +280,45 @@ function submitNoAuth(evt) {
 }
 
 
+// Submit location data and playlist to import artists from
+function submitPlaylist(evt) {
+    evt.preventDefault();
+
+    var playlist = $("#playlist-input").val();
+
+    // Alert if no playlist entered
+    if (!playlist) {
+        alert('Please enter a Spotify playlist link.');
+
+    // Otherwise, send data
+    } else {
+        // Merge playlist & location data into payload
+        var selectedLoc = $('input[name="sk-loc"]:checked').data();
+        var payload = Object.assign({}, {playlist: playlist}, selectedLoc);
+
+        // Create hidden form & inputs with location and playlist
+        var playlistForm = $("<form>").attr({"method": "POST", "action": "/no-auth-search"});
+        for (var item in payload) {
+            $("<input>").attr("name", item).val(payload[item]).appendTo(playlistForm);
+        }
+
+        // Submit hidden form
+        playlistForm.hide().appendTo('body').submit();
+    }
+}
+
+
 
 /* -------------------------------------- RESULTS FUNCTIONS -------------------------------------- */
 
 
-// Sends concert data to server via AJAX request for addition to database
+// Concert saves waiting to be sent, and how long to wait for more clicks (ms)
+var saveQueue = [];
+var saveTimer = null;
+var SAVE_DELAY = 500;
+
+
+// Queues concert data to be sent to server for addition to database
 function addConcert(evt){
     evt.preventDefault();
 
@@ -309,24 +343,74 @@ function addConcert(evt){
         "end-datetime": $(this).siblings("input.end-datetime").val(),
     };
 
+    // Disable the button so the concert is only queued once
+    thisButton.prop("disabled", true).val("Saving...");
+    saveQueue.push({"button": thisButton, "concert": formInputs});
+
+    // Send the queue once clicks stop for a moment
+    clearTimeout(saveTimer);
+    saveTimer = setTimeout(flushSaveQueue, SAVE_DELAY);
+}
+
+
+// Sends queued concerts to server in one AJAX request
+function flushSaveQueue(){
+    var saves = saveQueue;
+    saveQueue = [];
+
+    if (saves.length === 0) {
+        return;
+    }
+
+    var concerts = saves.map(function(save) { return save.concert; });
+
     // POST AJAX request to server
-    $.post("/add-concert.json", formInputs, function(data) {
-        // If the removal is successful, disable the button
+    $.post("/add-concerts.json", {"concerts": JSON.stringify(concerts)}, function(data) {
+        // If the additions are successful, mark the buttons saved
         if (data === true) {
-            thisButton.prop("disabled", true).val("Saved!");
-            thisButton.removeClass("btn-info").addClass("btn-success");
+            saves.forEach(function(save) {
+                save.button.val("Saved!").removeClass("btn-info").addClass("btn-success");
+            });
         } else {
             // Alert user if unsuccessful
-            alert('Cannot add this concert at this time.');
+            resetSaveButtons(saves);
+            alert('Cannot add these concerts at this time.');
         }
     }).fail(function(err){
-        // Display error message if GET request fails
+        // Display error message if POST request fails
+        resetSaveButtons(saves);
         alert("Concert addition failed: " +
               err.status + ": " + err.statusText);
     });
 }
 
 
+// Sends queued concerts as the page closes, which cancels AJAX requests
+function flushSaveQueueOnUnload(){
+    if (saveQueue.length === 0 || !navigator.sendBeacon) {
+        flushSaveQueue();
+        return;
+    }
+
+    clearTimeout(saveTimer);
+
+    var concerts = saveQueue.map(function(save) { return save.concert; });
+    saveQueue = [];
+
+    // Beacons are sent even after the page is gone (as a form, like $.post)
+    var data = new URLSearchParams({"concerts": JSON.stringify(concerts)});
+    navigator.sendBeacon("/add-concerts.json", data);
+}
+
+
+// Lets concerts that weren't saved be saved again
+function resetSaveButtons(saves){
+    saves.forEach(function(save) {
+        save.button.prop("disabled", false).val("Add this concert");
+    });
+}
+
+
 // Sort concert divs based on button pressed
 function sortConcerts(evt){
     var evtButton = $(this);
@@ -1,17 +1,89 @@
 import unittest
+import threading
+import time
+import arrow
+import numpy
 from freezegun import freeze_time
-from datetime import datetime
+from datetime import datetime, timedelta
 import spotipy
 import os
 from passlib.hash import pbkdf2_sha256 as sha
 import json
+import requests
 
 import sample_apis
+import caching
+import artist_graph
 import songkick
 import analyzation
 import spotify_oauth_tools
 import model
 import server
+import workers
+
+
+class QueryCounter(object):
+    """Context manager counting the SQL statements run on an engine"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        model.db.event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        model.db.event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+def fake_songkick_response(status_code, data=None):
+    """Return requests response with status code and JSON data"""
+
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = songkick.SONGKICK_API_URL
+    response._content = json.dumps(data).encode('utf-8') if data is not None else b''
+
+    return response
+
+
+def songkick_events_page(events, total_entries):
+    """Return Songkick results page JSON for a page of events"""
+
+    return {'resultsPage': {'results': {'event': events} if events else {},
+                            'totalEntries': total_entries}}
+
+
+class FakeSongkickClient(object):
+    """Stand-in for songkick.SONGKICK_CLIENT
+
+    respond(path, payload) returns (status code, JSON data) for each request
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def get(self, path, payload=None):
+        payload = dict(payload or {})
+
+        with self._lock:
+            self.requests.append((path, payload))
+
+        return fake_songkick_response(*self.respond(path, payload))
+
+    def __enter__(self):
+        self.real_client = songkick.SONGKICK_CLIENT
+        songkick.SONGKICK_CLIENT = self
+        return self
+
+    def __exit__(self, *exc_info):
+        songkick.SONGKICK_CLIENT = self.real_client
 
 
 class TestSongkick(unittest.TestCase):
@@ -36,6 +108,16 @@ class TestSongkick(unittest.TestCase):
     def test_nowhere(self):
         self.assertEqual(songkick.create_location_list(sample_apis.nowhere), [])
 
+    def test_songkick_client(self):
+        client = songkick.SongkickClient(pool_size=4, retries=2, connect_timeout=1, read_timeout=5)
+        self.assertEqual(client.timeout, (1, 5))
+        self.assertEqual(client.sessions.adapter.max_retries.total, 2)
+        self.assertIn(503, client.sessions.adapter.max_retries.status_forcelist)
+
+        session = client.sessions.get()
+        self.assertIs(client.sessions.get(), session)
+        self.assertIs(session.get_adapter(songkick.SONGKICK_API_URL), client.sessions.adapter)
+
     def test_concert_request(self):
         artist = {'spotify_id': '1234',
                   'artist': 'Open Mike Eagle',
@@ -44,6 +126,200 @@ class TestSongkick(unittest.TestCase):
         concerts = songkick.find_songkick_concerts(artist)
         self.assertIsInstance(concerts, list)
 
+    def test_iter_concerts_request(self):
+        artist = {'spotify_id': '1234',
+                  'artist': 'Open Mike Eagle',
+                  'image_url': None,
+                  'source': 'Run The Jewels'}
+        concerts = songkick.iter_songkick_concerts(artist, limit=3)
+        self.assertLessEqual(len(list(concerts)), 3)
+
+    def test_concert_batch(self):
+        artists = [{'spotify_id': '1234',
+                    'artist': 'Open Mike Eagle',
+                    'image_url': None,
+                    'source': 'Run The Jewels'}]
+        results = songkick.find_songkick_concerts_batch(artists)
+        self.assertIsInstance(results['concerts'], list)
+        self.assertIsInstance(results['failed'], list)
+
+        empty = songkick.find_songkick_concerts_batch([])
+        self.assertEqual(empty, {'concerts': [], 'failed': []})
+
+    def test_normalize_artist_name(self):
+        self.assertEqual(songkick.normalize_artist_name('  Run  The JEWELS '), 'run the jewels')
+
+    def test_index_events_by_artist(self):
+        events = (sample_apis.vw_concerts['resultsPage']['results']['event'] +
+                  sample_apis.outside_lands['resultsPage']['results']['event'])
+        artist_index = songkick.index_events_by_artist(events)
+
+        self.assertEqual(len(artist_index['vampire weekend']), 2)
+        self.assertEqual(len(artist_index['schoolboy q']), 1)
+        self.assertIn('Outside Lands', artist_index['schoolboy q'][0]['displayName'])
+        self.assertNotIn('run the jewels', artist_index)
+
+    def test_calendar_concerts(self):
+        events = sample_apis.vw_concerts['resultsPage']['results']['event']
+        songkick.SONGKICK_CALENDAR_CACHE.set('sk:24426', songkick.index_events_by_artist(events))
+
+        artist = {'spotify_id': '9999',
+                  'artist': 'VAMPIRE Weekend',
+                  'image_url': None,
+                  'source': 'Phoenix'}
+        concerts = songkick.find_songkick_concerts(artist, 'sk:24426', use_calendar=True)
+        self.assertEqual(len(concerts), 2)
+        self.assertEqual(concerts[0]['artist'], 'VAMPIRE Weekend')
+        self.assertEqual(concerts[1]['songkick_id'], 3078766)
+
+        artist['artist'] = 'Phoenix'
+        self.assertEqual(songkick.find_songkick_concerts(artist, 'sk:24426', use_calendar=True), [])
+
+        songkick.SONGKICK_CALENDAR_CACHE.clear()
+
+    def test_filter_events_by_metro_area(self):
+        events = (sample_apis.vw_concerts['resultsPage']['results']['event'] +
+                  sample_apis.outside_lands['resultsPage']['results']['event'])
+
+        sf_events = songkick.filter_events_by_metro_area(events, 'sk:26330')
+        self.assertEqual(len(sf_events), 1)
+        self.assertIn('Outside Lands', sf_events[0]['displayName'])
+        self.assertEqual(songkick.filter_events_by_metro_area(events, 'sk:24426'), [])
+
+    def test_artist_id_concerts(self):
+        events = sample_apis.outside_lands['resultsPage']['results']['event']
+        songkick.SONGKICK_ARTIST_ID_CACHE.set('5555', {'songkick_artist_id': 42})
+        songkick.SONGKICK_ARTIST_ID_CACHE.set('0000', {'songkick_artist_id': None})
+        songkick.SONGKICK_EVENT_CACHE.set(('songkick-artist', 42), events)
+
+        artist = {'spotify_id': '5555',
+                  'artist': 'Lorde',
+                  'image_url': None,
+                  'source': None}
+        concerts = songkick.find_songkick_concerts(artist, 'sk:26330')
+        self.assertEqual(len(concerts), 1)
+        self.assertEqual(concerts[0]['spotify_id'], '5555')
+        self.assertEqual(songkick.find_songkick_concerts(artist, 'sk:24426'), [])
+
+        # Artists without a Songkick id are searched for by name
+        songkick.SONGKICK_EVENT_CACHE.set(('lorde', 'sk:26330'), events)
+        artist['spotify_id'] = '0000'
+        self.assertEqual(len(songkick.find_songkick_concerts(artist, 'sk:26330')), 1)
+
+        songkick.SONGKICK_ARTIST_ID_CACHE.clear()
+        songkick.SONGKICK_EVENT_CACHE.clear()
+
+    def test_concert_batch_upstream_error(self):
+        events = sample_apis.vw_concerts['resultsPage']['results']['event']
+
+        def respond(path, payload):
+            if payload['artist_name'] == 'Vampire Weekend':
+                return 200, songkick_events_page(events, len(events))
+            return 503, None
+
+        artists = [{'spotify_id': None, 'artist': 'Vampire Weekend', 'image_url': None, 'source': None},
+                   {'spotify_id': None, 'artist': 'Phoenix', 'image_url': None, 'source': None}]
+
+        # Artist whose search fails is reported, not shown as having no concerts
+        try:
+            with FakeSongkickClient(respond):
+                results = songkick.find_songkick_concerts_batch(artists, 'sk:26330')
+                self.assertEqual(len(results['concerts']), len(events))
+                self.assertEqual(results['failed'], ['Phoenix'])
+
+                streamed = {search_dict['artist']: error for search_dict, concerts, error
+                            in songkick.iter_songkick_concerts_batch(artists, 'sk:26330')}
+                self.assertIsNone(streamed['Vampire Weekend'])
+                self.assertIn('Phoenix', streamed['Phoenix'])
+
+        finally:
+            songkick.SONGKICK_EVENT_CACHE.clear()
+
+    def test_concert_batch_stream_closed(self):
+        def respond(path, payload):
+            time.sleep(0.05)
+            return 200, songkick_events_page([], 0)
+
+        artists = [{'spotify_id': None, 'artist': 'Artist {}'.format(i), 'image_url': None, 'source': None}
+                   for i in range(5)]
+
+        # Searches not started when the stream is closed are never made
+        max_workers = songkick.SONGKICK_MAX_WORKERS
+        songkick.SONGKICK_MAX_WORKERS = 1
+        try:
+            with FakeSongkickClient(respond) as client:
+                stream = songkick.iter_songkick_concerts_batch(artists, 'sk:26330')
+                next(stream)
+                stream.close()
+                time.sleep(0.2)
+
+                searched = set(payload.get('artist_name') for path, payload in client.requests)
+                self.assertLessEqual(len(searched), 2)
+
+        finally:
+            songkick.SONGKICK_MAX_WORKERS = max_workers
+            songkick.SONGKICK_EVENT_CACHE.clear()
+
+    def test_artist_id_not_found(self):
+        events = sample_apis.vw_concerts['resultsPage']['results']['event']
+
+        def respond(path, payload):
+            if path == '/search/artists.json':
+                artists = [{'id': 7, 'displayName': 'Vampire Weekend Tribute'}]
+                return 200, {'resultsPage': {'results': {'artist': artists}}}
+            return 200, songkick_events_page(events, len(events))
+
+        artist = {'spotify_id': '9999',
+                  'artist': 'Vampire Weekend',
+                  'image_url': None,
+                  'source': None}
+        store = songkick.ARTIST_ID_STORE
+        songkick.ARTIST_ID_STORE = None
+
+        # Inexact name match falls back to the name search, and isn't cached
+        try:
+            with FakeSongkickClient(respond) as client:
+                self.assertEqual(len(songkick.find_songkick_concerts(artist, 'sk:26330')), len(events))
+                self.assertEqual([path for path, payload in client.requests], ['/search/artists.json', '/events.json'])
+                self.assertFalse(songkick.SONGKICK_ARTIST_ID_CACHE.has('9999'))
+
+        finally:
+            songkick.ARTIST_ID_STORE = store
+            songkick.SONGKICK_ARTIST_ID_CACHE.clear()
+            songkick.SONGKICK_EVENT_CACHE.clear()
+
+    def test_concert_timeout(self):
+        events = sample_apis.vw_concerts['resultsPage']['results']['event']
+
+        def respond(path, payload):
+            if path == '/search/artists.json':
+                raise requests.ReadTimeout("Read timed out")
+            return 200, songkick_events_page(events, len(events))
+
+        artist = {'spotify_id': '9999',
+                  'artist': 'Vampire Weekend',
+                  'image_url': None,
+                  'source': None}
+        store = songkick.ARTIST_ID_STORE
+        songkick.ARTIST_ID_STORE = None
+
+        # Timeout looking up the artist id falls back to the name search
+        try:
+            with FakeSongkickClient(respond):
+                self.assertEqual(len(songkick.find_songkick_concerts(artist, 'sk:26330')), len(events))
+
+            songkick.SONGKICK_EVENT_CACHE.clear()
+
+            # Timeout searching by name is reported as a failed search
+            with FakeSongkickClient(lambda path, payload: respond('/search/artists.json', payload)):
+                with self.assertRaises(songkick.SongkickError):
+                    songkick.find_songkick_concerts(artist, 'sk:26330')
+
+        finally:
+            songkick.ARTIST_ID_STORE = store
+            songkick.SONGKICK_ARTIST_ID_CACHE.clear()
+            songkick.SONGKICK_EVENT_CACHE.clear()
+
     def test_concert_response(self):
         artist = {'spotify_id': '9999',
                   'artist': 'Vampire Weekend',
@@ -63,6 +339,31 @@ class TestSongkick(unittest.TestCase):
         self.assertEqual(concerts[1]['spotify_id'], '9999')
         self.assertEqual(concerts[1]['source'], 'Phoenix')
 
+    def test_create_concert(self):
+        artist = {'spotify_id': '9999',
+                  'artist': 'Vampire Weekend',
+                  'image_url': None,
+                  'source': None}
+        event = sample_apis.vw_concerts['resultsPage']['results']['event'][1]
+        concert = songkick.create_concert(event, artist)
+
+        self.assertEqual(concert, songkick.create_concert_list(sample_apis.vw_concerts, artist)[1])
+        self.assertEqual(concert['start_date'], '2010-02-17T00:00:00+00:00')
+        self.assertEqual(concert['venue_name'], 'O2 Academy Brixton')
+
+    def test_normalize_date(self):
+        dates = ['2010-02-16T19:30:00+0000', '2010-02-16T19:30:00-0700', '2017-08-11',
+                 '2017-08-11T10:00:00', '2010-12-31T23:59:59-0000', '2017-08-11T10:00:00.5+05:30']
+        for date_string in dates:
+            self.assertEqual(songkick.normalize_date(date_string), arrow.get(date_string).isoformat())
+
+        memo = {}
+        songkick.normalize_date('2017-08-11', memo)
+        self.assertEqual(memo, {'2017-08-11': '2017-08-11T00:00:00+00:00'})
+
+        with self.assertRaises(ValueError):
+            songkick.normalize_date('2017-02-30')
+
     def test_festival_response(self):
         artist = {'spotify_id': '5555',
                   'artist': 'Little Dragon',
@@ -117,6 +418,311 @@ class TestAnalyzation(unittest.TestCase):
         self.assertNotEqual(len(result), 0)
         self.assertEqual(result[1]['source'], 'Little Dragon')
 
+    def test_artist_rec_collection(self):
+        clip_search = sample_apis.clipping_search['artists']['items']
+        collection = analyzation.ArtistRecCollection()
+        collection.append(analyzation.ArtistRec.from_dict({'spotify_id': '7iUaTsRiiEVbslUcOs5mpd',
+                                                           'artist': 'Clipping'}))
+
+        result = analyzation.parse_artist_response(clip_search, collection, 'Death Grips')
+        self.assertIs(result, collection)
+        self.assertEqual(len(collection), 3)
+        self.assertIn('5HJ2kX5UTwN4Ns8fB5Rn1I', collection)
+        self.assertEqual(collection.to_dicts()[1:],
+                         analyzation.parse_artist_response(clip_search[:1] + clip_search[2:], source='Death Grips'))
+
+        with self.assertRaises(AttributeError):
+            collection._recs[0].genres = []
+
+    def test_find_spotify_artists_cached(self):
+        clip_search = sample_apis.clipping_search['artists']['items']
+        analyzation.ARTIST_SEARCH_CACHE.set('clip', analyzation.parse_artist_response(clip_search), True)
+
+        result = analyzation.find_spotify_artists('  CLIPPING. ')
+        self.assertEqual([artist['artist'] for artist in result], ['clipping.', 'clipping. feat. baseck'])
+        self.assertEqual(len(analyzation.find_spotify_artists('Clip')), 3)
+        analyzation.ARTIST_SEARCH_CACHE.clear()
+
+    def test_get_top_artists_ranges(self):
+        release = threading.Event()
+
+        class FakeSpotify(object):
+            def current_user_top_artists(self, limit, time_range):
+                ids = {'short_term': ['c', 'a'],
+                       'medium_term': ['a', 'b'],
+                       'long_term': ['d']}[time_range]
+                if time_range == 'long_term':
+                    release.wait(5)
+                return {'items': [{'id': i, 'name': i.upper(), 'images': []} for i in ids]}
+
+        ranges = [('short_term', 1), ('medium_term', 1), ('long_term', 1)]
+        result = analyzation.get_top_artists(FakeSpotify(), ranges, timeout=0.2)
+        release.set()
+        self.assertEqual([artist['spotify_id'] for artist in result], ['a', 'c', 'b'])
+        self.assertEqual(set(result[0]), {'spotify_id', 'artist', 'source', 'image_url'})
+
+        result = analyzation.get_top_artists(FakeSpotify(), [('medium_term', 1)], max_seeds=1)
+        self.assertEqual([artist['spotify_id'] for artist in result], ['a'])
+
+        with self.assertRaises(TimeoutError):
+            release.clear()
+            analyzation.get_top_artists(FakeSpotify(), [('long_term', 1), ('long_term', 2)], timeout=0.05)
+        release.set()
+
+    def test_import_playlist_seeds(self):
+        class FakeSpotify(object):
+            def __init__(self):
+                self.offsets = []
+
+            def _get(self, url, limit, offset, fields):
+                self.offsets.append(offset)
+                tracks = [{'track': {'artists': [{'id': 'a{}'.format(i % 3), 'name': 'A'},
+                                                 {'id': None, 'name': 'Local'}]}}
+                          for i in range(offset, min(offset + limit, 250))]
+                return {'total': 250, 'items': tracks + [{'track': None}]}
+
+        spotify = FakeSpotify()
+        playlist = 'https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M?si=abc'
+        result = analyzation.import_playlist_seeds(spotify, playlist, max_artists=2)
+        self.assertEqual(sorted(spotify.offsets), [0, 100, 200])
+        self.assertEqual([artist['spotify_id'] for artist in result], ['a0', 'a1'])
+        self.assertEqual(set(result[0]), {'spotify_id', 'artist', 'source', 'image_url'})
+
+        spotify = FakeSpotify()
+        analyzation.import_playlist_seeds(spotify, 'spotify:playlist:37i9dQZF1DXcBWIGoYBM5M', max_tracks=150)
+        self.assertEqual(sorted(spotify.offsets), [0, 100])
+
+        with self.assertRaises(ValueError):
+            analyzation.import_playlist_seeds(spotify, 'not a playlist')
+
+    def test_import_followed_seeds(self):
+        class FakeSpotify(object):
+            def current_user_followed_artists(self, limit, after):
+                start = int(after or 0)
+                items = [{'id': str(i), 'name': 'A', 'images': []} for i in range(start, start + limit)]
+                return {'artists': {'items': items,
+                                    'cursors': {'after': str(start + limit) if start < 100 else None}}}
+
+        self.assertEqual(len(analyzation.import_followed_seeds(FakeSpotify(), max_artists=120)), 120)
+        self.assertEqual(len(analyzation.import_followed_seeds(FakeSpotify(), max_artists=1000)), 150)
+
+    def test_rank_artist_recs(self):
+        def response(*ids):
+            return {'artists': [{'id': i, 'name': i.upper(), 'images': []} for i in ids]}
+
+        seeds = [{'spotify_id': 'a', 'artist': 'A', 'source': None, 'image_url': None},
+                 {'spotify_id': 'b', 'artist': 'B', 'source': None, 'image_url': None}]
+        result = analyzation.rank_artist_recs(seeds, [response('c', 'd', 'b'), response('d', 'a')])
+
+        self.assertEqual([artist['spotify_id'] for artist in result], ['a', 'b', 'd', 'c'])
+        self.assertEqual(result[0]['sources'], ['B'])
+        self.assertIsNone(result[0]['source'])
+        self.assertEqual(result[2]['sources'], ['A', 'B'])
+        self.assertEqual(result[2]['source'], 'A')
+        self.assertEqual(result[3]['source'], 'A')
+        self.assertGreater(result[2]['score'], result[3]['score'])
+
+        top_two = analyzation.rank_artist_recs(seeds, [response('c', 'd', 'b'), response('d', 'a')], top_k=2)
+        self.assertEqual([artist['spotify_id'] for artist in top_two], ['a', 'b'])
+        self.assertEqual(analyzation.rank_artist_recs([], []), [])
+
+    def test_get_related_artists_batch(self):
+        class SlowSpotify(object):
+            def artist_related_artists(self, spotify_id):
+                time.sleep(0.05 / int(spotify_id))
+                return {'artists': [{'id': spotify_id, 'name': 'A', 'images': [], 'genres': []}]}
+
+        ids = ['1', '2', '3', '4']
+        result = analyzation.get_related_artists_batch(SlowSpotify(), ids)
+        self.assertEqual(result, [{'artists': [{'id': i, 'name': 'A', 'images': []}]} for i in ids])
+        self.assertEqual(analyzation.get_related_artists_batch(SlowSpotify(), []), [])
+        analyzation.RELATED_ARTISTS_CACHE.clear()
+
+        timings = analyzation.RELATED_ARTISTS_TIMER.stats()
+        self.assertIn('mean_seconds', timings)
+
+
+class TestArtistGraph(unittest.TestCase):
+
+    def setUp(self):
+        def response(*ids):
+            return {'artists': [{'id': i, 'name': i.upper(), 'images': [{'url': i + '.jpg'}]}
+                                for i in ids]}
+
+        self.graph = artist_graph.ArtistGraph.from_responses({'a': response('b', 'c'),
+                                                              'b': response('c', 'd'),
+                                                              'c': response('e'),
+                                                              'x': response('c', 'y')})
+
+    def test_from_responses(self):
+        self.assertEqual(self.graph.stats()['artists'], 7)
+        self.assertEqual(self.graph.stats()['edges'], 7)
+        self.assertEqual(self.graph.targets.dtype, numpy.int32)
+        self.assertEqual(self.graph.related('b'), ['c', 'd'])
+        self.assertEqual(self.graph.related('d'), [])
+        self.assertEqual(len(self.graph.offsets), 8)
+        self.assertEqual(self.graph.related('y'), [])
+        self.assertEqual(self.graph.names[self.graph.index['e']], 'E')
+
+    def test_bfs(self):
+        self.assertEqual(self.graph.bfs(['a'], max_depth=3),
+                         [('a', 0, None), ('b', 1, 'a'), ('c', 1, 'a'), ('d', 2, 'b'), ('e', 2, 'c')])
+        self.assertEqual(self.graph.bfs(['a', 'x'], max_depth=1)[-1], ('y', 1, 'x'))
+        self.assertEqual(self.graph.bfs(['unknown']), [])
+
+    def test_personalized_pagerank(self):
+        scores = self.graph.personalized_pagerank(['a', 'x'])
+        self.assertAlmostEqual(scores.sum(), 1)
+        self.assertGreater(scores[self.graph.index['c']], scores[self.graph.index['b']])
+        self.assertGreater(scores[self.graph.index['d']], 0)
+
+    def test_add_graph_recs(self):
+        seeds = [{'spotify_id': 'a', 'artist': 'A'}]
+        recs = [{'spotify_id': 'a', 'artist': 'A', 'source': None, 'image_url': None, 'score': 1.0},
+                {'spotify_id': 'b', 'artist': 'B', 'source': 'A', 'image_url': None, 'score': 0.5},
+                {'spotify_id': 'c', 'artist': 'C', 'source': 'A', 'image_url': None, 'score': 0.4}]
+
+        result = analyzation.add_graph_recs(seeds, list(recs), graph=self.graph, max_depth=2, limit=1)
+        self.assertEqual(result[:3], recs)
+        self.assertEqual(len(result), 4)
+        self.assertIn(result[3]['spotify_id'], ('d', 'e'))
+        self.assertGreater(result[3]['score'], 0)
+        self.assertLess(result[3]['score'], 0.4)
+
+        self.assertEqual(analyzation.add_graph_recs(seeds, list(recs), graph=self.graph, max_depth=1), recs)
+
+    def test_recs_for_top_artists_with_graph(self):
+        def response(*ids):
+            return {'artists': [{'id': i, 'name': i.upper(), 'images': []} for i in ids]}
+
+        # Related artists already cached, so Spotify isn't asked
+        analyzation.RELATED_ARTISTS_CACHE.set('a', response('b', 'c'))
+        client = spotify_oauth_tools._spotify_client
+        spotify_oauth_tools._spotify_client = object()
+        try:
+            seeds = [{'spotify_id': 'a', 'artist': 'A', 'image_url': None}]
+            result = analyzation.get_recs_for_top_artists(seeds, top_k=4, graph=self.graph)
+        finally:
+            spotify_oauth_tools._spotify_client = client
+            analyzation.RELATED_ARTISTS_CACHE.clear()
+
+        self.assertEqual(len(result), 4)
+        self.assertEqual([rec['spotify_id'] for rec in result[:3]], ['a', 'b', 'c'])
+        self.assertIn(result[3]['spotify_id'], ('d', 'e'))
+        scores = [rec['score'] for rec in result]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_rebuilding_artist_graph(self):
+        rebuilding = artist_graph.RebuildingArtistGraph(lambda: {'a': {'artists': []}}, max_age=60)
+        self.assertIsNone(rebuilding.stats())
+
+        graph = rebuilding.rebuild()
+        self.assertIs(rebuilding.get(), graph)
+        self.assertEqual(rebuilding.stats()['artists'], 1)
+
+
+class TestCaching(unittest.TestCase):
+
+    def test_cache_hit_and_miss(self):
+        cache = caching.TTLCache(ttl=60)
+        self.assertEqual(cache.get_or_fetch('a', lambda: [1, 2]), [1, 2])
+        self.assertEqual(cache.get_or_fetch('a', lambda: [3]), [1, 2])
+        self.assertIsNone(cache.get_or_fetch('b', lambda: None))
+        self.assertIsNone(cache.get('b'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_cache_eviction(self):
+        cache = caching.TTLCache(ttl=60, max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache = caching.TTLCache(ttl=60, max_bytes=15)
+        cache.set('a', 'x' * 8)
+        cache.set('b', 'y' * 8)
+        cache.set('c', 'z' * 50)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'yyyyyyyy')
+        self.assertIsNone(cache.get('c'))
+
+    def test_cache_stale_while_revalidate(self):
+        cache = caching.TTLCache(ttl=60, stale_ttl=60)
+
+        with freeze_time('2017-06-01 12:00:00') as frozen:
+            cache.set('a', 'old')
+            cache.set('b', 'old')
+
+            frozen.tick(timedelta(seconds=90))
+            self.assertEqual(cache.get_or_fetch('a', lambda: 'new'), 'old')
+            cache._executor.shutdown(wait=True)
+            self.assertEqual(cache.get('a'), 'new')
+
+            frozen.tick(timedelta(seconds=60))
+            self.assertEqual(cache.get_or_fetch('b', lambda: 'new'), 'new')
+
+        stats = cache.stats()
+        self.assertEqual(stats['stale_hits'], 1)
+        self.assertEqual(stats['refreshes'], 1)
+
+
+    def test_prefix_cache(self):
+        cache = caching.PrefixCache(ttl=60, max_entries=2)
+        match = lambda result, term: result.startswith(term)
+        cache.set('ru', ['run the jewels', 'rush'], complete=True)
+        cache.set('b', ['beyonce'], complete=False)
+
+        self.assertEqual(cache.get('ru', match), ['run the jewels', 'rush'])
+        self.assertEqual(cache.get('run t', match), ['run the jewels'])
+        self.assertIsNone(cache.get('be', match))
+
+        cache.set('c', [], complete=True)
+        self.assertIsNone(cache.get('ru', match))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['prefix_hits'], stats['misses']), (1, 1, 2))
+        self.assertEqual(stats['evictions'], 1)
+
+        expired = caching.PrefixCache(ttl=0)
+        expired.set('c', [], complete=True)
+        self.assertIsNone(expired.get('c', match))
+
+    def test_single_flight(self):
+        flight = caching.SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_call():
+            calls.append(1)
+            release.wait(5)
+            return ['result']
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow_call)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()['shared'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['result']] * 5)
+        self.assertEqual(flight.stats(), {'calls': 1, 'shared': 4, 'in_flight': 0})
+
+        with self.assertRaises(ZeroDivisionError):
+            flight.do('key', lambda: 1 / 0)
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
 
 class TestSpotifyOauth(unittest.TestCase):
 
@@ -128,6 +734,75 @@ class TestSpotifyOauth(unittest.TestCase):
         self.assertEqual(sp_oauth.client_id, os.getenv('SPOTIPY_CLIENT_ID'))
         self.assertEqual(sp_oauth.client_secret, os.getenv('SPOTIPY_CLIENT_SECRET'))
 
+    def test_refreshing_client_credentials(self):
+        class FakeCredentials(spotify_oauth_tools.RefreshingClientCredentials):
+            requests = 0
+
+            def _request_access_token(self):
+                self.requests += 1
+                return {'access_token': 'token{}'.format(self.requests), 'expires_in': 3600}
+
+        credentials = FakeCredentials(refresh_margin=300)
+        self.assertEqual(credentials.seconds_until_refresh(), 0)
+        self.assertEqual(credentials.get_access_token(), 'token1')
+        self.assertEqual(credentials.get_access_token(), 'token1')
+        self.assertEqual(credentials.requests, 1)
+        self.assertAlmostEqual(credentials.seconds_until_refresh(), 3300, delta=2)
+
+        credentials.refresh()
+        self.assertEqual(credentials.get_access_token(), 'token2')
+
+    def test_spotify_client(self):
+        client = spotify_oauth_tools.get_spotify_client()
+        self.assertIs(client, spotify_oauth_tools.get_spotify_client())
+        self.assertIs(client._session, spotify_oauth_tools.SPOTIFY_SESSION)
+
+        user_client = spotify_oauth_tools.get_user_spotify_client('token')
+        self.assertIs(user_client._session, spotify_oauth_tools.SPOTIFY_SESSION)
+
+    def test_pooled_session_reuses_connections(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        connections = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                body = b'{"id": "spotifyuser"}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        session = spotify_oauth_tools.PooledSession()
+        client = spotipy.Spotify(auth='token', requests_session=session)
+        client.prefix = 'http://127.0.0.1:{}/v1/'.format(httpd.server_port)
+
+        try:
+            # Spotipy closes each response's connection, which mustn't empty the pool
+            for _ in range(5):
+                self.assertEqual(client.current_user()['id'], 'spotifyuser')
+            self.assertEqual(len(connections), 1)
+
+        finally:
+            session.sessions.adapter.close_pool()
+            httpd.shutdown()
+            httpd.server_close()
+
 
 class TestModel(unittest.TestCase):
 
@@ -160,6 +835,10 @@ class TestModel(unittest.TestCase):
         failure = noone.add_concert(99)
         self.assertFalse(failure)
 
+        # Saving the same concert twice is refused
+        self.assertFalse(noone.add_concert(2))
+        self.assertEqual(len(noone.concerts), 1)
+
     def test_user_remove_concert(self):
         user = model.User.query.first()
         clip = model.Concert.query.get(1)
@@ -173,6 +852,33 @@ class TestModel(unittest.TestCase):
         self.assertEqual(len(user.concerts), 0)
         self.assertIsNone(clip)
 
+    def test_user_remove_shared_concert(self):
+        model.User.query.get(3).add_concert(1)
+
+        # Concert stays while another user has it saved
+        self.assertTrue(model.User.query.get(1).remove_concert(1))
+        self.assertIsNotNone(model.Concert.query.get(1))
+        self.assertEqual(model.User.saved_concert_ids(1), [])
+
+        self.assertTrue(model.User.query.get(3).remove_concert(1))
+        self.assertIsNone(model.Concert.query.get(1))
+
+    def test_collect_orphaned_concerts(self):
+        model.db.session.add_all([model.Concert(songkick_id=10, artist='Kelela',
+                                                start_datetime=datetime.now() + timedelta(days=30)),
+                                  model.Concert(songkick_id=11, artist='Tune-Yards',
+                                                start_datetime=datetime(2017, 1, 1)),
+                                  model.Concert(songkick_id=12, artist='Princess Nokia')])
+        model.db.session.commit()
+
+        self.assertEqual(workers.collect_orphaned_concerts(batch_size=1, pause=0), (2, 1))
+        model.db.session.expire_all()
+
+        # Saved concerts are kept
+        self.assertEqual(sorted(concert.songkick_id for concert in model.Concert.query.all()), [1, 2, 3])
+        self.assertEqual(model.ConcertArchive.query.get(11).artist, 'Tune-Yards')
+        self.assertEqual(workers.collect_orphaned_concerts(), (0, 0))
+
     def test_concerts(self):
         clip = model.Concert.query.get(1)
         self.assertEqual(clip.artist, 'clipping.')
@@ -223,6 +929,205 @@ class TestModel(unittest.TestCase):
         self.assertEqual(assoc.user_id, 1)
         self.assertEqual(assoc.songkick_id, 1)
 
+    def test_database_single_flight(self):
+        flight = model.DatabaseSingleFlight(result_ttl=30)
+        self.assertEqual(flight.do('test:key', lambda: {'a': [1, 2]}), {'a': [1, 2]})
+
+        # Result is shared with calls that arrive before it expires
+        self.assertEqual(flight.do('test:key', lambda: 'new'), {'a': [1, 2]})
+        self.assertIsNone(flight.do('test:none', lambda: None))
+        self.assertIsNone(flight.do('test:none', lambda: 'new'))
+
+        # Failed calls release their claim
+        with self.assertRaises(ZeroDivisionError):
+            flight.do('test:error', lambda: 1 / 0)
+        self.assertIsNone(model.UpstreamCall.query.get(model.UpstreamCall.hash_key('test:error')))
+        self.assertEqual(flight.do('test:error', lambda: 'ok'), 'ok')
+
+        # Keys longer than the column, like ones with long artist names, still work
+        long_key = 'songkick:events:{}:sk:26330'.format('a' * 500)
+        self.assertEqual(flight.do(long_key, lambda: [1]), [1])
+        self.assertEqual(flight.do(long_key, lambda: [2]), [1])
+
+        # Expired results are replaced
+        expired = model.DatabaseSingleFlight(result_ttl=0, purge_interval=0)
+        self.assertEqual(expired.do('test:key', lambda: 'new'), 'new')
+
+        # Expired calls for every key are removed, not just for keys called again
+        self.assertEqual(expired.do('test:other', lambda: 'new'), 'new')
+        self.assertEqual(model.UpstreamCall.query.count(), 1)
+        self.assertEqual(expired.purge_expired(), 1)
+        self.assertEqual(model.UpstreamCall.query.count(), 0)
+
+    def test_artist_id_store(self):
+        store = model.DatabaseArtistIdStore()
+        self.assertEqual(store.get('5HJ2kX5UTwN4Ns8fB5Rn1I'), (False, None))
+
+        store.set('5HJ2kX5UTwN4Ns8fB5Rn1I', None)
+        self.assertEqual(store.get('5HJ2kX5UTwN4Ns8fB5Rn1I'), (True, None))
+
+        store.set('5HJ2kX5UTwN4Ns8fB5Rn1I', 4356181)
+        self.assertEqual(store.get('5HJ2kX5UTwN4Ns8fB5Rn1I'), (True, 4356181))
+
+        retry = model.DatabaseArtistIdStore(retry_not_found_after=timedelta(0))
+        retry.set('6Tyzp9KzpiZ04DABQoedps', None)
+        self.assertEqual(retry.get('6Tyzp9KzpiZ04DABQoedps'), (False, None))
+
+    def test_spotify_user(self):
+        token_info = {'access_token': 'access', 'refresh_token': 'refresh',
+                      'expires_at': int(time.time()) + 3600}
+        spotify_user = model.SpotifyUser.save_authorization('spotifyuser', token_info, 2)
+        self.assertEqual(spotify_user.user_id, 2)
+        self.assertTrue(spotify_user.token_is_valid())
+        self.assertIsNone(spotify_user.get_top_artists(timedelta(days=1)))
+
+        # New tokens keep the refresh token if Spotify doesn't send one
+        spotify_user = model.SpotifyUser.save_authorization('spotifyuser', {'access_token': 'new',
+                                                                            'expires_at': int(time.time())})
+        self.assertEqual(spotify_user.refresh_token, 'refresh')
+        self.assertEqual(spotify_user.user_id, 2)
+        self.assertFalse(spotify_user.token_is_valid())
+
+        top_artists = [{'spotify_id': '6Tyzp9KzpiZ04DABQoedps', 'artist': 'Little Dragon'}]
+        self.assertTrue(spotify_user.save_top_artists(top_artists))
+        self.assertEqual(model.SpotifyUser.query.get('spotifyuser').get_top_artists(timedelta(days=1)),
+                         top_artists)
+        self.assertIsNone(spotify_user.get_top_artists(timedelta(0)))
+
+    def test_migrations(self):
+        import migrations
+
+        # Recreate a DB from before the indexes, with a duplicate save
+        migrations.drop_indexes()
+        model.db.session.add(model.UserConcert(user_id=1, songkick_id=1))
+        model.db.session.commit()
+        self.assertEqual(model.UserConcert.query.filter_by(user_id=1, songkick_id=1).count(), 2)
+
+        # Migrating removes the duplicate and can be run again
+        migrations.migrate(concurrently=False)
+        migrations.migrate()
+        self.assertEqual(model.UserConcert.query.filter_by(user_id=1, songkick_id=1).count(), 1)
+
+        indexes = [row[0] for row in model.db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename IN ('concerts', 'users_concerts')")]
+        for name, statement in migrations.INDEXES:
+            self.assertIn(name, indexes)
+
+    def test_related_artists_store(self):
+        store = model.DatabaseRelatedArtistsStore()
+        response = {'artists': [{'id': '7iUaTsRiiEVbslUcOs5mpd', 'name': 'Clipping', 'images': []}]}
+        store.set('5HJ2kX5UTwN4Ns8fB5Rn1I', response)
+
+        saved = store.get_many(['5HJ2kX5UTwN4Ns8fB5Rn1I', '6Tyzp9KzpiZ04DABQoedps'])
+        self.assertEqual(list(saved), ['5HJ2kX5UTwN4Ns8fB5Rn1I'])
+        self.assertEqual(saved['5HJ2kX5UTwN4Ns8fB5Rn1I'][0], response)
+        self.assertEqual(list(store.most_recent(5)), ['5HJ2kX5UTwN4Ns8fB5Rn1I'])
+        self.assertEqual(model.DatabaseRelatedArtistsStore(timedelta(0)).get_many(['5HJ2kX5UTwN4Ns8fB5Rn1I']), {})
+
+        # Saved responses are used without asking Spotify
+        class NoSpotify(object):
+            def artist_related_artists(self, spotify_id):
+                raise AssertionError("Requested {}".format(spotify_id))
+
+        analyzation.RELATED_ARTISTS_STORE = store
+        try:
+            self.assertEqual(analyzation.warm_related_artists_cache(), 1)
+            analyzation.RELATED_ARTISTS_CACHE.clear()
+            result = analyzation.get_related_artists_batch(NoSpotify(), ['5HJ2kX5UTwN4Ns8fB5Rn1I'])
+            self.assertEqual(result, [response])
+        finally:
+            analyzation.RELATED_ARTISTS_STORE = None
+            analyzation.RELATED_ARTISTS_CACHE.clear()
+
+    def test_location_record_search(self):
+        self.assertTrue(model.Location.record_search('sk:26330', 'SF Bay Area, CA, US'))
+        self.assertTrue(model.Location.record_search('sk:24426', 'London, UK'))
+        self.assertTrue(model.Location.record_search('sk:26330', 'SF Bay Area, CA, US'))
+
+        popular = model.Location.most_searched(1)
+        self.assertEqual(len(popular), 1)
+        self.assertEqual(popular[0].location_id, 'sk:26330')
+        self.assertEqual(popular[0].search_count, 2)
+        self.assertIsNone(popular[0].refreshed_at)
+
+        # First searches for a new location at the same time are all counted
+        barrier = threading.Barrier(4)
+        results = []
+
+        def search():
+            barrier.wait()
+            results.append(model.Location.record_search('sk:17835', 'Los Angeles, CA, US'))
+            model.db.session.remove()
+
+        threads = [threading.Thread(target=search) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(model.Location.query.get('sk:17835').search_count, 4)
+
+    def test_warm_location_with_large_calendar(self):
+        events = sample_apis.outside_lands['resultsPage']['results']['event']
+
+        def respond(path, payload):
+            return 200, songkick_events_page(events[:1], 5)
+
+        # Partial calendar isn't used, so the location stays cold
+        with FakeSongkickClient(respond) as client:
+            self.assertIsNone(songkick.fetch_metro_calendar('sk:26330', max_pages=2))
+            self.assertEqual(len(client.requests), 2)
+
+            model.Location.record_search('sk:26330')
+            max_pages = songkick.SONGKICK_CALENDAR_MAX_PAGES
+            songkick.SONGKICK_CALENDAR_MAX_PAGES = 2
+            try:
+                self.assertFalse(workers.warm_location('sk:26330'))
+            finally:
+                songkick.SONGKICK_CALENDAR_MAX_PAGES = max_pages
+
+        self.assertIsNone(model.Location.query.get('sk:26330').refreshed_at)
+
+        def respond(path, payload):
+            return 200, songkick_events_page(events[:1], 2)
+
+        with FakeSongkickClient(respond):
+            self.assertEqual(len(songkick.fetch_metro_calendar('sk:26330', max_pages=2)), 2)
+
+        with FakeSongkickClient(lambda path, payload: (503, None)):
+            self.assertIsNone(songkick.fetch_metro_calendar('sk:26330'))
+
+        def time_out(path, payload):
+            raise requests.ReadTimeout("Read timed out")
+
+        # Slow Songkick response doesn't stop the warmer
+        with FakeSongkickClient(time_out):
+            self.assertIsNone(songkick.fetch_metro_calendar('sk:26330'))
+            self.assertFalse(workers.warm_location('sk:26330'))
+
+    def test_event_replace_for_location(self):
+        max_age = timedelta(hours=1)
+        self.assertIsNone(model.Event.find_for_artists('sk:26330', ['metallica'], max_age))
+
+        events = sample_apis.outside_lands['resultsPage']['results']['event']
+        self.assertTrue(model.Event.replace_for_location('sk:26330', events + events))
+
+        artist_index = model.Event.find_for_artists('sk:26330', ['metallica', 'lorde', 'nobody'], max_age)
+        self.assertEqual(sorted(artist_index), ['lorde', 'metallica'])
+        self.assertEqual(artist_index['lorde'][0]['id'], events[0]['id'])
+        self.assertTrue(model.Location.query.get('sk:26330').is_warm(max_age))
+
+        # Long artist names don't stop the location's events being stored
+        long_event = dict(events[0], performance=[{'artist': {'displayName': 'Orchestra ' * 30}}])
+        self.assertTrue(model.Event.replace_for_location('sk:26330', [long_event]))
+        long_key = songkick.normalize_artist_name('Orchestra ' * 30)
+        self.assertEqual(list(model.Event.find_for_artists('sk:26330', [long_key], max_age)), [long_key])
+
+        self.assertTrue(model.Event.replace_for_location('sk:26330', []))
+        self.assertEqual(model.Event.find_for_artists('sk:26330', ['metallica'], max_age), {})
+        self.assertEqual(model.EventArtist.query.count(), 0)
+
 
 class TestServer(unittest.TestCase):
 
@@ -378,6 +1283,18 @@ class TestServer(unittest.TestCase):
         self.assertIn('<h3>FINDING CONCERTS...</h3>', result.data.decode('utf-8'))
         self.assertIn('<div id="concert-results" hidden>', result.data.decode('utf-8'))
 
+    def test_playlist_results_page(self):
+        result = self.client.post('/no-auth-search', data={'playlist': 'spotify:playlist:37i9dQZF1DXcBWIGoYBM5M'})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('playlist = "spotify:playlist:37i9dQZF1DXcBWIGoYBM5M"', result.data.decode('utf-8'))
+
+    def test_import_seeds(self):
+        result = self.client.get('/import-seeds.json?playlist=asdf')
+        self.assertIn('Unable to import', result.json)
+
+        result = self.client.get('/import-seeds.json')
+        self.assertIn('Unable to authorize', result.json)
+
     def test_location_matches(self):
         result = self.client.get('/location-search.json?search-term=SanFrancisco,+TX')
         self.assertEqual(result.status_code, 200)
@@ -406,6 +1323,61 @@ class TestServer(unittest.TestCase):
         self.assertIn('user-top-read', result.data.decode('utf-8'))
         self.assertIn('accounts.spotify.com', result.data.decode('utf-8'))
 
+    def test_saved_spotify_user(self):
+        spotify_user = model.SpotifyUser(spotify_user_id='spotifyuser')
+        model.db.session.add(spotify_user)
+        spotify_user.save_top_artists([{'spotify_id': '6Tyzp9KzpiZ04DABQoedps', 'artist': 'Little Dragon'}])
+
+        with self.client.session_transaction() as sess:
+            sess['spotify_user_id'] = 'spotifyuser'
+
+        # Results page is shown without asking Spotify for authorization
+        result = self.client.get('/spotify-auth.json')
+        self.assertEqual(result.json, '/callback')
+        result = self.client.get('/callback')
+        self.assertIn('spotifySession = true', result.data.decode('utf-8'))
+
+        # Saved top artists are used without a Spotify request
+        related = {'artists': [{'id': '3Ejmm2j2T6GRxqkfZ6cTzM', 'name': 'Jai Paul', 'images': []}]}
+        analyzation.RELATED_ARTISTS_CACHE.set('6Tyzp9KzpiZ04DABQoedps', related)
+        try:
+            result = self.client.get('/recs.json?auth-code=')
+        finally:
+            analyzation.RELATED_ARTISTS_CACHE.clear()
+        self.assertEqual([artist['artist'] for artist in result.json], ['Little Dragon', 'Jai Paul'])
+
+    def test_saved_spotify_user_without_code(self):
+        spotify_user = model.SpotifyUser(spotify_user_id='spotifyuser')
+        model.db.session.add(spotify_user)
+        spotify_user.save_top_artists([{'spotify_id': '6Tyzp9KzpiZ04DABQoedps', 'artist': 'Little Dragon'}])
+
+        with self.client.session_transaction() as sess:
+            sess['spotify_user_id'] = 'spotifyuser'
+
+        # Callback without a code doesn't send a code from the page
+        result = self.client.get('/callback')
+        self.assertIn('var authCode = "";', result.data.decode('utf-8'))
+        self.assertNotIn('"None"', result.data.decode('utf-8'))
+
+        # Code sent as 'None' by older pages uses the saved Spotify user
+        related = {'artists': [{'id': '3Ejmm2j2T6GRxqkfZ6cTzM', 'name': 'Jai Paul', 'images': []}]}
+        analyzation.RELATED_ARTISTS_CACHE.set('6Tyzp9KzpiZ04DABQoedps', related)
+        try:
+            result = self.client.get('/recs.json?auth-code=None')
+            self.assertEqual([artist['artist'] for artist in result.json], ['Little Dragon', 'Jai Paul'])
+
+            result = self.client.get('/search-stream?auth-code=')
+            self.assertNotIn('event: search-error', result.data.decode('utf-8'))
+            self.assertIn('event: artists\ndata: [{', result.data.decode('utf-8'))
+            self.assertIn('Jai Paul', result.data.decode('utf-8'))
+        finally:
+            analyzation.RELATED_ARTISTS_CACHE.clear()
+
+        # Logging out forgets the Spotify user, even without logging in
+        self.client.get('/logout')
+        with self.client.session_transaction() as sess:
+            self.assertNotIn('spotify_user_id', sess)
+
     def test_recommendations(self):
         result = self.client.get('/recs.json?code=AbCdEf')
         self.assertEqual(result.status_code, 200)
@@ -421,6 +1393,52 @@ class TestServer(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIsNotNone(result.data)
 
+    def test_concerts_timeout(self):
+        def time_out(path, payload):
+            raise requests.ReadTimeout("Read timed out")
+
+        try:
+            with FakeSongkickClient(time_out):
+                result = self.client.get('/concerts.json?spotify-id=123&artist=clipping&image-url=www.clip.com/img.jpg')
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(json.loads(result.data.decode('utf-8')), [])
+
+        finally:
+            songkick.SONGKICK_ARTIST_ID_CACHE.clear()
+            songkick.SONGKICK_EVENT_CACHE.clear()
+
+    def test_search_stream(self):
+        result = self.client.get('/search-stream?artists=[]')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'text/event-stream')
+        self.assertIn('event: artists\ndata: []\n\n', result.data.decode('utf-8'))
+        self.assertIn('event: done\ndata: {"artists": 0, "concerts": 0, "failed": 0}', result.data.decode('utf-8'))
+
+        result = self.client.get('/search-stream?auth-code=AbCdEf')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('event: search-error', result.data.decode('utf-8'))
+        self.assertNotIn('event: done', result.data.decode('utf-8'))
+
+    def test_concerts_batch_warm_location(self):
+        events = sample_apis.vw_concerts['resultsPage']['results']['event']
+        model.Event.replace_for_location('sk:24426', events)
+
+        artists = [{'spotify_id': '9999', 'artist': 'Vampire Weekend', 'image_url': None, 'source': None},
+                   {'spotify_id': '123', 'artist': 'clipping.', 'image_url': None, 'source': None}]
+        result = self.client.post('/concerts-batch.json', data={'artists': json.dumps(artists),
+                                                                'locID': 'sk:24426'})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(result.json['concerts']), 2)
+        self.assertEqual(result.json['concerts'][0]['spotify_id'], '9999')
+        self.assertEqual(result.json['failed'], [])
+
+    def test_concerts_batch(self):
+        artists = [{'spotify_id': '123', 'artist': 'clipping', 'image_url': None, 'source': None}]
+        result = self.client.post('/concerts-batch.json', data={'artists': json.dumps(artists)})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('"concerts":', result.data.decode('utf-8'))
+        self.assertIn('"failed":', result.data.decode('utf-8'))
+
 
 class TestServerLoggedIn(unittest.TestCase):
 
@@ -515,6 +1533,26 @@ class TestServerLoggedIn(unittest.TestCase):
         self.assertEqual(failure.status_code, 200)
         self.assertEqual(failure.data.decode('utf-8'), 'false\n')
 
+    def test_add_saved_concerts(self):
+        concerts = [{'songkick-id': '4', 'artist': 'Princess Nokia', 'venue-lat': '',
+                     'start-datetime': '2017-05-06T21:00:00'},
+                    {'songkick-id': '2', 'artist': 'Cakes Da Killa'},
+                    {'songkick-id': '1', 'artist': 'clipping.'}]
+        result = self.client.post('/add-concerts.json', data={'concerts': json.dumps(concerts)})
+        self.assertEqual(result.data.decode('utf-8'), 'true\n')
+
+        # New concert added, and repeat saves ignored
+        user = model.User.query.get(2)
+        self.assertEqual(sorted(concert.songkick_id for concert in user.concerts), [1, 2, 3, 4])
+        self.assertIsNone(model.Concert.query.get(4).venue_lat)
+        self.assertEqual(model.Concert.query.get(2).venue_name, 'The New Parish')
+
+        # Nothing is saved if one concert can't be
+        concerts = [{'songkick-id': '5', 'artist': 'Kelela'}, {'songkick-id': '99'}]
+        result = self.client.post('/add-concerts.json', data={'concerts': json.dumps(concerts)})
+        self.assertEqual(result.data.decode('utf-8'), 'false\n')
+        self.assertIsNone(model.Concert.query.get(5))
+
     def test_remove_saved_concert(self):
         result = self.client.post('/remove-concert.json', data={'songkick-id': '2'})
         self.assertEqual(result.status_code, 200)
@@ -530,17 +1568,9 @@ class TestFrozenMid(unittest.TestCase):
         model.db.create_all()
         model.example_data()
 
-        with freeze_time('2017-06-01 23:00:00', tz_offset=-7):
-            model.User.future_concerts = model.db.relationship("Concert",
-                                                               order_by="Concert.start_datetime",
-                                                               secondary="users_concerts",
-                                                               secondaryjoin=model.db.and_(model.UserConcert.songkick_id == model.Concert.songkick_id,
-                                                                                           model.Concert.start_datetime > datetime.now()))
-            model.User.past_concerts = model.db.relationship("Concert",
-                                                             order_by="Concert.start_datetime.desc()",
-                                                             secondary="users_concerts",
-                                                             secondaryjoin=model.db.and_(model.UserConcert.songkick_id == model.Concert.songkick_id,
-                                                                                         model.Concert.start_datetime < datetime.now()))
+        # Profile pages compare concert times with the frozen time
+        self.freezer = freeze_time('2017-06-01 23:00:00', tz_offset=-7)
+        self.freezer.start()
 
         server.app.config['TESTING'] = True
         server.app.config['SECRET_KEY'] = 'key'
@@ -550,6 +1580,7 @@ class TestFrozenMid(unittest.TestCase):
             sess['user_id'] = 2
 
     def tearDown(self):
+        self.freezer.stop()
         model.db.session.close()
         model.db.drop_all()
 
@@ -557,10 +1588,10 @@ class TestFrozenMid(unittest.TestCase):
         kiko = model.User.query.get(2)
 
         self.assertEqual(len(kiko.concerts), 2)
-        self.assertEqual(len(kiko.past_concerts), 1)
-        self.assertEqual(kiko.past_concerts[0].artist, 'Cakes Da Killa')
-        self.assertEqual(len(kiko.future_concerts), 1)
-        self.assertEqual(kiko.future_concerts[0].artist, 'Sleigh Bells')
+        self.assertEqual(len(kiko.past_concerts()), 1)
+        self.assertEqual(kiko.past_concerts()[0].artist, 'Cakes Da Killa')
+        self.assertEqual(len(kiko.future_concerts()), 1)
+        self.assertEqual(kiko.future_concerts()[0].artist, 'Sleigh Bells')
 
     def test_profile(self):
         result = self.client.get('/my-profile')
@@ -581,6 +1612,36 @@ class TestFrozenMid(unittest.TestCase):
         self.assertNotIn('<h4>Cakes Da Killa</h4>', result.data.decode('utf-8'))
         self.assertNotIn('Mykki Blanco &amp; Cakes Da Killa', result.data.decode('utf-8'))
 
+    def test_load_profile_concerts(self):
+        kiko = model.User.query.get(2)
+
+        concerts, has_past = kiko.load_profile_concerts(False, 5)
+        self.assertEqual([concert.artist for concert in concerts], ['Sleigh Bells'])
+        self.assertTrue(has_past)
+
+        concerts, has_future = kiko.load_profile_concerts(True, 5)
+        self.assertEqual([concert.artist for concert in concerts], ['Cakes Da Killa'])
+        self.assertTrue(has_future)
+
+        self.assertEqual(sorted(model.User.saved_concert_ids(2)), [2, 3])
+
+    def test_profile_query_count(self):
+        # Loading the user, then the page of concerts with one from the other side
+        for url in ('/my-profile', '/my-profile/past'):
+            with QueryCounter(model.db.engine) as counter:
+                result = self.client.get(url)
+
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(len(counter.statements), 2, url)
+
+        # Saved concert ids without loading the user
+        with QueryCounter(model.db.engine) as counter:
+            with server.app.test_request_context():
+                server.session['user_id'] = 2
+                self.assertEqual(sorted(server.get_user_saved_concerts()), [2, 3])
+
+        self.assertEqual(len(counter.statements), 1)
+
     def test_past(self):
         result = self.client.get('/my-profile/past')
         self.assertEqual(result.status_code, 200)
@@ -606,27 +1667,53 @@ class TestFrozenEarly(unittest.TestCase):
         model.db.create_all()
         model.example_data()
 
-        with freeze_time('2016-06-01 23:00:00', tz_offset=-7):
-            model.User.future_concerts = model.db.relationship("Concert",
-                                                               order_by="Concert.start_datetime",
-                                                               secondary="users_concerts",
-                                                               secondaryjoin=model.db.and_(model.UserConcert.songkick_id == model.Concert.songkick_id,
-                                                                                           model.Concert.start_datetime > datetime.now()))
-            model.User.past_concerts = model.db.relationship("Concert",
-                                                             order_by="Concert.start_datetime.desc()",
-                                                             secondary="users_concerts",
-                                                             secondaryjoin=model.db.and_(model.UserConcert.songkick_id == model.Concert.songkick_id,
-                                                                                         model.Concert.start_datetime < datetime.now()))
+        # Profile pages compare concert times with the frozen time
+        self.freezer = freeze_time('2016-06-01 23:00:00', tz_offset=-7)
+        self.freezer.start()
 
     def tearDown(self):
+        self.freezer.stop()
         model.db.session.close()
         model.db.drop_all()
 
     def test_way_past(self):
         kiko = model.User.query.get(2)
-        self.assertEqual(len(kiko.past_concerts), 0)
-        self.assertEqual(len(kiko.future_concerts), 2)
-        self.assertEqual(kiko.future_concerts[0].artist, 'Cakes Da Killa')
+        self.assertEqual(len(kiko.past_concerts()), 0)
+        self.assertEqual(len(kiko.future_concerts()), 2)
+        self.assertEqual(kiko.future_concerts()[0].artist, 'Cakes Da Killa')
+
+    def test_future_pages(self):
+        kiko = model.User.query.get(2)
+
+        first_page = kiko.future_concerts(1)
+        self.assertEqual([concert.artist for concert in first_page], ['Cakes Da Killa'])
+
+        after = model.Concert.parse_page_cursor(first_page[0].page_cursor)
+        self.assertEqual(after, (datetime(2017, 3, 3, 20, 0), 2))
+        self.assertEqual([concert.artist for concert in kiko.future_concerts(1, after)], ['Sleigh Bells'])
+        self.assertEqual(kiko.future_concerts(1, (datetime(2017, 8, 11, 10, 0), 3)), [])
+        self.assertIsNone(model.Concert.parse_page_cursor('2017-03-03'))
+
+    def test_profile_pages(self):
+        server.PROFILE_PAGE_SIZE = 1
+        client = server.app.test_client()
+
+        with client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+        try:
+            result = client.get('/my-profile')
+            self.assertIn('<h4>Cakes Da Killa</h4>', result.data.decode('utf-8'))
+            self.assertNotIn('<h4>Sleigh Bells</h4>', result.data.decode('utf-8'))
+            self.assertIn('href="?after=2017-03-03T20%3A00%3A00_2"', result.data.decode('utf-8'))
+
+            result = client.get('/my-profile?after=2017-03-03T20%3A00%3A00_2')
+            self.assertIn('<h4>Sleigh Bells</h4>', result.data.decode('utf-8'))
+            self.assertNotIn('<h4>Cakes Da Killa</h4>', result.data.decode('utf-8'))
+            self.assertNotIn('id="next-page"', result.data.decode('utf-8'))
+
+        finally:
+            server.PROFILE_PAGE_SIZE = 20
 
 
 class TestFrozenFuture(unittest.TestCase):
@@ -635,27 +1722,20 @@ class TestFrozenFuture(unittest.TestCase):
         model.db.create_all()
         model.example_data()
 
-        with freeze_time('2018-06-01 23:00:00', tz_offset=-7):
-            model.User.future_concerts = model.db.relationship("Concert",
-                                                               order_by="Concert.start_datetime",
-                                                               secondary="users_concerts",
-                                                               secondaryjoin=model.db.and_(model.UserConcert.songkick_id == model.Concert.songkick_id,
-                                                                                           model.Concert.start_datetime > datetime.now()))
-            model.User.past_concerts = model.db.relationship("Concert",
-                                                             order_by="Concert.start_datetime.desc()",
-                                                             secondary="users_concerts",
-                                                             secondaryjoin=model.db.and_(model.UserConcert.songkick_id == model.Concert.songkick_id,
-                                                                                         model.Concert.start_datetime < datetime.now()))
+        # Profile pages compare concert times with the frozen time
+        self.freezer = freeze_time('2018-06-01 23:00:00', tz_offset=-7)
+        self.freezer.start()
 
     def tearDown(self):
+        self.freezer.stop()
         model.db.session.close()
         model.db.drop_all()
 
     def test_way_future(self):
         kiko = model.User.query.get(2)
-        self.assertEqual(len(kiko.future_concerts), 0)
-        self.assertEqual(len(kiko.past_concerts), 2)
-        self.assertEqual(kiko.past_concerts[0].artist, 'Sleigh Bells')
+        self.assertEqual(len(kiko.future_concerts()), 0)
+        self.assertEqual(len(kiko.past_concerts()), 2)
+        self.assertEqual(kiko.past_concerts()[0].artist, 'Sleigh Bells')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+"""Timing of slow stages of a search"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """Thread-safe running totals of how long a stage takes"""
+
+    def __init__(self, name):
+
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._counts = {'calls': 0,
+                        'total_seconds': 0.0,
+                        'max_seconds': 0.0,
+                        'last_seconds': None}
+
+    @contextmanager
+    def time(self):
+        """Context manager that records how long its block takes"""
+
+        started = time.time()
+
+        try:
+            yield
+
+        finally:
+            self.record(time.time() - started)
+
+    def record(self, seconds):
+        """Add a timing for the stage"""
+
+        with self._lock:
+            self._counts['calls'] += 1
+            self._counts['total_seconds'] += seconds
+            self._counts['max_seconds'] = max(self._counts['max_seconds'], seconds)
+            self._counts['last_seconds'] = seconds
+
+    def stats(self):
+        """Return dictionary of the stage's timings"""
+
+        with self._lock:
+            stats = dict(self._counts)
+
+        stats['mean_seconds'] = stats['total_seconds'] / stats['calls'] if stats['calls'] else None
+
+        return stats
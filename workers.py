@@ -0,0 +1,166 @@
+"""Background jobs that keep the database's Songkick data fresh and tidy
+
+Run as a separate process with `python workers.py`, which warms locations
+and collects concerts in a background thread, or from the Flask CLI with
+`flask warm-locations` and `flask collect-concerts`.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+from model import db, Location, Event, Concert, connect_to_db
+from songkick import fetch_metro_calendar
+
+# Seconds between refreshes of the most searched locations
+WARMER_INTERVAL = int(os.getenv('WARMER_INTERVAL', 30 * 60))
+
+# Number of most searched locations to keep fresh
+WARMER_LOCATIONS = int(os.getenv('WARMER_LOCATIONS', 10))
+
+# Seconds between removals of concerts no user has saved
+COLLECTOR_INTERVAL = int(os.getenv('COLLECTOR_INTERVAL', 60 * 60))
+
+# Concerts removed in each transaction, and seconds to pause between them
+COLLECTOR_BATCH_SIZE = int(os.getenv('COLLECTOR_BATCH_SIZE', 1000))
+COLLECTOR_BATCH_PAUSE = float(os.getenv('COLLECTOR_BATCH_PAUSE', 0.1))
+
+
+def warm_location(location_id):
+    """Replace a location's stored events with its current Songkick calendar
+
+    Return True if successful, False if unsuccessful
+    """
+
+    events = fetch_metro_calendar(location_id)
+
+    # Keep the location cold if the calendar can't be read in full
+    if events is None:
+        return False
+
+    return Event.replace_for_location(location_id, events)
+
+
+def warm_popular_locations(limit=None):
+    """Refresh stored events for the most searched locations
+
+    Returns list of the location ids that were refreshed
+    """
+
+    if limit is None:
+        limit = WARMER_LOCATIONS
+
+    # Get ids first, since refreshing a location commits the session
+    location_ids = [location.location_id for location in Location.most_searched(limit)]
+
+    refreshed = []
+
+    for location_id in location_ids:
+        if warm_location(location_id):
+            refreshed.append(location_id)
+        else:      # pragma: no cover
+            print("Failed to warm: {}".format(location_id))
+
+    return refreshed
+
+
+def run_warmer(interval=None, limit=None):      # pragma: no cover
+    """Refresh the most searched locations every interval seconds, forever"""
+
+    if interval is None:
+        interval = WARMER_INTERVAL
+
+    while True:
+        started = time.time()
+
+        try:
+            refreshed = warm_popular_locations(limit)
+            print("Warmed {} locations in {:.1f}s".format(len(refreshed), time.time() - started))
+
+        # Keep warming on the next pass, e.g. if Songkick or the database was unavailable
+        except Exception as msg:
+            db.session.rollback()
+            print("Failed to warm locations: {}".format(msg))
+
+        # Wait until the next refresh is due
+        time.sleep(max(interval - (time.time() - started), 0))
+
+
+def collect_orphaned_concerts(batch_size=None, pause=None):
+    """Delete future concerts and archive past concerts that no user has saved
+
+    Works in small batches, each its own transaction, pausing between them
+    so other writes to the concerts table aren't held up.
+    Returns (number deleted, number archived)
+    """
+
+    if batch_size is None:
+        batch_size = COLLECTOR_BATCH_SIZE
+    if pause is None:
+        pause = COLLECTOR_BATCH_PAUSE
+
+    # Split future and past at the same time for every batch
+    now = datetime.now()
+    total_deleted = total_archived = 0
+
+    while True:
+        try:
+            deleted, archived = Concert.collect_orphans(now, batch_size)
+
+        # Try again on the next run, e.g. if a user saved a concert meanwhile
+        except Exception as msg:      # pragma: no cover
+            print("Failed to collect concerts: {}".format(msg))
+            break
+
+        total_deleted += deleted
+        total_archived += archived
+
+        # Stop once a batch finds fewer orphans than it could remove
+        if deleted < batch_size and archived < batch_size:
+            break
+
+        time.sleep(pause)
+
+    return total_deleted, total_archived
+
+
+def run_collector(interval=None):      # pragma: no cover
+    """Remove concerts no user has saved every interval seconds, forever"""
+
+    if interval is None:
+        interval = COLLECTOR_INTERVAL
+
+    while True:
+        started = time.time()
+
+        deleted, archived = collect_orphaned_concerts()
+        print("Deleted {} and archived {} concerts in {:.1f}s".format(deleted, archived,
+                                                                     time.time() - started))
+
+        time.sleep(max(interval - (time.time() - started), 0))
+
+
+def start_collector(app, interval=None):      # pragma: no cover
+    """Start removing unsaved concerts every interval seconds in a background thread"""
+
+    def collect():
+        with app.app_context():
+            run_collector(interval)
+
+    thread = threading.Thread(target=collect, name='concert-collector')
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+if __name__ == "__main__":      # pragma: no cover
+
+    from server import app
+    connect_to_db(app)
+
+    start_collector(app)
+
+    with app.app_context():
+        run_warmer()